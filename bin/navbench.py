@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+'''
+        FILE:  navbench.py
+ DESCRIPTION:  Benchmark the csv encoder used to write the r2rnav exports
+               (lib/nav_writer.py encode_csv) against DataFrame.to_csv and
+               the archive decoder (lib/nav_archive.py read_archive) on a
+               synthetic r2rnav dataframe, reports the rows/s of each.
+
+        BUGS:
+       NOTES:  The synthetic data is a 1Hz bestres-like track: iso_time,
+               rounded longitude/latitude, nmea_quality, nsv, hdop, antenna
+               height and rounded speed/course, with a few missing values.
+               Both encoders must produce identical bytes and the decoded
+               archive must match the dataframe written.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-24
+    REVISION:  2021-05-24
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import argparse
+import os
+import sys
+import time
+import logging
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from os.path import dirname, realpath
+sys.path.append(dirname(dirname(realpath(__file__))))
+
+from lib.nav_manager import rounding
+from lib.nav_writer import encode_csv, ISO_DATE_FORMAT
+from lib.nav_archive import write_archive, read_archive
+
+BENCH_ROWS = 2000000
+BENCH_REPEATS = 3
+
+
+def build_frame(rows, seed=0):
+    """
+    Return a synthetic r2rnav dataframe with the specified number of rows
+    """
+
+    rng = np.random.default_rng(seed)
+
+    data = pd.DataFrame({
+        'iso_time': pd.Timestamp('2021-01-01') + pd.to_timedelta(np.arange(rows) * 1000 + rng.integers(0, 5, rows), unit='ms'),
+        'ship_longitude': -92.02695 + np.cumsum(rng.normal(0, 1e-5, rows)),
+        'ship_latitude': 46.805483 + np.cumsum(rng.normal(0, 1e-5, rows)),
+        'nmea_quality': rng.integers(1, 3, rows),
+        'nsv': rng.integers(6, 13, rows),
+        'hdop': rng.integers(5, 20, rows) / 10,
+        'antenna_height': np.round(rng.normal(10, 0.5, rows), 1),
+        'speed_made_good': np.abs(rng.normal(5, 1, rows)),
+        'course_made_good': rng.uniform(0, 360, rows)
+    })
+
+    missing = rng.random(rows) < 0.001
+    data.loc[missing, 'hdop'] = np.nan
+    data.loc[missing, 'antenna_height'] = np.nan
+
+    return data.round(pd.Series(rounding))
+
+
+def time_encoder(encoder, repeats):
+    """
+    Return the best time in seconds of repeats runs of the encoder and its
+    output
+    """
+
+    best = None
+    output = None
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = encoder()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, output
+
+
+def bench_csv(frame, repeats):
+    """
+    Time encode_csv against DataFrame.to_csv, returns False if the outputs
+    differ
+    """
+
+    rows = len(frame.index)
+
+    logging.info("Timing DataFrame.to_csv")
+    pandas_time, pandas_output = time_encoder(lambda: frame.to_csv(index=False, date_format=ISO_DATE_FORMAT).encode('utf-8'), repeats)
+
+    logging.info("Timing encode_csv")
+    encoder_time, encoder_output = time_encoder(lambda: encode_csv(frame, date_format=ISO_DATE_FORMAT, precision=rounding), repeats)
+
+    if encoder_output != pandas_output:
+        logging.error("encode_csv output differs from DataFrame.to_csv")
+        return False
+
+    print("csv: %d rows, output: %0.1f MB, best of %d" % (rows, len(encoder_output) / 10**6, repeats))
+    print("DataFrame.to_csv: %0.3f s, %d rows/s" % (pandas_time, rows / pandas_time))
+    print("encode_csv:       %0.3f s, %d rows/s" % (encoder_time, rows / encoder_time))
+    print("Speedup: %0.1fx" % (pandas_time / encoder_time))
+
+    return True
+
+
+def bench_archive(frame, repeats):
+    """
+    Time write_archive and read_archive, returns False if the decoded
+    dataframe differs from the dataframe written
+    """
+
+    rows = len(frame.index)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.r2rnav')
+
+        logging.info("Timing write_archive")
+        write_time, _ = time_encoder(lambda: write_archive(frame, filename, precision=rounding), repeats)
+        size = os.path.getsize(filename)
+
+        logging.info("Timing read_archive")
+        read_time, decoded = time_encoder(lambda: read_archive(filename), repeats)
+
+    # the archive decodes times at ns resolution
+    if not decoded.astype(frame.dtypes.to_dict()).equals(frame):
+        logging.error("read_archive output differs from the dataframe written")
+        return False
+
+    decoded_size = decoded.memory_usage(index=False).sum()
+
+    print("archive: %d rows, file: %0.1f MB, decoded: %0.1f MB, best of %d" % (rows, size / 10**6, decoded_size / 10**6, repeats))
+    print("write_archive: %0.3f s, %d rows/s" % (write_time, rows / write_time))
+    print("read_archive:  %0.3f s, %d rows/s, %0.1f MB/s" % (read_time, rows / read_time, decoded_size / 10**6 / read_time))
+
+    return True
+
+
+# -------------------------------------------------------------------------------------
+# Main function
+# -------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the r2rnav csv encoder and archive decoder')
+    parser.add_argument('-v', '--verbosity', dest='verbosity', default=0, action='count', help='Increase output verbosity, default level: warning')
+    parser.add_argument('-n', '--rows', type=int, default=BENCH_ROWS, metavar='rows', help='Number of rows of the synthetic dataframe, default: %d' % BENCH_ROWS)
+    parser.add_argument('-b', '--benchmark', type=str, action='append', metavar='benchmark', choices=['csv', 'archive'], help='The benchmark to run: csv (encode_csv vs DataFrame.to_csv), archive (write_archive/read_archive), may be repeated, default: all')
+    parser.add_argument('-r', '--repeats', type=int, default=BENCH_REPEATS, metavar='repeats', help='Number of runs of each encoder/decoder, the best run is reported, default: %d' % BENCH_REPEATS)
+
+    parsed_args = parser.parse_args()
+
+    ############################
+    # Set up logging before we do any other argument parsing (so that we
+    # can log problems with argument parsing).
+
+    LOGGING_FORMAT = '%(asctime)-15s %(levelname)s - %(message)s'
+    logging.basicConfig(format=LOGGING_FORMAT)
+
+    LOG_LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+    parsed_args.verbosity = min(parsed_args.verbosity, max(LOG_LEVELS))
+    logging.getLogger().setLevel(LOG_LEVELS[parsed_args.verbosity])
+
+    logging.info("Building synthetic r2rnav dataframe of %d rows", parsed_args.rows)
+    frame = build_frame(parsed_args.rows)
+
+    passed = True
+    for benchmark in parsed_args.benchmark or ['csv', 'archive']:
+        if benchmark == 'csv':
+            passed &= bench_csv(frame, parsed_args.repeats)
+        elif benchmark == 'archive':
+            passed &= bench_archive(frame, parsed_args.repeats)
+
+    sys.exit(0 if passed else 1)
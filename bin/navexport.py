@@ -17,16 +17,123 @@ LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for detai
 '''
 
 import argparse
+import itertools
 import os
 import sys
 import logging
-from io import StringIO
 from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from os.path import dirname, realpath
 sys.path.append(dirname(dirname(realpath(__file__))))
 
-from lib.nav_manager import NavExport, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL
+from lib.nav_manager import NavExport, PRODUCT_COLS, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL, RDP_EPSILON, PYRAMID_FACTOR, PYRAMID_MIN_POINTS, rounding
+from lib.nav_writer import write_csv, write_csv_chunks, write_pyramid, open_output, get_compression, ISO_DATE_FORMAT
+from lib.nav_decimate import parse_interval, DECIMATION_RULES
+from lib.geocsv_templates import onemin_header, control_header, pyramid_header
+
+
+def check_interval(interval):
+    '''
+    Verifies a valid decimation interval has been specified
+    '''
+
+    try:
+        parse_interval(interval)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+    return interval
+
+
+def product_filename(outfile, suffix, directory=False):
+    '''
+    Insert the suffix before the outfile extension (including the
+    compression extension), i.e. control.csv.gz -> control_500pts.csv.gz.  If
+    directory is set the extension is removed, i.e. cruise.geocsv ->
+    cruise_pyramid
+    '''
+
+    root, ext = os.path.splitext(outfile)
+    if ext in ['.gz', '.zst']:
+        root, data_ext = os.path.splitext(root)
+        ext = data_ext + ext
+
+    return "{}_{}{}".format(root, suffix, '' if directory else ext)
+
+
+def write_product(parsed_args, build, header, outfile):
+    '''
+    Build the product data and write it to the outfile or stdout
+    '''
+
+    data = build()
+
+    if outfile:
+        logging.info("Saving nav export to %s in %s format", outfile, parsed_args.outfileformat)
+    else:
+        logging.info("Sending nav export to stdout in %s format", parsed_args.outfileformat)
+
+    try:
+        with open_output(outfile, compression=parsed_args.compression, threads=parsed_args.threads) as out_file:
+            write_csv(data, out_file, header=header, na_rep='NAN', date_format=ISO_DATE_FORMAT, precision=rounding)
+
+    except (IOError, ValueError) as err:
+        logging.error("Error saving nav export file: %s", outfile)
+        logging.error(str(err))
+
+
+def first_chunk(chunks):
+    '''
+    Skip the leading empty chunks, returns the first chunk with any rows (the
+    last chunk if all the chunks are empty, None if there are no chunks) and
+    the iterator of the remaining chunks
+    '''
+
+    first = None
+    for first in chunks:
+        if len(first.index) > 0:
+            break
+
+    return first, chunks
+
+
+def write_streamed_product(parsed_args, chunks, header, outfile):
+    '''
+    Write the product chunks to the outfile or stdout as they are built
+    '''
+
+    if outfile:
+        logging.info("Streaming nav export to %s in %s format", outfile, parsed_args.outfileformat)
+    else:
+        logging.info("Streaming nav export to stdout in %s format", parsed_args.outfileformat)
+
+    try:
+        with open_output(outfile, compression=parsed_args.compression, threads=parsed_args.threads) as out_file:
+            rows = write_csv_chunks(chunks, out_file, header=header, na_rep='NAN', date_format=ISO_DATE_FORMAT, precision=rounding)
+            logging.info("Wrote %d rows", rows)
+
+    except (IOError, ValueError) as err:
+        logging.error("Error saving nav export file: %s", outfile)
+        logging.error(str(err))
+
+
+def write_pyramid_product(parsed_args, build, header, directory):
+    '''
+    Build the track pyramid levels and write them to the directory, the
+    levels are compressed like the outfile
+    '''
+
+    try:
+        compression = get_compression(parsed_args.outfile, parsed_args.compression)
+        manifest = write_pyramid(build(), directory, header=header, compression=compression, threads=parsed_args.threads, na_rep='NAN', precision=rounding)
+        logging.info("Wrote %d level(s) to %s", len(manifest['levels']), directory)
+
+    except (IOError, ValueError) as err:
+        logging.error("Error saving track pyramid to: %s", directory)
+        logging.error(str(err))
+
 
 # -------------------------------------------------------------------------------------
 # Main function
@@ -36,16 +143,27 @@ if __name__ == "__main__":
     parser.add_argument('-v', '--verbosity', dest='verbosity', default=0, action='count', help='Increase output verbosity, default level: warning')
     parser.add_argument('-o', '--outfile', type=str, metavar='outfile', help='Write output to specified outfile')
     parser.add_argument('-O', '--outfileformat', type=str, metavar='outfileformat', default="geocsv", choices=["csv","geocsv"], help='The outfile format: csv or geocsv, default: geocsv')
+    parser.add_argument('-z', '--compression', type=str, metavar='compression', choices=["gzip","zstd"], help='Compress the output: gzip, zstd, default: determined by the outfile extension (.gz, .zst)')
+    parser.add_argument('--threads', type=int, metavar='threads', help='Number of threads used to compress the output, default: number of cpus')
     parser.add_argument('-m', '--meta', type=str, nargs='*', help='Add custom metadata to the geocsv header, overrides default vaules, format: "key=value"')
     parser.add_argument('-q', '--qc', action='store_true', help='Exclude bad data points before exporting data')
-    parser.add_argument('-t', '--type', type=str, metavar='outputtype', default="bestres", choices=["bestres","1min","control"], help='The type of output to generate: bestres, 1min, control, default: bestres')
+    parser.add_argument('-Q', '--keepflagged', action='store_true', help='With -q keep the bad data points in the bestres product and add their qc_flags column instead of excluding them')
+    parser.add_argument('-t', '--type', type=str, action='append', metavar='outputtype', choices=["bestres","1min","decimated","control","pyramid"], help='The type of output to generate: bestres, 1min, decimated (requires -i), control, pyramid (directory of track levels of detail plus a manifest, requires -o), may be repeated to build several products from one load, default: bestres')
+    parser.add_argument('-i', '--interval', type=check_interval, metavar='interval', help='The interval of the decimated product, a number followed by s, min, h (time), m, km, nm (distance along the track) or pts (number of fixes), i.e. 10s, 500m')
+    parser.add_argument('-r', '--rule', type=str, metavar='rule', default='first', choices=DECIMATION_RULES, help='The fix used for each interval of the decimated product: first, center (nearest to the center of the interval) or mean, default: first')
+    parser.add_argument('-e', '--epsilon', type=float, action='append', metavar='epsilon', help='The RDP epsilon (degrees) of the control product, may be repeated to build several control products from one ranking, default: %g' % RDP_EPSILON)
+    parser.add_argument('-n', '--maxpoints', type=int, action='append', metavar='maxpoints', help='Build a control product with at most this many points, may be repeated')
+    parser.add_argument('--pyramidfactor', type=int, default=PYRAMID_FACTOR, metavar='pyramidfactor', help='Each level of the track pyramid has 1/N of the points of the previous level, default: %d' % PYRAMID_FACTOR)
+    parser.add_argument('--pyramidminpoints', type=int, default=PYRAMID_MIN_POINTS, metavar='pyramidminpoints', help='The minimum number of points of the coarsest level of the track pyramid, default: %d' % PYRAMID_MIN_POINTS)
     parser.add_argument('--startTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='startTS', help='Crop data to start timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('--endTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='endTS', help='Crop data to end timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('-g', '--gapthreshold', type=float, default=MAX_DELTA_T,  metavar='gapthreshold', help='Set custom gap threshold in seconds')
     parser.add_argument('-s', '--speedthreshold', type=float, default=MAX_SPEED, metavar='speedthreshold', help='Set custom speed threshold in m/s')
     parser.add_argument('-a', '--accelerationthreshold', default=MAX_ACCEL, type=float, metavar='accelerationthreshold', help='Set custom acceleration threshold in m/s^2')
-    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf"], help='The format type of input r2rnav file: csv, hdf, default: csv')
-    parser.add_argument('input', type=str, help='The input r2rnav file')
+    parser.add_argument('-c', '--chunksize', type=int, metavar='chunksize', help='Stream the bestres product in chunks of this many input rows instead of loading the input into memory')
+    parser.add_argument('--explain', action='store_true', help='Print the executed load plan (steps, optimized plan and row counts) to stderr')
+    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf","archive"], help='The format type of input r2rnav file: csv, hdf, archive, default: csv')
+    parser.add_argument('input', type=str, help='The input r2rnav file or partitioned r2rnav directory')
 
     parsed_args = parser.parse_args()
 
@@ -76,75 +194,128 @@ if __name__ == "__main__":
 
     navexport = NavExport(parsed_args.input, delta_t_threshold=metadata['delta_t_threshold'], speed_threshold=metadata['speed_threshold'], acceleration_threshold=metadata['acceleration_threshold'])
 
+    product_types = list(dict.fromkeys(parsed_args.type or ['bestres']))
+
     try:
 
+        if parsed_args.chunksize and product_types != ['bestres']:
+            logging.error("Only the bestres product can be streamed (-c)")
+            sys.exit(1)
+
+        if 'decimated' in product_types and not parsed_args.interval:
+            logging.error("The decimated product requires an interval (-i)")
+            sys.exit(1)
+
+        if 'pyramid' in product_types and not parsed_args.outfile:
+            logging.error("The track pyramid requires an output directory (-o)")
+            sys.exit(1)
+
+        # the steps are planned and executed once, the crop window and QC
+        # rules are applied while reading only the columns of the products
+        logging.info("Planning r2rnav file: %s", parsed_args.input)
+        navexport.read_r2rnavfile(parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS)
+
+        if parsed_args.startTS or parsed_args.endTS:
+            logging.info("Cropping data to: %s - %s", parsed_args.startTS, parsed_args.endTS)
+            navexport.crop_data(start_ts=parsed_args.startTS, end_ts=parsed_args.endTS)
+
+        if parsed_args.qc:
+            logging.info("Removing bad data based on QC rules")
+            navexport.apply_qc(keep_flagged=parsed_args.keepflagged)
+
+        elif parsed_args.keepflagged:
+            logging.warning("Keeping flagged data (-Q) requires the QC rules (-q), ignoring")
+
+        navexport.select_columns([col for product_type in product_types for col in PRODUCT_COLS[product_type]])
+
+        if parsed_args.chunksize:
+            logging.info("Streaming r2rnav file: %s in chunks of %d rows", parsed_args.input, parsed_args.chunksize)
+            first, chunks = first_chunk(navexport.iter_bestres(chunk_size=parsed_args.chunksize))
+
+            if first is None:
+                logging.error("Unable to read input file")
+                sys.exit(1)
+
+            if len(first.index) == 0 and (parsed_args.startTS or parsed_args.endTS):
+                logging.warning("Data is empty after cropping for start/end timestamps")
+                sys.exit(0)
+
+            template = navexport.bestres_template(keep_flagged=parsed_args.qc and parsed_args.keepflagged)
+            header = navexport.geocsv_header(metadata, template) if parsed_args.outfileformat == 'geocsv' else None
+
+            write_streamed_product(parsed_args, itertools.chain([first], chunks), header, parsed_args.outfile)
+
+            if parsed_args.explain:
+                print(navexport.plan.explain(), file=sys.stderr)
+
+            sys.exit(0)
+
         try:
-            # Process the files
             logging.info("Reading r2rnav file: %s", parsed_args.input)
-            navexport.read_r2rnavfile(parsed_args.inputformat)
+            navexport.execute()
         except Exception as err:
             logging.error("Unable to read input file")
             raise err
 
-        if parsed_args.startTS or parsed_args.endTS:
-            try:
-                logging.info("Cropping data older than: %s", parsed_args.startTS)
-                navexport.crop_data(start_ts=parsed_args.startTS, end_ts=parsed_args.endTS)
+        if parsed_args.explain:
+            print(navexport.plan.explain(), file=sys.stderr)
 
-            except Exception as err:
-                logging.error("Error cropping data")
-                logging.error(str(err))
-                raise err
+        if (parsed_args.startTS or parsed_args.endTS) and navexport.plan.stats['cropped'] == 0:
+            logging.warning("Data is empty after cropping for start/end timestamps")
+            sys.exit(0)
 
-            if navexport.data.shape[0] == 0:
-                logging.warning("Data is empty after cropping for start/end timestamps")
-                sys.exit(0)
+        control_products = [('eps%g' % epsilon, epsilon, None) for epsilon in parsed_args.epsilon or []]
+        control_products += [('%dpts' % max_points, None, max_points) for max_points in parsed_args.maxpoints or []]
 
-        if parsed_args.qc:
-            logging.info("Removing bad data based on QC rules")
-            navexport.apply_qc()
-
-        if parsed_args.type == 'bestres':
-            logging.info("Building bestres dataset")
-            navexport.build_bestres()
-        elif parsed_args.type == '1min':
-            logging.info("Building 1min dataset")
-            navexport.build_1min()
-        elif parsed_args.type == 'control':
-            logging.info("Building control dataset")
-            navexport.build_control()
-
-        if parsed_args.outfile:
-            logging.info("Saving nav export to %s in %s format", parsed_args.outfile, parsed_args.outfileformat)
-
-            try:
-                with open(parsed_args.outfile, 'w') as out_file:
-
-                    if parsed_args.outfileformat == 'csv':
-                        navexport.data.to_csv(out_file, index=False, na_rep='NAN', date_format='%Y-%m-%dT%H:%M:%S.%fZ')
-
-                    elif parsed_args.outfileformat == 'geocsv':
-                        out_file.write(navexport.geocsv_header(metadata))
-                        navexport.data.to_csv(out_file, mode='a', index=False, na_rep='NAN', date_format='%Y-%m-%dT%H:%M:%S.%fZ')
-
-            except IOError:
-                logging.error("Error saving nav export file: %s", parsed_args.outfile)
-
-        else:
-            logging.info("Sending nav export to stdout in %s format", parsed_args.outfileformat)
-
-            if parsed_args.outfileformat == 'csv':
-                output = StringIO()
-                navexport.data.to_csv(output, index=False, na_rep='NAN', date_format='%Y-%m-%dT%H:%M:%S.%fZ')
-                output.seek(0)
-                print(output.read())
-
-            elif parsed_args.outfileformat == 'geocsv':
-                output = StringIO()
-                navexport.data.to_csv(output, index=False, na_rep='NAN', date_format='%Y-%m-%dT%H:%M:%S.%fZ')
-                output.seek(0)
-                print(navexport.geocsv_header(metadata), end='')
-                print(output.read())
+        # (product type, suffix, function returning the data, geocsv template)
+        products = []
+        for product_type in product_types:
+            prefix = [product_type] if len(product_types) > 1 else []
+
+            if product_type == 'bestres':
+                products.append((product_type, prefix, navexport.bestres_data, navexport.bestres_template()))
+            elif product_type == '1min':
+                products.append((product_type, prefix, navexport.onemin_data, onemin_header))
+            elif product_type == 'decimated':
+                products.append((product_type, prefix, partial(navexport.decimated_data, parsed_args.interval, parsed_args.rule), NavExport.decimated_header(parsed_args.interval, parsed_args.rule)))
+            elif product_type == 'control':
+                for suffix, epsilon, max_points in control_products or [(None, None, None)]:
+                    products.append((product_type, prefix + ([suffix] if len(control_products) > 1 else []), partial(navexport.control_data, epsilon, max_points), control_header))
+            elif product_type == 'pyramid':
+                products.append((product_type, prefix, partial(navexport.pyramid_data, parsed_args.pyramidfactor, parsed_args.pyramidminpoints), pyramid_header))
+
+        if len(products) > 1 and not parsed_args.outfile:
+            logging.error("Multiple products require an outfile (-o)")
+            sys.exit(1)
+
+        # rank the control points once for all the control products and the
+        # track pyramid
+        epsilons = [epsilon for _, epsilon, _ in control_products if epsilon is not None]
+        budgets = [max_points for _, _, max_points in control_products if max_points is not None]
+
+        if 'control' in product_types and not control_products:
+            epsilons.append(RDP_EPSILON)
+
+        if 'pyramid' in product_types:
+            levels = navexport.pyramid_levels(parsed_args.pyramidfactor, parsed_args.pyramidminpoints)
+            budgets += [levels[1] + 1] if len(levels) > 1 else []
+
+        if epsilons or budgets:
+            logging.info("Ranking control points")
+            navexport.rank_control(epsilons or None, budgets or None)
+
+        # build and write the independent products concurrently
+        with ThreadPoolExecutor(max_workers=len(products)) as executor:
+            futures = []
+            for product_type, suffix, build, template in products:
+                outfile = product_filename(parsed_args.outfile, '_'.join(suffix), directory=(product_type == 'pyramid')) if suffix else parsed_args.outfile
+                header = navexport.geocsv_header(metadata, template) if parsed_args.outfileformat == 'geocsv' else None
+
+                logging.info("Building %s dataset", product_type)
+                futures.append(executor.submit(write_pyramid_product if product_type == 'pyramid' else write_product, parsed_args, build, header, outfile))
+
+            for future in futures:
+                future.result()
 
     except KeyboardInterrupt:
         logging.warning('Interrupted')
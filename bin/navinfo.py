@@ -27,7 +27,9 @@ from os.path import dirname, realpath
 sys.path.append(dirname(dirname(realpath(__file__))))
 
 from lib.utils import read_r2rnavfile
-from lib.nav_manager import NavInfoReport
+from lib.nav_manager import NavInfoReport, NavTrackReport
+from lib.nav_ports import load_port_index, PORT_RADIUS
+from lib.nav_track import UNDERWAY_SPEED, STATION_SPEED
 
 # -------------------------------------------------------------------------------------
 # Main function
@@ -39,8 +41,13 @@ if __name__ == "__main__":
     parser.add_argument('-L', '--logfileformat', type=str, metavar='logfileformat', default="text", choices=["text","json"], help='The format of the logfile, text, json, default: text')
     parser.add_argument('--startTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='startTS', help='Crop data to start timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('--endTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='endTS', help='Crop data to end timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
-    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf"], help='The format type of input file, csv, hdf, default: csv')
-    parser.add_argument('input', type=str, help='The input r2rnav file')
+    parser.add_argument('-t', '--track', action='store_true', help='Include the track statistics: track length, time underway, on station and in port')
+    parser.add_argument('--underwayspeed', type=float, default=UNDERWAY_SPEED, metavar='underwayspeed', help='Speed in m/s at which the vessel is underway, default: %g' % UNDERWAY_SPEED)
+    parser.add_argument('--stationspeed', type=float, default=STATION_SPEED, metavar='stationspeed', help='Speed in m/s at which the vessel is on station, default: %g' % STATION_SPEED)
+    parser.add_argument('-P', '--portfile', type=str, metavar='portfile', help='Port database csv file (name, latitude, longitude) used to detect the time in port')
+    parser.add_argument('--portradius', type=float, default=PORT_RADIUS, metavar='portradius', help='Set the port radius in meters, default: %d' % PORT_RADIUS)
+    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf","archive"], help='The format type of input file, csv, hdf, archive, default: csv')
+    parser.add_argument('input', type=str, help='The input r2rnav file or partitioned r2rnav directory')
 
     parsed_args = parser.parse_args()
 
@@ -59,7 +66,7 @@ if __name__ == "__main__":
 
         # Process the files
         logging.info("Reading r2rnav file: %s", parsed_args.input)
-        data = read_r2rnavfile(parsed_args.input, parsed_args.inputformat)
+        data = read_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS)
 
         if data is None:
             logging.error("Unable to read input file")
@@ -87,6 +94,17 @@ if __name__ == "__main__":
         navinfo = NavInfoReport(parsed_args.input)
         navinfo.build_report(data)
 
+        report_text = str(navinfo)
+        report_json = navinfo.to_json()
+
+        if parsed_args.track:
+            logging.info("Compiling track statistics")
+            navtrack = NavTrackReport(parsed_args.input, underway_speed=parsed_args.underwayspeed, station_speed=parsed_args.stationspeed, port_index=load_port_index(parsed_args.portfile) if parsed_args.portfile else None, port_radius=parsed_args.portradius)
+            navtrack.build_report(data)
+
+            report_text += "\n\n" + str(navtrack)
+            report_json = {"navinfo": report_json, "track": navtrack.to_json()}
+
         if parsed_args.logfile:
             logging.info("Saving info report to %s in %s format", parsed_args.logfile, parsed_args.logfileformat)
 
@@ -94,18 +112,17 @@ if __name__ == "__main__":
                 with open(parsed_args.logfile, 'w') as log_file:
 
                     if parsed_args.logfileformat == 'json':
-                        # json_navinfo = navinfo.to_json()
-                        json.dump(navinfo.to_json(), log_file, indent=2)
+                        json.dump(report_json, log_file, indent=2)
 
                     elif parsed_args.logfileformat == 'text':
-                        log_file.write(str(navinfo))
+                        log_file.write(report_text)
 
             except IOError:
                 logging.error("Error saving info report file: %s", parsed_args.logfile)
 
         else:
             logging.info("Send navinfo to stdout in csv format")
-            print(navinfo)
+            print(report_text)
 
     except KeyboardInterrupt:
         logging.warning('Interrupted')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+'''
+        FILE:  navmonitor.py
+ DESCRIPTION:  Return rolling window quality assurance information for r2rnav
+               formatted data as it is logged.
+
+        BUGS:
+       NOTES:  The r2rnav csv data (with header) is read from the input file or
+               stdin, i.e. tail -n +1 -f r2rnav.csv | navmonitor.py -
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-20
+    REVISION:  2021-05-20
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import argparse
+import os
+import sys
+import csv
+import json
+import logging
+
+from os.path import dirname, realpath
+sys.path.append(dirname(dirname(realpath(__file__))))
+
+from lib.nav_manager import MAX_DELTA_T, MAX_SPEED, MAX_ACCEL
+from lib.nav_monitor import NavQAMonitor, WINDOW
+from lib.nav_ports import load_port_index
+
+
+def write_report(monitor, logfileformat):
+    """
+    Write the monitor report to stdout
+    """
+
+    if logfileformat == 'json':
+        print(json.dumps(monitor.to_json()), flush=True)
+
+    elif logfileformat == 'text':
+        print(monitor.report(), flush=True)
+
+
+# -------------------------------------------------------------------------------------
+# Main function
+# -------------------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Return rolling window quality assurance information for r2rnav formatted data as it is logged')
+    parser.add_argument('-v', '--verbosity', dest='verbosity', default=0, action='count', help='Increase output verbosity, default level: warning')
+    parser.add_argument('-L', '--logfileformat', type=str, metavar='logfileformat', default="text", choices=["text","json"], help='The format of the reports: text or json (one report per line), default: text')
+    parser.add_argument('-w', '--window', type=float, default=WINDOW / 60, metavar='window', help='The window length in minutes, default: %g' % (WINDOW / 60))
+    parser.add_argument('-r', '--reportinterval', type=int, default=60, metavar='reportinterval', help='Report every N fixes, default: 60')
+    parser.add_argument('-g', '--gapthreshold', type=float, default=MAX_DELTA_T,  metavar='gapthreshold', help='Set custom gap threshold in seconds')
+    parser.add_argument('-s', '--speedthreshold', type=float, default=MAX_SPEED, metavar='speedthreshold', help='Set custom speed threshold in m/s')
+    parser.add_argument('-a', '--accelerationthreshold', default=MAX_ACCEL, type=float, metavar='accelerationthreshold', help='Set custom acceleration threshold in m/s^2')
+    parser.add_argument('-e', '--epochinterval', type=float, metavar='epochinterval', help='Set the nominal epoch interval in seconds, default: median deltaT of the first fixes')
+    parser.add_argument('-P', '--portfile', type=str, metavar='portfile', help='Port database csv file (name, latitude, longitude) used for the distance from port')
+    parser.add_argument('input', type=str, help='The input r2rnav csv file, - for stdin')
+
+    parsed_args = parser.parse_args()
+
+    ############################
+    # Set up logging before we do any other argument parsing (so that we
+    # can log problems with argument parsing).
+
+    LOGGING_FORMAT = '%(asctime)-15s %(levelname)s - %(message)s'
+    logging.basicConfig(format=LOGGING_FORMAT)
+
+    LOG_LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+    parsed_args.verbosity = min(parsed_args.verbosity, max(LOG_LEVELS))
+    logging.getLogger().setLevel(LOG_LEVELS[parsed_args.verbosity])
+
+    port_index = None # pylint: disable=invalid-name
+    if parsed_args.portfile:
+        logging.info("Reading port database: %s", parsed_args.portfile)
+        port_index = load_port_index(parsed_args.portfile)
+
+    monitor = NavQAMonitor('stdin' if parsed_args.input == '-' else parsed_args.input, window=parsed_args.window * 60, delta_t_threshold=parsed_args.gapthreshold, speed_threshold=parsed_args.speedthreshold, acceleration_threshold=parsed_args.accelerationthreshold, epoch_interval=parsed_args.epochinterval, port_index=port_index)
+
+    try:
+        with (open(parsed_args.input, 'r') if parsed_args.input != '-' else sys.stdin) as input_file:
+
+            fixes = 0 # pylint: disable=invalid-name
+            for row in csv.DictReader(input_file):
+                monitor.add_fix(row)
+                fixes += 1
+
+                if fixes % parsed_args.reportinterval == 0:
+                    write_report(monitor, parsed_args.logfileformat)
+
+            if fixes % parsed_args.reportinterval != 0:
+                write_report(monitor, parsed_args.logfileformat)
+
+    except IOError:
+        logging.error("Error reading input file: %s", parsed_args.input)
+
+    except KeyboardInterrupt:
+        logging.warning('Interrupted')
+        try:
+            sys.exit(0)
+        except SystemExit:
+            os._exit(0) # pylint: disable=protected-access
@@ -21,7 +21,6 @@ import os
 import sys
 import json
 import logging
-from io import StringIO
 from datetime import datetime
 
 from os.path import dirname, realpath
@@ -30,7 +29,9 @@ sys.path.append(dirname(dirname(realpath(__file__))))
 import pandas as pd
 
 from lib.utils import build_file_list, is_valid_nav_format
-from lib.nav_manager import NavInfoReport
+from lib.nav_manager import rounding, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL
+from lib.nav_archive import write_archive
+from lib.nav_writer import write_csv, write_partitioned, open_output, ISO_DATE_FORMAT
 from parsers.nav01_parser import Nav01Parser
 from parsers.nav02_parser import Nav02Parser
 from parsers.nav03_parser import Nav03Parser
@@ -45,6 +46,19 @@ def check_nav_format(nav_format):
 
     raise argparse.ArgumentTypeError("%s is an invalid nav format" % nav_format)
 
+def check_partition(partition):
+    '''
+    Verifies a valid partition has been specified, either "day" or a number of
+    rows
+    '''
+    if partition == 'day':
+        return partition
+
+    if partition.isdigit() and int(partition) > 0:
+        return int(partition)
+
+    raise argparse.ArgumentTypeError("%s is an invalid partition, must be \"day\" or a number of rows" % partition)
+
 # -------------------------------------------------------------------------------------
 # Main function
 # -------------------------------------------------------------------------------------
@@ -55,13 +69,22 @@ if __name__ == "__main__":
     parser.add_argument('-l', '--logfile', type=str, metavar='logfile', help='Write file report to specified logfile')
     parser.add_argument('-L', '--logfileformat', type=str, default="text", choices=["text","json"], metavar='logfileformat', help='The file report format: text or json, default: text')
     parser.add_argument('-o', '--outfile', type=str, metavar='outfile', help='Write output to specified outfile')
-    parser.add_argument('-O', '--outfileformat', type=str, metavar='outfileformat', default="csv", choices=["csv","hdf"], help='The outfile format: csv or hdf, default: csv')
+    parser.add_argument('-O', '--outfileformat', type=str, metavar='outfileformat', default="csv", choices=["csv","hdf","archive"], help='The outfile format: csv, hdf or archive (compact binary), default: csv')
+    parser.add_argument('-z', '--compression', type=str, metavar='compression', choices=["gzip","zstd"], help='Compress csv output: gzip, zstd, default: determined by the outfile extension (.gz, .zst)')
+    parser.add_argument('--threads', type=int, metavar='threads', help='Number of threads used to compress the output, default: number of cpus')
+    parser.add_argument('-p', '--partition', type=check_partition, metavar='partition', help='Write csv output as a directory of shards, one per UTC day ("day") or per N rows, plus a manifest. Requires -o and csv output (-O csv)')
+    parser.add_argument('-g', '--gapthreshold', type=float, default=MAX_DELTA_T,  metavar='gapthreshold', help='Set custom gap threshold in seconds for the qc_flags column')
+    parser.add_argument('-s', '--speedthreshold', type=float, default=MAX_SPEED, metavar='speedthreshold', help='Set custom speed threshold in m/s for the qc_flags column')
+    parser.add_argument('-a', '--accelerationthreshold', default=MAX_ACCEL, type=float, metavar='accelerationthreshold', help='Set custom acceleration threshold in m/s^2 for the qc_flags column')
     parser.add_argument('--startTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='startTS', help='Crop data to start timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('--endTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='endTS', help='Crop data to end timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('input', type=str, nargs='*', help='The input files, directories and/or file globs')
 
     parsed_args = parser.parse_args()
 
+    if parsed_args.partition and parsed_args.outfileformat != 'csv':
+        parser.error("-p/--partition requires csv output (-O csv), not %s" % parsed_args.outfileformat)
+
     ############################
     # Set up logging before we do any other argument parsing (so that we
     # can log problems with argument parsing).
@@ -121,17 +144,12 @@ if __name__ == "__main__":
                 logging.warning("No usable data parsed.")
                 continue
 
-            df = pd.DataFrame(results)
-
-            # Set lines with parsing errors
-            fileReport = NavInfoReport(file)
-            fileReport.build_report(df)
-
-            nav_parser.add_file_report(fileReport)
+            # The file report is built by the parser while parsing
+            nav_parser.add_file_report(nav_parser.report)
 
             # Build DataFrame
             logging.debug("Building dataframe from parsed data...")
-            nav_parser.add_dateframe(df)
+            nav_parser.add_dateframe(pd.DataFrame(results))
 
         if parsed_args.startTS:
             logging.info("Cropping data older than %s", parsed_args.startTS.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
@@ -148,6 +166,14 @@ if __name__ == "__main__":
             logging.info("Processing data")
             nav_parser.proc_dataframe()
 
+            logging.info("Flagging data based on QC rules")
+            nav_parser.build_qc_flags(delta_t_threshold=parsed_args.gapthreshold, speed_threshold=parsed_args.speedthreshold, acceleration_threshold=parsed_args.accelerationthreshold)
+
+        # the thresholds of the qc_flags column and the time range of each
+        # logger file are saved with the data
+        metadata = {'qc_thresholds': nav_parser.qc_thresholds} if nav_parser.qc_thresholds else {}
+        metadata['source_files'] = nav_parser.source_files
+
         logging.info("NavInfo Report(s):\n%s", '\n'.join([str(report) for report in nav_parser.file_report]))
 
         if parsed_args.logfile:
@@ -169,20 +195,40 @@ if __name__ == "__main__":
         if parsed_args.outfile:
             logging.info("Saving data to %s in %s format", parsed_args.outfile, parsed_args.outfileformat)
 
-            if parsed_args.outfileformat == 'csv':
+            if parsed_args.partition:
 
                 try:
-                    with open(parsed_args.outfile, 'w') as data_file:
-                        nav_parser.dataframe.to_csv(data_file, mode='a', index=False, date_format='%Y-%m-%dT%H:%M:%S.%fZ')
+                    manifest = write_partitioned(nav_parser.dataframe, parsed_args.outfile, partition=parsed_args.partition, compression=parsed_args.compression, threads=parsed_args.threads, metadata=metadata)
+                    logging.info("Wrote %d shard(s) to %s", len(manifest['shards']), parsed_args.outfile)
 
-                except IOError:
+                except (IOError, ValueError) as err:
+                    logging.error("Error saving partitioned data to: %s", parsed_args.outfile)
+                    logging.error(str(err))
+
+            elif parsed_args.outfileformat == 'csv':
+
+                try:
+                    with open_output(parsed_args.outfile, compression=parsed_args.compression, threads=parsed_args.threads) as data_file:
+                        write_csv(nav_parser.dataframe, data_file, date_format=ISO_DATE_FORMAT)
+
+                except (IOError, ValueError) as err:
                     logging.error("Error saving data file: %s", parsed_args.outfile)
+                    logging.error(str(err))
 
             elif parsed_args.outfileformat == 'hdf':
 
                 try:
                     with pd.HDFStore(parsed_args.outfile) as data_file:
                         data_file.put(key="nav_data", value=nav_parser.dataframe, format='table', data_columns=True)
+                        data_file.get_storer("nav_data").attrs.metadata = metadata
+
+                except IOError:
+                    logging.error("Error saving data file: %s", parsed_args.outfile)
+
+            elif parsed_args.outfileformat == 'archive':
+
+                try:
+                    write_archive(nav_parser.dataframe, parsed_args.outfile, precision=rounding, metadata=metadata)
 
                 except IOError:
                     logging.error("Error saving data file: %s", parsed_args.outfile)
@@ -190,11 +236,17 @@ if __name__ == "__main__":
 
         else:
 
+            if parsed_args.partition:
+                logging.warning("Partitioned output requires an outfile (-o), sending data to stdout")
+
             logging.info("Send data to stdout in csv format")
-            output = StringIO()
-            nav_parser.dataframe.to_csv(output, index=False, date_format='%Y-%m-%dT%H:%M:%S.%fZ')
-            output.seek(0)
-            print(output.read())
+
+            try:
+                with open_output(compression=parsed_args.compression, threads=parsed_args.threads) as data_file:
+                    write_csv(nav_parser.dataframe, data_file, date_format=ISO_DATE_FORMAT)
+
+            except ValueError as err:
+                logging.error(str(err))
 
     except KeyboardInterrupt:
         logging.warning('Interrupted')
@@ -23,11 +23,105 @@ import json
 import logging
 from datetime import datetime
 
+import numpy as np
+
 from os.path import dirname, realpath
 sys.path.append(dirname(dirname(realpath(__file__))))
 
-from lib.utils import read_r2rnavfile
-from lib.nav_manager import NavQAReport, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL
+from lib.utils import read_r2rnavfile, iter_r2rnavfile, SOURCE_FILE_COL
+from lib.nav_manager import NavInfoReport, NavQAReport, NavQABreakdown, NavQASweep, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL, PERCENTILES, HISTOGRAM_BINS
+from lib.nav_stats import scan_nav_data, scan_nav_groups, sweep_nav_data, merge_sweeps, day_keys, source_keys, stream_epoch_interval, NavQAAccumulator
+from lib.nav_ports import load_port_index, PORT_RADIUS
+
+
+def threshold_list(value):
+    """
+    Parse a list of thresholds, either comma separated values or a
+    start:stop:step range (stop included)
+    """
+
+    try:
+        if ':' in value:
+            start, stop, step = [float(part) for part in value.split(':')]
+            if step <= 0:
+                raise ValueError
+            return [round(threshold, 10) for threshold in np.arange(start, stop + step / 2, step)]
+
+        return sorted(float(threshold) for threshold in value.split(','))
+
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError("%s is not a comma separated list or start:stop:step range" % value) from exc
+
+
+def write_report(parsed_args, report_text, report_json, report_xml=None):
+    """
+    Write the report to the logfile or stdout in the requested format,
+    report_xml is a callable returning the xml report
+    """
+
+    if parsed_args.logfile:
+        logging.info("Saving qa report to %s in %s format", parsed_args.logfile, parsed_args.logfileformat)
+
+        try:
+            with open(parsed_args.logfile, 'w') as log_file:
+
+                if parsed_args.logfileformat == 'text':
+                    log_file.write(report_text)
+
+                elif parsed_args.logfileformat == 'json':
+                    json.dump(report_json, log_file, indent=2)
+
+                elif parsed_args.logfileformat == 'xml':
+                    log_file.write(report_xml())
+
+        except IOError:
+            logging.error("Error saving qa report file: %s", parsed_args.logfile)
+
+    else:
+        logging.info("Send navqa to stdout in %s format", parsed_args.logfileformat)
+
+        if parsed_args.logfileformat == 'text':
+            print(report_text)
+
+        elif parsed_args.logfileformat == 'json':
+            print(json.dumps(report_json, indent=2))
+
+        elif parsed_args.logfileformat == 'xml':
+            print(report_xml())
+
+
+def group_keys(data, group_by):
+    """
+    Return the breakdown group of each row: the UTC day or the source file,
+    the logger file if the data records them (see source_keys) else the
+    file or shard the row was read from
+    """
+
+    if group_by == 'day':
+        return day_keys(data)
+
+    keys = source_keys(data)
+    return keys if keys is not None else data[SOURCE_FILE_COL].to_numpy()
+
+
+def crop_data(data, start_ts=None, end_ts=None):
+    """
+    Crop the data to the start/end timestamps
+    """
+
+    try:
+        if start_ts:
+            data = data[(data['iso_time'] >= start_ts)]
+
+        if end_ts:
+            data = data[(data['iso_time'] <= end_ts)]
+
+    except Exception as err:
+        logging.error("Error cropping data")
+        logging.error(str(err))
+        raise err
+
+    return data
 
 # -------------------------------------------------------------------------------------
 # Main function
@@ -36,14 +130,27 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Return quality assurance information based on r2rnav formatted file')
     parser.add_argument('-v', '--verbosity', dest='verbosity', default=0, action='count', help='Increase output verbosity, default level: warning')
     parser.add_argument('-l', '--logfile', type=str, metavar='logfile', help='Write output to specified logfile')
-    parser.add_argument('-L', '--logfileformat', type=str, metavar='logfileformat', default="text", choices=["text","json"], help='The format of the logfile: text, json default: text')
+    parser.add_argument('-L', '--logfileformat', type=str, metavar='logfileformat', default="text", choices=["text","json","xml"], help='The format of the logfile: text, json or xml, default: text')
     parser.add_argument('--startTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='startTS', help='Crop data to start timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('--endTS', type=lambda d: datetime.strptime(d, '%Y-%m-%dT%H:%M:%S.%fZ'), metavar='endTS', help='Crop data to end timestamp, format: YYYY-mm-ddTHH:MM:SS.sssZ')
     parser.add_argument('-g', '--gapthreshold', type=float, default=MAX_DELTA_T,  metavar='gapthreshold', help='Set custom gap threshold in seconds')
     parser.add_argument('-s', '--speedthreshold', type=float, default=MAX_SPEED, metavar='speedthreshold', help='Set custom speed threshold in m/s')
     parser.add_argument('-a', '--accelerationthreshold', default=MAX_ACCEL, type=float, metavar='accelerationthreshold', help='Set custom acceleration threshold in m/s^2')
-    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf"], help='The format type of input file: csv, hdf, default: csv')
-    parser.add_argument('input', type=str, help='The input r2rnav file')
+    parser.add_argument('--gapsweep', type=threshold_list, metavar='thresholds', help='Sweep mode, report the gap errors for each threshold in seconds, comma separated list or start:stop:step')
+    parser.add_argument('--speedsweep', type=threshold_list, metavar='thresholds', help='Sweep mode, report the speed errors for each threshold in m/s, comma separated list or start:stop:step')
+    parser.add_argument('--accelerationsweep', type=threshold_list, metavar='thresholds', help='Sweep mode, report the acceleration errors for each threshold in m/s^2, comma separated list or start:stop:step')
+    parser.add_argument('--percentiles', type=threshold_list, default=PERCENTILES, metavar='percentiles', help='The percentiles reported for the distributions, comma separated list or start:stop:step, default: %s' % ','.join('%g' % percentile for percentile in PERCENTILES))
+    parser.add_argument('--histogrambins', type=int, default=HISTOGRAM_BINS, metavar='histogrambins', help='The number of histogram bins reported for the distributions (json), default: %d' % HISTOGRAM_BINS)
+    parser.add_argument('-e', '--epochinterval', type=float, metavar='epochinterval', help='Set the nominal epoch interval in seconds, default: median deltaT (found in an extra pass over the input with -c)')
+    parser.add_argument('-P', '--portfile', type=str, metavar='portfile', help='Port database csv file (name, latitude, longitude) used for the distance from port')
+    parser.add_argument('--portcalls', action='store_true', help='List the port calls, consecutive fixes within the port radius of a port. Requires -P')
+    parser.add_argument('--portradius', type=float, default=PORT_RADIUS, metavar='portradius', help='Set the port radius in meters, default: %d' % PORT_RADIUS)
+    parser.add_argument('-b', '--breakdown', type=str, action='append', metavar='breakdown', choices=['day','file'], help='Add a breakdown of the QA metrics per UTC day or per source file (the logger files recorded by navparse in a partition, archive or hdf file, else the input file or shard), may be repeated')
+    parser.add_argument('--workers', type=int, metavar='workers', help='Number of processes used to compute the breakdown, default: 1')
+    parser.add_argument('-c', '--chunksize', type=int, metavar='chunksize', help='Stream the input in chunks of this many rows instead of loading it into memory')
+    parser.add_argument('-i', '--info', action='store_true', help='Include the navinfo report, both reports are built from a single pass over the data')
+    parser.add_argument('-I', '--inputformat', type=str, metavar='inputformat', default="csv", choices=["csv","hdf","archive"], help='The format type of input file: csv, hdf, archive, default: csv')
+    parser.add_argument('input', type=str, help='The input r2rnav file or partitioned r2rnav directory')
 
     parsed_args = parser.parse_args()
 
@@ -60,66 +167,158 @@ if __name__ == "__main__":
 
     try:
 
-        # Process the files
-        logging.info("Reading r2rnav file: %s", parsed_args.input)
-        data = read_r2rnavfile(parsed_args.input, parsed_args.inputformat)
+        if parsed_args.startTS:
+            logging.info("Cropping data older than: %s", parsed_args.startTS)
 
-        if data is None:
-            logging.error("Unable to read input file")
-            sys.exit(0)
+        if parsed_args.endTS:
+            logging.info("Cropping data newer than: %s", parsed_args.endTS)
 
-        try:
-            if parsed_args.startTS:
-                logging.info("Cropping data older than: %s", parsed_args.startTS)
-                data = data[(data['iso_time'] >= parsed_args.startTS)]
+        port_index = None
+        if parsed_args.portfile:
+            logging.info("Reading port database: %s", parsed_args.portfile)
+            try:
+                port_index = load_port_index(parsed_args.portfile)
+            except (IOError, ValueError) as err:
+                logging.error("Unable to read port database: %s", parsed_args.portfile)
+                logging.error(str(err))
+                sys.exit(1)
+
+        elif parsed_args.portcalls:
+            logging.error("A port database (-P) is required to list port calls")
+            sys.exit(1)
+
+        navqa = NavQAReport(parsed_args.input, delta_t_threshold=parsed_args.gapthreshold, speed_threshold=parsed_args.speedthreshold, acceleration_threshold=parsed_args.accelerationthreshold, port_index=port_index, percentiles=parsed_args.percentiles, histogram_bins=parsed_args.histogrambins)
+
+        # Sweep mode
+        if parsed_args.gapsweep or parsed_args.speedsweep or parsed_args.accelerationsweep:
+
+            if parsed_args.logfileformat == 'xml':
+                logging.error("The threshold sweep can not be written in xml format")
+                sys.exit(1)
 
-            if parsed_args.endTS:
-                logging.info("Cropping data newer than: %s", parsed_args.endTS)
-                data = data[(data['iso_time'] <= parsed_args.endTS)]
+            sweep_thresholds = {'delta_t_thresholds': parsed_args.gapsweep, 'speed_thresholds': parsed_args.speedsweep, 'acceleration_thresholds': parsed_args.accelerationsweep}
 
-        except Exception as err:
-            logging.error("Error cropping data")
-            logging.error(str(err))
-            raise err
+            if parsed_args.chunksize:
+                logging.info("Streaming r2rnav file: %s in chunks of %d rows", parsed_args.input, parsed_args.chunksize)
 
-        if (parsed_args.startTS or parsed_args.endTS) and data.shape[0] == 0:
-            logging.warning("Data is empty after cropping for start/end timestamps")
+                sweep = None
+                for chunk in iter_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS, chunk_size=parsed_args.chunksize):
+                    sweep = merge_sweeps(sweep, sweep_nav_data(crop_data(chunk, parsed_args.startTS, parsed_args.endTS), **sweep_thresholds))
+
+            else:
+                logging.info("Reading r2rnav file: %s", parsed_args.input)
+                data = read_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS)
+                sweep = sweep_nav_data(crop_data(data, parsed_args.startTS, parsed_args.endTS), **sweep_thresholds) if data is not None else None
+
+            if sweep is None or sweep['total_lines'] == 0:
+                logging.warning("No data read from input file")
+                sys.exit(0)
+
+            logging.info("Compiling threshold sweep")
+            navsweep = NavQASweep(parsed_args.input, sweep)
+            write_report(parsed_args, str(navsweep), navsweep.to_json())
             sys.exit(0)
 
-        logging.info("Compiling nav info")
+        thresholds = {'delta_t_threshold': parsed_args.gapthreshold, 'speed_threshold': parsed_args.speedthreshold, 'acceleration_threshold': parsed_args.accelerationthreshold}
+        breakdowns = {group_by: {} for group_by in parsed_args.breakdown or []}
 
-        navqa = NavQAReport(parsed_args.input, delta_t_threshold=parsed_args.gapthreshold, speed_threshold=parsed_args.speedthreshold, acceleration_threshold=parsed_args.accelerationthreshold)
-        navqa.build_report(data)
+        # Process the files
+        if parsed_args.chunksize:
+            logging.info("Streaming r2rnav file: %s in chunks of %d rows", parsed_args.input, parsed_args.chunksize)
 
-        if parsed_args.logfile:
-            logging.info("Saving qa report to %s in %s format", parsed_args.logfile, parsed_args.logfileformat)
+            epoch_interval = parsed_args.epochinterval
+            accumulator = None
 
-            try:
-                with open(parsed_args.logfile, 'w') as log_file:
+            # the epoch interval is the median deltaT of all the data, as when
+            # the data is loaded into memory, found in a first pass
+            if epoch_interval is None:
+                epoch_interval = stream_epoch_interval(crop_data(chunk, parsed_args.startTS, parsed_args.endTS) for chunk in iter_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS, chunk_size=parsed_args.chunksize, columns=['iso_time', 'deltaT']))
+                logging.info("Using epoch interval: %s seconds", epoch_interval)
+
+            for chunk in iter_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS, chunk_size=parsed_args.chunksize, source='file' in breakdowns):
+                chunk = crop_data(chunk, parsed_args.startTS, parsed_args.endTS)
+
+                if chunk.shape[0] == 0:
+                    continue
 
-                    if parsed_args.logfileformat == 'text':
-                        log_file.write(str(navqa))
+                if accumulator is None:
+                    accumulator = NavQAAccumulator(**thresholds, epoch_interval=epoch_interval)
 
-                    elif parsed_args.logfileformat == 'json':
-                        json.dump(navqa.to_json(), log_file, indent=2)
+                if breakdowns:
+                    for group_by, groups in breakdowns.items():
+                        chunk_total, chunk_groups = scan_nav_groups(chunk, group_keys(chunk, group_by), **thresholds, epoch_interval=epoch_interval)
+                        for key, group in chunk_groups.items():
+                            groups.setdefault(key, NavQAAccumulator(**thresholds, epoch_interval=epoch_interval)).merge(group)
 
-                    elif parsed_args.logfileformat == 'xml':
-                        log_file.write(navqa.to_xml())
+                    accumulator.merge(chunk_total)
 
-            except IOError:
-                logging.error("Error saving qa report file: %s", parsed_args.logfile)
+                else:
+                    accumulator.update(chunk)
+
+                if parsed_args.portcalls:
+                    navqa.find_port_calls(chunk, parsed_args.portradius)
+
+            if accumulator is None or accumulator.total_lines == 0:
+                logging.warning("No data read from input file")
+                sys.exit(0)
+
+            stats = accumulator.stats
 
         else:
-            logging.info("Send navqa to stdout in %s format", parsed_args.logfileformat)
+            logging.info("Reading r2rnav file: %s", parsed_args.input)
+            data = read_r2rnavfile(parsed_args.input, parsed_args.inputformat, start_ts=parsed_args.startTS, end_ts=parsed_args.endTS, source='file' in breakdowns)
+
+            if data is None:
+                logging.error("Unable to read input file")
+                sys.exit(0)
+
+            data = crop_data(data, parsed_args.startTS, parsed_args.endTS)
+
+            if (parsed_args.startTS or parsed_args.endTS) and data.shape[0] == 0:
+                logging.warning("Data is empty after cropping for start/end timestamps")
+                sys.exit(0)
+
+            logging.info("Compiling nav qa")
+
+            if breakdowns:
+                for group_by in breakdowns:
+                    logging.info("Compiling nav qa breakdown by %s", group_by)
+                    total, breakdowns[group_by] = scan_nav_groups(data, group_keys(data, group_by), **thresholds, epoch_interval=parsed_args.epochinterval, workers=parsed_args.workers)
+
+                # the cruise total is rolled up from the groups
+                stats = total.stats
+
+            else:
+                stats = scan_nav_data(data, **thresholds, epoch_interval=parsed_args.epochinterval)
+
+            if parsed_args.portcalls:
+                logging.info("Finding port calls")
+                navqa.find_port_calls(data, parsed_args.portradius)
+
+        navqa.load_stats(stats)
+
+        report_text = str(navqa)
+        report_json = navqa.to_json()
+
+        for group_by, groups in breakdowns.items():
+            reports = {}
+            for key, group in groups.items():
+                reports[key] = NavQAReport(parsed_args.input, delta_t_threshold=parsed_args.gapthreshold, speed_threshold=parsed_args.speedthreshold, acceleration_threshold=parsed_args.accelerationthreshold, percentiles=parsed_args.percentiles, histogram_bins=parsed_args.histogrambins)
+                reports[key].load_stats(group.stats)
+
+            breakdown = NavQABreakdown(group_by, reports)
+            report_text += "\n" + str(breakdown)
+            report_json.setdefault("breakdown", {})[group_by] = breakdown.to_json()
 
-            if parsed_args.logfileformat == 'text':
-                print(navqa)
+        if parsed_args.info:
+            logging.info("Compiling nav info")
+            navinfo = NavInfoReport(parsed_args.input)
+            navinfo.load_stats(stats)
 
-            elif parsed_args.logfileformat == 'json':
-                print(json.dumps(navqa.to_json(), indent=2))
+            report_text = str(navinfo) + "\n\n" + report_text
+            report_json = {"navinfo": navinfo.to_json(), "navqa": report_json}
 
-            elif parsed_args.logfileformat == 'xml':
-                print(navqa.to_xml())
+        write_report(parsed_args, report_text, report_json, navqa.to_xml if parsed_args.logfileformat == 'xml' else None)
 
     except KeyboardInterrupt:
         logging.warning('Interrupted')
@@ -54,6 +54,27 @@ onemin_header = {
     'creation_date': '',
 }
 
+decimated_header = {
+    'dataset': 'GeoCSV 2.0',
+    'title': 'Processed Trackline Navigation Data: Decimated',
+    'field_unit': 'ISO_8601,degree_east,degree_north,meter/second,degree',
+    'field_type': 'datetime,float,float,float,float',
+    'field_standard_name': 'iso_time,ship_longitude,ship_latitude,speed_made_good,course_made_good',
+    'field_long_name': 'date and time,longitude of vessel,latitude of vessel,speed made good,course made good',
+    'standard_name_cv': 'http://www.rvdata.us/voc/fieldname',
+    'ellipsoid': 'WGS-84 (EPSG:4326)',
+    'delimiter': ',',
+    'field_missing': 'NAN',
+    'attribution': 'Rolling Deck to Repository (R2R) Program; http://www.rvdata.us/',
+    'source_repository': 'doi:10.17616/R39C8D',
+    'source_event': 'doi:10.7284/908273',
+    'source_dataset': 'doi:10.7284/133064',
+    'decimation_interval': '',
+    'decimation_rule': '',
+    'cruise_id': '',
+    'creation_date': '',
+}
+
 control_header = {
     'dataset': 'GeoCSV 2.0',
     'title': 'Processed Trackline Navigation Data: Control Points',
@@ -72,3 +93,6 @@ control_header = {
     'cruise_id': '',
     'creation_date': '',
 }
+
+# the pyramid levels have the control point columns
+pyramid_header = dict(control_header, title='Processed Trackline Navigation Data: Track Pyramid')
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_archive.py
+ DESCRIPTION:  Compact binary archive format for r2rnav data.
+
+        BUGS:
+       NOTES:  File layout:
+                 MAGIC
+                 block 0 .. block N
+                 index (json)
+                 footer: index offset (uint64), index length (uint64), MAGIC
+
+               Each block holds up to BLOCK_ROWS rows.  A block starts with
+               the number of columns (uint32) and the byte length of each
+               column segment (uint64), followed by the segments.  A column
+               segment is the bit-packed null mask followed by the encoded
+               non-null values:
+                 time:      delta-of-delta zigzag varints (int64 ns)
+                 timedelta: delta zigzag varints (int64 ns)
+                 scaled:    value * 10^decimals as delta zigzag varints
+                 flag:      bit-packed 0/1 values
+                 int:       zigzag varints (integer or whole number float
+                            columns)
+                 float:     raw little-endian float64
+               The index lists the columns and the offset, length, row count
+               and time bounds of every block so blocks can be read
+               individually.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-16
+    REVISION:  2021-05-16
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import json
+import struct
+import logging
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'R2RNAVA1'
+
+BLOCK_ROWS = 65536
+
+FLAG_COLS = ['valid_cksum', 'valid_parse', 'valid_order']
+
+ISO_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _zigzag_encode(values):
+    """
+    Map signed int64 values to unsigned values with small magnitudes
+    """
+
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def _zigzag_decode(values):
+    """
+    Inverse of _zigzag_encode
+    """
+
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def _varint_encode(values):
+    """
+    Encode uint64 values as LEB128 varints
+    """
+
+    values = values.astype(np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        nbytes += values >= (np.uint64(1) << np.uint64(shift))
+
+    ends = np.cumsum(nbytes)
+    starts = ends - nbytes
+    output = np.empty(int(ends[-1]) if len(ends) > 0 else 0, dtype=np.uint8)
+
+    for position in range(int(nbytes.max()) if len(nbytes) > 0 else 0):
+        selected = nbytes > position
+        byte = (values[selected] >> np.uint64(7 * position)) & np.uint64(0x7f)
+        more = (nbytes[selected] > position + 1).astype(np.uint64) << np.uint64(7)
+        output[starts[selected] + position] = (byte | more).astype(np.uint8)
+
+    return output.tobytes()
+
+
+def _varint_decode(buffer):
+    """
+    Decode LEB128 varints into uint64 values
+    """
+
+    data = np.frombuffer(buffer, dtype=np.uint8)
+
+    if len(data) == 0:
+        return np.array([], dtype=np.uint64)
+
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+
+    # the first byte of every varint, then the following bytes of the
+    # varints that are long enough (most values are 1-3 bytes)
+    values = (data[starts] & 0x7f).astype(np.uint64)
+
+    selected = np.flatnonzero(lengths > 1)
+    position = 1
+
+    while selected.size > 0:
+        values[selected] |= (data[starts[selected] + position] & 0x7f).astype(np.uint64) << np.uint64(7 * position)
+        position += 1
+        selected = selected[lengths[selected] > position]
+
+    return values
+
+
+def _column_kind(name, series, precision):
+    """
+    Return the encoding used for the column
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return 'time'
+
+    if pd.api.types.is_timedelta64_dtype(series.dtype):
+        return 'timedelta'
+
+    if name in precision:
+        return 'scaled'
+
+    if name in FLAG_COLS:
+        return 'flag'
+
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return 'int'
+
+    # float columns holding whole numbers (i.e. nsv with missing values)
+    values = series.to_numpy(dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if (np.abs(values) < 2**53).all() and (np.rint(values) == values).all():
+        return 'int'
+
+    return 'float'
+
+
+def _column_values(series, kind):
+    """
+    Return the null mask and non-null values of the series as int64/float64
+    """
+
+    if kind == 'time':
+        if series.dt.tz is not None:
+            series = series.dt.tz_convert(None)
+        values = series.to_numpy(dtype='datetime64[ns]')
+        nulls = np.isnat(values)
+        return nulls, values[~nulls].view(np.int64)
+
+    if kind == 'timedelta':
+        values = series.to_numpy(dtype='timedelta64[ns]')
+        nulls = np.isnat(values)
+        return nulls, values[~nulls].view(np.int64)
+
+    values = series.to_numpy(dtype=np.float64)
+    nulls = np.isnan(values)
+    return nulls, values[~nulls]
+
+
+def _encode_segment(series, column):
+    """
+    Encode one column of a block
+    """
+
+    kind = column['kind']
+    nulls, values = _column_values(series, kind)
+
+    if kind == 'time':
+        payload = _varint_encode(_zigzag_encode(np.diff(np.diff(values, prepend=0), prepend=0)))
+
+    elif kind == 'timedelta':
+        payload = _varint_encode(_zigzag_encode(np.diff(values, prepend=0)))
+
+    elif kind == 'scaled':
+        scaled = np.rint(values * 10**column['decimals']).astype(np.int64)
+        payload = _varint_encode(_zigzag_encode(np.diff(scaled, prepend=0)))
+
+    elif kind == 'flag':
+        payload = np.packbits(values != 0).tobytes()
+
+    elif kind == 'int':
+        payload = _varint_encode(_zigzag_encode(values.astype(np.int64)))
+
+    else:
+        payload = values.astype('<f8').tobytes()
+
+    return np.packbits(nulls).tobytes() + payload
+
+
+def _column_dtype(column):
+    """
+    Return the numpy dtype of the decoded column
+    """
+
+    if column['kind'] == 'time':
+        return np.dtype('datetime64[ns]')
+
+    if column['kind'] == 'timedelta':
+        return np.dtype('timedelta64[ns]')
+
+    return np.dtype(column['dtype'])
+
+
+def _decode_segment(segment, rows, column, out=None):
+    """
+    Decode one column of a block into a numpy array, or into out (an array
+    of rows values of the column dtype) if specified
+    """
+
+    kind = column['kind']
+    mask_length = (rows + 7) // 8
+    nulls = np.unpackbits(np.frombuffer(segment[:mask_length], dtype=np.uint8), count=rows).astype(bool)
+    payload = segment[mask_length:]
+    count = rows - int(nulls.sum())
+
+    if kind in ('time', 'timedelta'):
+        values = _zigzag_decode(_varint_decode(payload)).cumsum()
+        if kind == 'time':
+            values = values.cumsum()
+
+        output = out if out is not None else np.empty(rows, dtype=_column_dtype(column))
+        if count == rows:
+            output.view(np.int64)[:] = values
+        else:
+            output[:] = np.datetime64('NaT') if kind == 'time' else np.timedelta64('NaT')
+            output.view(np.int64)[~nulls] = values
+
+    else:
+        if kind == 'scaled':
+            values = np.cumsum(_zigzag_decode(_varint_decode(payload))) / 10**column['decimals']
+        elif kind == 'flag':
+            values = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=count).astype(np.float64)
+        elif kind == 'int':
+            values = _zigzag_decode(_varint_decode(payload)).astype(np.float64)
+        else:
+            values = np.frombuffer(payload, dtype='<f8')
+
+        if count == rows and column['dtype'] != 'float64':
+            values = values.astype(column['dtype'])
+
+        if out is not None and count == rows:
+            out[:] = values
+            return out
+
+        if count == rows:
+            return values
+
+        output = out if out is not None else np.empty(rows)
+        output[:] = np.nan
+        output[~nulls] = values
+
+    return output
+
+
+def _encode_block(data_frame, columns):
+    """
+    Encode a block of rows
+    """
+
+    segments = [_encode_segment(data_frame[column['name']], column) for column in columns]
+    header = struct.pack('<I', len(segments)) + struct.pack('<{}Q'.format(len(segments)), *[len(segment) for segment in segments])
+    return header + b''.join(segments)
+
+
+def _decode_block(block, rows, columns, names=None, out=None):
+    """
+    Decode a block of rows into a dict of column: numpy array, or into out
+    (a dict of column: array of rows values) if specified
+    """
+
+    ncols = struct.unpack_from('<I', block, 0)[0]
+    lengths = struct.unpack_from('<{}Q'.format(ncols), block, 4)
+    offset = 4 + 8 * ncols
+
+    data = {}
+    for column, length in zip(columns, lengths):
+        if names is None or column['name'] in names:
+            data[column['name']] = _decode_segment(block[offset:offset + length], rows, column, out[column['name']] if out is not None else None)
+        offset += length
+
+    return data
+
+
+def _time_bounds(series):
+    """
+    Return the min/max of the series formatted as ISO8601 strings
+    """
+
+    if not series.notna().any():
+        return None, None
+
+    return series.min().strftime(ISO_DATE_FORMAT), series.max().strftime(ISO_DATE_FORMAT)
+
+
+def write_archive(data_frame, filename, precision=None, block_rows=BLOCK_ROWS, metadata=None):
+    """
+    Write the r2rnav data_frame to filename in the compact archive format.
+    Columns in precision (i.e. the rounding table) are stored as scaled
+    integers and are lossless to that number of decimals.  metadata (a json
+    serializable dict) is saved in the index.
+    """
+
+    precision = precision or {}
+
+    columns = []
+    for name in data_frame.columns:
+        kind = _column_kind(name, data_frame[name], precision)
+        columns.append({
+            'name': str(name),
+            'kind': kind,
+            'dtype': str(data_frame[name].dtype) if kind not in ('time', 'timedelta') else kind,
+            'decimals': precision.get(name)
+        })
+
+    blocks = []
+    with open(filename, 'wb') as archive_file:
+        archive_file.write(MAGIC)
+        offset = len(MAGIC)
+
+        for start in range(0, len(data_frame.index), block_rows):
+            chunk = data_frame.iloc[start:start + block_rows]
+            block = _encode_block(chunk, columns)
+            start_ts, end_ts = _time_bounds(chunk['iso_time']) if 'iso_time' in chunk else (None, None)
+
+            archive_file.write(block)
+            blocks.append({'offset': offset, 'length': len(block), 'rows': len(chunk.index), 'startTS': start_ts, 'endTS': end_ts})
+            offset += len(block)
+
+        index = json.dumps({'columns': columns, 'blocks': blocks, 'metadata': metadata or {}}).encode('utf-8')
+        archive_file.write(index)
+        archive_file.write(struct.pack('<QQ', offset, len(index)) + MAGIC)
+
+    logging.debug("Wrote %d rows in %d blocks to %s", len(data_frame.index), len(blocks), filename)
+
+
+def read_archive_index(archive_file):
+    """
+    Read the index of the open archive file
+    """
+
+    archive_file.seek(-(16 + len(MAGIC)), 2)
+    footer = archive_file.read(16 + len(MAGIC))
+
+    if footer[16:] != MAGIC:
+        raise ValueError("Not a r2rnav archive file")
+
+    offset, length = struct.unpack('<QQ', footer[:16])
+    archive_file.seek(offset)
+
+    return json.loads(archive_file.read(length).decode('utf-8'))
+
+
+def _select_blocks(index, start_ts=None, end_ts=None):
+    """
+    Return the blocks of the archive index overlapping the start_ts/end_ts
+    window
+    """
+
+    start_ts = pd.Timestamp(start_ts).tz_localize(None) if start_ts is not None else None
+    end_ts = pd.Timestamp(end_ts).tz_localize(None) if end_ts is not None else None
+
+    blocks = []
+    for block in index['blocks']:
+
+        if block['startTS'] is not None:
+            if end_ts is not None and pd.Timestamp(block['startTS']).tz_localize(None) > end_ts:
+                continue
+            if start_ts is not None and pd.Timestamp(block['endTS']).tz_localize(None) < start_ts:
+                continue
+
+        blocks.append(block)
+
+    return blocks
+
+
+def _iter_blocks(filename, start_ts=None, end_ts=None, columns=None):
+    """
+    Yield the column names and the decoded columns (dict of column: numpy
+    array) of each block overlapping the start_ts/end_ts window.
+    """
+
+    with open(filename, 'rb') as archive_file:
+        index = read_archive_index(archive_file)
+        names = [column['name'] for column in index['columns'] if columns is None or column['name'] in columns]
+
+        for block in _select_blocks(index, start_ts, end_ts):
+            archive_file.seek(block['offset'])
+            yield names, _decode_block(archive_file.read(block['length']), block['rows'], index['columns'], names)
+
+
+def iter_archive(filename, start_ts=None, end_ts=None, columns=None):
+    """
+    Yield the blocks of the archive overlapping the start_ts/end_ts window as
+    DataFrames (rows are not cropped).  columns limits the columns that are
+    decoded.
+    """
+
+    for names, decoded in _iter_blocks(filename, start_ts, end_ts, columns):
+        yield pd.DataFrame(decoded, columns=names)
+
+
+def read_archive(filename, start_ts=None, end_ts=None, columns=None):
+    """
+    Read the archive into a DataFrame.  Only the blocks overlapping the
+    start_ts/end_ts window are decoded (rows are not cropped).  columns limits
+    the columns that are decoded.  The columns are allocated from the row
+    counts of the index and each block is decoded in place.
+    """
+
+    with open(filename, 'rb') as archive_file:
+        index = read_archive_index(archive_file)
+        selected = [column for column in index['columns'] if columns is None or column['name'] in columns]
+        names = [column['name'] for column in selected]
+        blocks = _select_blocks(index, start_ts, end_ts)
+
+        if not blocks:
+            return pd.DataFrame({name: np.array([]) for name in names}, columns=names)
+
+        data = {column['name']: np.empty(sum(block['rows'] for block in blocks), dtype=_column_dtype(column)) for column in selected}
+
+        start = 0
+        for block in blocks:
+            archive_file.seek(block['offset'])
+            _decode_block(archive_file.read(block['length']), block['rows'], index['columns'], names, {name: values[start:start + block['rows']] for name, values in data.items()})
+            start += block['rows']
+
+    return pd.DataFrame(data, columns=names, copy=False)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_decimate.py
+ DESCRIPTION:  Decimation engine used to build the decimated navexport
+               products, i.e. 1 second, 10 second, 5 minute or every N
+               meters.
+
+        BUGS:
+       NOTES:  The fixes are assigned to bins of a fixed interval of time
+               (from the int64 timestamps), distance along the track
+               (cumulative great circle distance) or number of fixes.  The
+               bins are the runs of equal bin numbers in the time sorted
+               arrays so empty bins are never allocated.  Each bin produces
+               one fix: the first fix, the fix nearest to the center of the
+               bin or the mean of the fixes.  The speed and course are
+               calculated from the decimated fixes.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-22
+    REVISION:  2021-05-22
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import re
+import logging
+
+import numpy as np
+import pandas as pd
+
+from lib.nav_stats import NAT_INT, time_column, float_column
+from lib.utils import calculate_bearings, great_circle_distances
+
+DECIMATION_RULES = ['first', 'center', 'mean']
+
+DECIMATED_COLS = ['iso_time','ship_longitude','ship_latitude','speed_made_good','course_made_good']
+
+# unit: (interval type, multiplier to seconds/meters/fixes)
+INTERVAL_UNITS = {
+    's': ('time', 1),
+    'min': ('time', 60),
+    'h': ('time', 3600),
+    'm': ('distance', 1),
+    'km': ('distance', 1000),
+    'nm': ('distance', 1852),
+    'pts': ('points', 1)
+}
+
+INTERVAL_REGEX = re.compile(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([a-z]+)\s*$')
+
+
+def parse_interval(spec):
+    """
+    Parse the interval spec, a number followed by a unit: s, min, h (time),
+    m, km, nm (distance along the track) or pts (number of fixes).  Returns
+    the interval type ('time', 'distance' or 'points') and the interval in
+    seconds, meters or fixes.
+    """
+
+    match = INTERVAL_REGEX.match(spec.lower())
+
+    if not match or match.group(2) not in INTERVAL_UNITS:
+        raise ValueError("Invalid interval: {}, must be a number followed by one of: {}".format(spec, ', '.join(INTERVAL_UNITS)))
+
+    interval_type, multiplier = INTERVAL_UNITS[match.group(2)]
+    interval = float(match.group(1)) * multiplier
+
+    if interval <= 0 or (interval_type == 'points' and not interval.is_integer()):
+        raise ValueError("Invalid interval: {}, must be a positive (whole number of fixes) interval".format(spec))
+
+    return interval_type, interval
+
+
+def _bins(interval_type, interval, iso_time, latitude, longitude):
+    """
+    Return the bin number of each fix and the offset of each fix from the
+    center of its bin
+    """
+
+    if interval_type == 'time':
+        interval_ns = int(round(interval * 10**9))
+        keys = iso_time // interval_ns
+        return keys, np.abs(2 * (iso_time - keys * interval_ns) - interval_ns)
+
+    if interval_type == 'distance':
+        position = np.zeros(iso_time.size)
+        if iso_time.size > 1:
+            position[1:] = np.cumsum(great_circle_distances(latitude, longitude)) * 1000
+    else:
+        position = np.arange(iso_time.size, dtype=np.float64)
+
+    keys = np.floor(position / interval).astype(np.int64)
+    center = (keys + 0.5) * interval if interval_type == 'distance' else keys * interval + (interval - 1) / 2
+
+    return keys, np.abs(position - center)
+
+
+def _nearest(starts, counts, offsets):
+    """
+    Return the index of the first fix of each bin with the smallest offset
+    from the center of the bin
+    """
+
+    nearest = np.flatnonzero(offsets == np.repeat(np.minimum.reduceat(offsets, starts), counts))
+    bins = np.repeat(np.arange(starts.size), counts)[nearest]
+
+    return nearest[np.flatnonzero(np.diff(bins, prepend=-1) != 0)]
+
+
+def _bin_means(starts, counts, iso_time, longitude, latitude):
+    """
+    Return the mean time, longitude and latitude of the fixes in each bin.
+    The longitudes are averaged relative to the first fix of the bin so bins
+    crossing the antimeridian are not averaged to the wrong side of the globe.
+    """
+
+    relative_time = iso_time - np.repeat(iso_time[starts], counts)
+    relative_longitude = (longitude - np.repeat(longitude[starts], counts) + 180) % 360 - 180
+
+    mean_time = iso_time[starts] + np.round(np.add.reduceat(relative_time, starts) / counts).astype(np.int64)
+    mean_longitude = (longitude[starts] + np.add.reduceat(relative_longitude, starts) / counts + 180) % 360 - 180
+    mean_latitude = np.add.reduceat(latitude, starts) / counts
+
+    return mean_time, mean_longitude, mean_latitude
+
+
+def decimate(dataframe, interval_type, interval, rule='first'):
+    """
+    Decimate the r2rnav dataframe to one fix per interval (see
+    parse_interval) using the rule: first (first fix of each interval),
+    center (fix nearest to the center of each interval) or mean (mean
+    time/position of the fixes in each interval).  Fixes without a timestamp
+    or position are ignored.  Returns a dataframe with the time, position,
+    speed and course of the decimated fixes.
+    """
+
+    if rule not in DECIMATION_RULES:
+        logging.error("Invalid decimation rule: %s", rule)
+        raise ValueError("The decimation rule must be one of: {}".format(', '.join(DECIMATION_RULES)))
+
+    iso_time = time_column(dataframe, 'iso_time')
+    longitude = float_column(dataframe, 'ship_longitude')
+    latitude = float_column(dataframe, 'ship_latitude')
+
+    rows = np.flatnonzero((iso_time != NAT_INT) & ~np.isnan(longitude) & ~np.isnan(latitude))
+
+    if rows.size > 0 and not np.all(iso_time[rows][1:] >= iso_time[rows][:-1]):
+        rows = rows[np.argsort(iso_time[rows], kind='stable')]
+
+    if rows.size == 0:
+        return pd.DataFrame(columns=DECIMATED_COLS)
+
+    iso_time = iso_time[rows]
+    longitude = longitude[rows]
+    latitude = latitude[rows]
+
+    keys, offsets = _bins(interval_type, interval, iso_time, latitude, longitude)
+
+    # the bins are the runs of equal keys
+    starts = np.flatnonzero(np.diff(keys, prepend=keys[0] - 1) != 0)
+    counts = np.diff(np.append(starts, keys.size))
+
+    if rule == 'mean':
+        iso_time, longitude, latitude = _bin_means(starts, counts, iso_time, longitude, latitude)
+
+    else:
+        selected = starts if rule == 'first' else _nearest(starts, counts, offsets)
+
+        iso_time = iso_time[selected]
+        longitude = longitude[selected]
+        latitude = latitude[selected]
+
+    logging.debug("Decimated %d fixes to %d fixes", rows.size, starts.size)
+
+    speed_made_good = np.full(starts.size, np.nan)
+    course_made_good = np.full(starts.size, np.nan)
+
+    if starts.size > 1:
+        delta_t = np.diff(iso_time) / 10**9
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed_made_good[1:] = np.where(delta_t > 0, great_circle_distances(latitude, longitude) * 1000 / delta_t, np.nan)
+
+        course_made_good[1:] = calculate_bearings(latitude, longitude)
+
+    return pd.DataFrame({
+        'iso_time': pd.to_datetime(iso_time),
+        'ship_longitude': longitude,
+        'ship_latitude': latitude,
+        'speed_made_good': speed_made_good,
+        'course_made_good': course_made_good
+    }, columns=DECIMATED_COLS)
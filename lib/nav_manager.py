@@ -15,9 +15,11 @@ LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for detai
               Copyright (C) OceanDataTools 2021
 '''
 import sys
+import copy
 import json
 import logging
-from io import StringIO
+import xml.etree.ElementTree as ET
+from functools import lru_cache
 from datetime import datetime, timedelta
 
 from os.path import dirname, realpath, basename, join
@@ -25,12 +27,19 @@ sys.path.append(dirname(dirname(realpath(__file__))))
 
 import numpy as np
 import pandas as pd
-from rdp import rdp
 from geopy import Point
 from geopy.distance import great_circle
 
-from lib.utils import calculate_bearing, read_r2rnavfile
-from lib.geocsv_templates import bestres_header, onemin_header, control_header
+from lib.utils import calculate_bearing, calculate_bearings, great_circle_distances
+from lib.geocsv_templates import bestres_header, onemin_header, decimated_header, control_header
+from lib.nav_writer import write_csv, CHUNK_SIZE
+from lib.nav_plan import ExportPlan
+from lib.nav_stats import NAT_INT, scan_nav_data, to_timestamp, to_timedelta
+from lib.nav_ports import PORT_RADIUS
+from lib.nav_simplify import rdp_ranking
+from lib.nav_track import segment_track, track_totals, UNDERWAY_SPEED, STATION_SPEED
+from lib.nav_decimate import decimate, parse_interval
+from lib.nav_qc import QC_COL, QC_FLAGS, QC_EXPORT_MASK, build_qc_flags, qc_flags, qc_thresholds
 
 R2RNAV_COLS = ['iso_time','ship_longitude','ship_latitude','nmea_quality','nsv','hdop','antenna_height','valid_cksum','valid_parse','sensor_time','deltaT','sensor_deltaT','valid_order','distance','speed_made_good','course_made_good','acceleration']
 
@@ -40,14 +49,37 @@ bestres_cols = ['iso_time','ship_longitude','ship_latitude','nmea_quality','nsv'
 onemin_cols = ['iso_time','ship_longitude','ship_latitude','speed_made_good','course_made_good']
 control_cols = ['iso_time','ship_longitude','ship_latitude']
 
+# the columns each navexport product is built from
+PRODUCT_COLS = {
+    'bestres': bestres_cols,
+    '1min': control_cols,
+    'decimated': control_cols,
+    'control': control_cols,
+    'pyramid': control_cols
+}
+
 MAX_SPEED = 8.7  # m/s
 MAX_ACCEL = 1    # m/s^2
 MAX_DELTA_T = 300 # seconds
 
 RDP_EPSILON = 0.001
 
+ONE_MINUTE_NS = 60 * 10**9
+
+PYRAMID_FACTOR = 4
+PYRAMID_MIN_POINTS = 500
+
+PERCENTILES = [50, 95, 99, 99.9]
+HISTOGRAM_BINS = 10
+
 XML_TEMPLATE = join(dirname(dirname(realpath(__file__))), 'templates', 'nav_qa_template_ver1.0.xml')
 
+XML_NAMESPACES = {
+    'r2r': 'http://get.rvdata.us/schema/r2r-1.0',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
+}
+
 rounding = {
     'ship_longitude': 8,
     'ship_latitude': 8,
@@ -77,6 +109,36 @@ class NpEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+def _format_value(value, fmt):
+    """
+    Return the value formatted using fmt, N/A if the value is missing (None
+    or NaN)
+    """
+
+    if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+        return "N/A"
+
+    return fmt % value
+
+
+def json_safe(value):
+    """
+    Return the value (dicts and lists are copied) with the NaN and infinite
+    floats replaced by None, json has no NaN
+    """
+
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+
+    if isinstance(value, (float, np.floating)) and not np.isfinite(value):
+        return None
+
+    return value
+
+
 class NavInfoReport():
     """
     Class for building navinfo reports
@@ -89,8 +151,8 @@ class NavInfoReport():
         self._start_coord = [None, None]
         self._end_coord = [None, None]
         self._bbox = [ None, None, None, None]
-        self._parse_errors = None
-        self._total_lines = None
+        self._parse_errors = 0
+        self._total_lines = 0
 
 
     @property
@@ -157,24 +219,68 @@ class NavInfoReport():
         return self._total_lines
 
 
+    def add_fix(self, timestamp, longitude, latitude):
+        """
+        Update the report with a successfully parsed line, used by the parsers
+        to build the report as the file is decoded
+        """
+
+        self._total_lines += 1
+
+        if self._start_ts is None:
+            self._start_ts = timestamp
+            self._start_coord = [longitude, latitude]
+            self._bbox = [longitude, latitude, longitude, latitude]
+
+        self._end_ts = timestamp
+        self._end_coord = [longitude, latitude]
+
+        bbox = self._bbox
+        if longitude > bbox[0]:
+            bbox[0] = longitude
+        elif longitude < bbox[2]:
+            bbox[2] = longitude
+
+        if latitude > bbox[1]:
+            bbox[1] = latitude
+        elif latitude < bbox[3]:
+            bbox[3] = latitude
+
+
+    def add_parse_error(self):
+        """
+        Update the report with a line that could not be parsed
+        """
+
+        self._total_lines += 1
+        self._parse_errors += 1
+
+
     def build_report(self, dataframe):
         """
         Build the NavInfo report
         """
 
-        self._parse_errors = len(dataframe[(dataframe['valid_parse'] == 0)])
-        self._total_lines = len(dataframe.index)
+        self.load_stats(scan_nav_data(dataframe))
 
-        first_valid_row = dataframe[dataframe['valid_parse'] == 1].iloc[0]
-        
-        idx = dataframe.query('valid_parse.eq(1)').index.max()
-        last_valid_row = dataframe.iloc[idx]
 
-        self._start_ts = first_valid_row['iso_time']
-        self._end_ts = last_valid_row['iso_time']
-        self._start_coord = [first_valid_row['ship_longitude'],first_valid_row['ship_latitude']]
-        self._end_coord = [last_valid_row['ship_longitude'],last_valid_row['ship_latitude']]
-        self._bbox = [dataframe['ship_longitude'].max(),dataframe['ship_latitude'].max(),dataframe['ship_longitude'].min(),dataframe['ship_latitude'].min()]
+    def load_stats(self, stats):
+        """
+        Build the NavInfo report from the statistics returned by scan_nav_data
+        """
+
+        self._parse_errors = stats['parse_errors']
+        self._total_lines = stats['total_lines']
+
+        if stats['first_valid'] is not None:
+            self._start_ts = to_timestamp(stats['first_valid'][0])
+            self._start_coord = stats['first_valid'][1:]
+
+        if stats['last_valid'] is not None:
+            self._end_ts = to_timestamp(stats['last_valid'][0])
+            self._end_coord = stats['last_valid'][1:]
+
+        self._bbox = [stats['longitude'][1], stats['latitude'][1], stats['longitude'][0], stats['latitude'][0]]
 
     def __str__(self):
         return "NavInfo Report: %s\n\
@@ -197,7 +303,7 @@ Total Lines of Data: %s\
         """
         Return test data as json object
         """
-        return {"filename": self._filename, "startTS": self._start_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "endTS": self._end_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "startCoord": self._start_coord, "endCoord": self._end_coord, "bbox": self._bbox, "parseErrors": self._parse_errors, "totalLines": self._total_lines}
+        return json_safe({"filename": self._filename, "startTS": self._start_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "endTS": self._end_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), "startCoord": self._start_coord, "endCoord": self._end_coord, "bbox": self._bbox, "parseErrors": self._parse_errors, "totalLines": self._total_lines})
 
 
 class NavQAReport(): # pylint: disable=too-many-instance-attributes
@@ -205,11 +311,31 @@ class NavQAReport(): # pylint: disable=too-many-instance-attributes
     Class for a navqa reports
     """
 
-    def __init__(self, filename, delta_t_threshold = MAX_DELTA_T, speed_threshold = MAX_SPEED, acceleration_threshold = MAX_ACCEL):
+    # The name, unit of measure, json name and text format of each
+    # distribution, the quantiles are approximate so nsv is rounded to the
+    # nearest satellite
+    DISTRIBUTIONS = {
+        'speed': ('Horizontal Speed', 'm/s', 'horizontalSpeed', '%%0.%df' % rounding['speed_made_good']),
+        'acceleration': ('Horizontal Acceleration', 'm/s^2', 'horizontalAcceleration', '%0.3f'),
+        'hdop': ('HDOP', '', 'hdop', '%0.1f'),
+        'nsv': ('Number of Satellites', '', 'satellites', '%0.0f'),
+        'delta_t': ('Epoch Gap', 's', 'deltaT', '%0.3f')
+    }
+
+    def __init__(self, filename, delta_t_threshold = MAX_DELTA_T, speed_threshold = MAX_SPEED, acceleration_threshold = MAX_ACCEL, port_index = None, percentiles = None, histogram_bins = HISTOGRAM_BINS): # pylint: disable=too-many-arguments
 
         # The filename
         self._filename = filename
 
+        # The percentiles and number of histogram bins reported for the
+        # distributions
+        self._percentiles = percentiles if percentiles is not None else PERCENTILES
+        self._histogram_bins = histogram_bins
+        self._distributions = None
+
+        # The port database (PortIndex) used for the distance from port
+        self._port_index = port_index
+
         # Total data rows
         self._total_lines = None
 
@@ -224,10 +350,22 @@ class NavQAReport(): # pylint: disable=too-many-instance-attributes
         self._horizontal_acceleration = [ None, None ]
         self._horizontal_speed = [ None, None ]
         self._distance_from_port = [ None, None ]
+        self._nearest_port = [ None, None ]
+        self._port_calls = None
         self._timestamps = [ None, None ]
         self._nsv = [ None, None ]
         self._hdop = [ None, None ]
         self._delta_t = [ None, None ]
+        self._bbox = [ None, None, None, None ]
+
+        # The epoch completeness
+        self._epoch_interval = None
+        self._possible_epochs = None
+        self._actual_epochs = None
+        self._countable_epochs = None
+        self._absent_epochs = None
+        self._flagged_epochs = None
+        self._percent_completeness = None
 
         # The QA errors
         self._delta_t_errors = None
@@ -239,54 +377,174 @@ class NavQAReport(): # pylint: disable=too-many-instance-attributes
         self._cksum_errors = None
 
 
+    @property
+    def filename(self):
+        '''
+        Getter function for self._filename
+        '''
+        return self._filename
+
+
+    @property
+    def total_lines(self):
+        '''
+        Getter function for self._total_lines
+        '''
+        return self._total_lines
+
+
+    @property
+    def longest_gap(self):
+        '''
+        Getter function for the longest epoch gap
+        '''
+        return self._delta_t[1]
+
+
+    @property
+    def percent_completeness(self):
+        '''
+        Getter function for self._percent_completeness
+        '''
+        return self._percent_completeness
+
+
+    @property
+    def errors(self):
+        '''
+        Getter function for the QA error counts
+        '''
+        return {
+            'gaps': self._delta_t_errors,
+            'out_of_sequence': self._out_of_sequence_errors,
+            'nmea_quality': self._nmea_qualty_errors,
+            'speed': self._horizontal_speed_errors,
+            'acceleration': self._horizontal_acceleration_errors,
+            'parse': self._parse_errors,
+            'cksum': self._cksum_errors
+        }
+
+
     def build_report(self, dataframe):
         '''
         Build the navqa report.
         '''
 
-        self._total_lines = len(dataframe.index)
+        self.load_stats(scan_nav_data(dataframe, self._delta_t_threshold.total_seconds(), self._horizontal_speed_threshold, self._horzontal_acceleration_threshold))
+
+
+    def find_port_calls(self, dataframe, radius=PORT_RADIUS):
+        '''
+        Add the port calls (consecutive fixes within radius meters of a port)
+        in the dataframe to the report.  Requires a port database.  May be
+        called with consecutive chunks of the data, a port call spanning the
+        chunks is merged.
+        '''
+
+        if self._port_index is None:
+            logging.error("A port database is required to find port calls")
+            raise ValueError("No port database")
+
+        if self._port_calls is None:
+            self._port_calls = []
+
+        # fixes without a position do not end a port call
+        dataframe = dataframe[dataframe['ship_latitude'].notna() & dataframe['ship_longitude'].notna()]
+
+        if len(dataframe.index) == 0:
+            return
 
-        self._antenna_altitude = [ dataframe['antenna_height'].min(), dataframe['antenna_height'].max() ]
-        self._horizontal_speed = [ dataframe['speed_made_good'].min(), dataframe['speed_made_good'].max() ]
-        self._horizontal_acceleration = [ dataframe['acceleration'].min(), dataframe['acceleration'].max() ]
-        self._distance_from_port = [ 0, 0 ]
-        self._timestamps = [ dataframe['iso_time'].loc[~dataframe['iso_time'].isnull()].iloc[0], dataframe['iso_time'].iloc[-1] ]
-        self._nsv = [ int(dataframe['nsv'].min()), int(dataframe['nsv'].max()) ]
-        self._hdop = [ dataframe['hdop'].min(), dataframe['hdop'].max() ]
-        self._delta_t = [ dataframe['deltaT'].min(), dataframe['deltaT'].max() ]
+        port_calls = self._port_index.port_calls(dataframe, radius)
 
-        self._delta_t_errors = len(dataframe[(dataframe['deltaT'] > self._delta_t_threshold)])
-        self._out_of_sequence_errors = len(dataframe[(dataframe['valid_order'] == 0)])
-        self._nmea_qualty_errors = self._total_lines - len(dataframe[dataframe['nmea_quality'].between(1,3)])
-        self._horizontal_speed_errors = len(dataframe[(dataframe['speed_made_good'] > self._horizontal_speed_threshold)])
-        self._horizontal_acceleration_errors = len(dataframe[(dataframe['acceleration'] > self._horzontal_acceleration_threshold)])
-        self._parse_errors = len(dataframe[(dataframe['valid_parse'] == 0)])
-        self._cksum_errors = len(dataframe[(dataframe['valid_cksum'] == 0)])
+        # merge the call still open at the end of the previous chunk
+        if self._port_calls and port_calls and self._port_calls[-1]['open'] and port_calls[0]['startTS'] == dataframe['iso_time'].iloc[0] and port_calls[0]['port'] == self._port_calls[-1]['port']:
+            first = port_calls.pop(0)
+            self._port_calls[-1].update({
+                'endTS': first['endTS'],
+                'fixes': self._port_calls[-1]['fixes'] + first['fixes'],
+                'closestApproach': min(self._port_calls[-1]['closestApproach'], first['closestApproach'])
+            })
 
+        if self._port_calls:
+            self._port_calls[-1]['open'] = False
+
+        self._port_calls += port_calls
+
+        if self._port_calls and self._port_calls[-1]['endTS'] == dataframe['iso_time'].iloc[-1]:
+            self._port_calls[-1]['open'] = True
+
+
+    def load_stats(self, stats):
+        '''
+        Build the navqa report from the statistics returned by scan_nav_data.
+        The statistics must have been calculated using this report's
+        thresholds.
+        '''
+
+        self._total_lines = stats['total_lines']
+
+        self._antenna_altitude = stats['antenna_height']
+        self._horizontal_speed = stats['speed']
+        self._horizontal_acceleration = stats['acceleration']
+        self._distance_from_port = [ None, None ]
+        self._nearest_port = [ None, None ]
+
+        if self._port_index is not None:
+            fixes = [stats['first_valid'], stats['last_valid']]
+            for position, fix in enumerate(fixes):
+                if fix is not None:
+                    self._nearest_port[position], self._distance_from_port[position] = self._port_index.nearest_port(fix[2], fix[1])
+        self._timestamps = [ to_timestamp(stats['first_epoch']), to_timestamp(stats['last_epoch']) ]
+        self._nsv = [ int(nsv) if not np.isnan(nsv) else nsv for nsv in stats['nsv'] ]
+        self._hdop = stats['hdop']
+        self._delta_t = [ to_timedelta(stats['delta_t'][0]), to_timedelta(stats['delta_t'][1]) ]
+        self._bbox = [stats['longitude'][1], stats['latitude'][1], stats['longitude'][0], stats['latitude'][0]]
+
+        self._epoch_interval = to_timedelta(stats['epoch_interval'])
+        self._possible_epochs = stats['possible_epochs']
+        self._actual_epochs = stats['actual_epochs']
+        self._countable_epochs = stats['countable_epochs']
+        self._absent_epochs = stats['absent_epochs']
+        self._flagged_epochs = stats['flagged_epochs']
+        self._percent_completeness = stats['percent_completeness']
+
+        self._distributions = stats['distributions']
+
+        self._delta_t_errors = stats['delta_t_errors']
+        self._out_of_sequence_errors = stats['out_of_sequence_errors']
+        self._nmea_qualty_errors = stats['nmea_quality_errors']
+        self._horizontal_speed_errors = stats['speed_errors']
+        self._horizontal_acceleration_errors = stats['acceleration_errors']
+        self._parse_errors = stats['parse_errors']
+        self._cksum_errors = stats['cksum_errors']
 
     def __str__(self):
-        return "NavQA Report: %s\n\
+        report = "NavQA Report: %s\n\
 Duration and range of values:\n\
-Maximum Antenna Altitude: %0.3f m\n\
-Minimum Antenna Altitude: %0.3f m\n\
-Maximum Horizontal Speed: %0.3f m/s\n\
-Minimum Horizontal Speed: %0.3f m/s\n\
-Maximum Horizontal Acceleration: %0.3f m/s^2\n\
-Minimum Horizontal Acceleration: %0.3f m/s^2\n\
-Distance from Port Start: %0.2f m\n\
-Distance from Port End: %0.2f m\n\
+Maximum Antenna Altitude: %s\n\
+Minimum Antenna Altitude: %s\n\
+Maximum Horizontal Speed: %s\n\
+Minimum Horizontal Speed: %s\n\
+Maximum Horizontal Acceleration: %s\n\
+Minimum Horizontal Acceleration: %s\n\
+Distance from Port Start: %s\n\
+Distance from Port End: %s\n\
+Nearest Port Start: %s\n\
+Nearest Port End: %s\n\
 First epoch: %s\n\
 Last epoch: %s\n\
-Possible Number of Epochs with Observations:\n\
-Actual Number of Epochs with Observations:\n\
-Actual Countable Number of Epoch with Observations:\n\
-Absent Number of Epochs with Observations:\n\
-Flagged Number of Epochs with Observations:\n\
+Epoch Interval: %s\n\
+Possible Number of Epochs with Observations: %s\n\
+Actual Number of Epochs with Observations: %s\n\
+Actual Countable Number of Epoch with Observations: %s\n\
+Absent Number of Epochs with Observations: %s\n\
+Flagged Number of Epochs with Observations: %s\n\
+Percent Completeness: %s\n\
 Number of satellites:\n\
-Maximum Number of Satellites: %d\n\
-Minimum Number of Satellites: %d\n\
-Maximum HDOP: %0.1f\n\
-Minimum HDOP: %0.1f\n\n\
+Maximum Number of Satellites: %s\n\
+Minimum Number of Satellites: %s\n\
+Maximum HDOP: %s\n\
+Minimum HDOP: %s\n\n\
 Qualtiy Assessment:\n\
 Longest epoch gap: %s\n\
 Number of Gaps Longer than Threshold: %d\n\
@@ -300,20 +558,29 @@ Percent Unreasonable Horizontal Speeds: %0.3f %%\n\
 Number of Horizontal Accelerations Exceeding Threshold: %d\n\
 Percent Unreasonable Horizontal Accelerations: %0.3f %%\n\
 " % (basename(self._filename),
-    self._antenna_altitude[1],
-    self._antenna_altitude[0],
-    self._horizontal_speed[1],
-    self._horizontal_speed[0],
-    self._horizontal_acceleration[1],
-    self._horizontal_acceleration[0],
-    self._distance_from_port[0],
-    self._distance_from_port[1],
+    _format_value(self._antenna_altitude[1], "%0.3f m"),
+    _format_value(self._antenna_altitude[0], "%0.3f m"),
+    _format_value(self._horizontal_speed[1], "%0.3f m/s"),
+    _format_value(self._horizontal_speed[0], "%0.3f m/s"),
+    _format_value(self._horizontal_acceleration[1], "%0.3f m/s^2"),
+    _format_value(self._horizontal_acceleration[0], "%0.3f m/s^2"),
+    _format_value(self._distance_from_port[0], "%0.2f m"),
+    _format_value(self._distance_from_port[1], "%0.2f m"),
+    _format_value(self._nearest_port[0], "%s"),
+    _format_value(self._nearest_port[1], "%s"),
     self._timestamps[0].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
     self._timestamps[1].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-    self._nsv[1],
-    self._nsv[0],
-    self._hdop[1],
-    self._hdop[0],
+    str(self._epoch_interval),
+    self._possible_epochs,
+    self._actual_epochs,
+    self._countable_epochs,
+    self._absent_epochs,
+    self._flagged_epochs,
+    "%0.3f %%" % self._percent_completeness if self._percent_completeness is not None else None,
+    _format_value(self._nsv[1], "%d"),
+    _format_value(self._nsv[0], "%d"),
+    _format_value(self._hdop[1], "%0.1f"),
+    _format_value(self._hdop[0], "%0.1f"),
     str(self._delta_t[1]),
     self._delta_t_errors,
     100 * self._delta_t_errors/self._total_lines,
@@ -327,13 +594,30 @@ Percent Unreasonable Horizontal Accelerations: %0.3f %%\n\
     100 * self._horizontal_acceleration_errors/self._total_lines,
 )
 
+        if self._distributions is not None:
+            report += "\nDistributions (%s):\n" % ' / '.join('p%g' % percentile for percentile in self._percentiles)
+            for metric, (name, uom, _, fmt) in self.DISTRIBUTIONS.items():
+                values = self._distributions[metric].quantiles(np.asarray(self._percentiles) / 100)
+                if values is None:
+                    report += "%s: N/A\n" % name
+                    continue
+
+                report += "%s: %s%s\n" % (name, ' / '.join(_format_value(value, fmt) for value in values), ' ' + uom if uom else '')
+
+        if self._port_calls is not None:
+            report += "\nPort Calls: %d\n" % len(self._port_calls)
+            for port_call in self._port_calls:
+                report += "\t%s: %s - %s, closest approach: %0.2f m\n" % (port_call['port'], port_call['startTS'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"), port_call['endTS'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"), port_call['closestApproach'])
+
+        return report
+
 
     def to_json(self):
         """
         Return test data json object
         """
 
-        return {
+        report = {
             "filename": self._filename,
             "antennaAltitudeMax": self._antenna_altitude[1],
             "antennaAltitudeMin": self._antenna_altitude[0],
@@ -343,8 +627,17 @@ Percent Unreasonable Horizontal Accelerations: %0.3f %%\n\
             "horizontalAccelerationMin": self._horizontal_acceleration[0],
             "distanceFromStartPort": self._distance_from_port[0],
             "distanceFromEndPort": self._distance_from_port[1],
-            "firstEpoch": self._timestamps[0].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
-            "lastEpoch": self._timestamps[1].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "nearestStartPort": self._nearest_port[0],
+            "nearestEndPort": self._nearest_port[1],
+            "firstEpoch": self._timestamps[0].strftime("%Y-%m-%dT%H:%M:%S.%fZ") if self._timestamps[0] is not None else None,
+            "lastEpoch": self._timestamps[1].strftime("%Y-%m-%dT%H:%M:%S.%fZ") if self._timestamps[1] is not None else None,
+            "epochInterval": str(self._epoch_interval),
+            "possibleEpochs": self._possible_epochs,
+            "actualEpochs": self._actual_epochs,
+            "actualCountableEpochs": self._countable_epochs,
+            "absentEpochs": self._absent_epochs,
+            "flaggedEpochs": self._flagged_epochs,
+            "percentCompleteness": self._percent_completeness,
             "satellitesMax": self._nsv[1],
             "satellitesMin": self._nsv[0],
             "hdopMax": self._hdop[1],
@@ -361,40 +654,374 @@ Percent Unreasonable Horizontal Accelerations: %0.3f %%\n\
             "horizontalAccelerationErrorPercentage": round(self._horizontal_acceleration_errors/self._total_lines, 2) * 100
         }
 
-    def to_xml():
+        if self._distributions is not None:
+            report["distributions"] = {}
+            for metric, (_, _, name, _) in self.DISTRIBUTIONS.items():
+                sketch = self._distributions[metric]
+                values = sketch.quantiles(np.asarray(self._percentiles) / 100)
+                histogram = sketch.histogram(self._histogram_bins)
+                report["distributions"][name] = {
+                    "percentiles": {'p%g' % percentile: value for percentile, value in zip(self._percentiles, values)} if values is not None else None,
+                    "histogram": {"counts": histogram[0].tolist(), "edges": histogram[1].tolist()} if histogram is not None else None
+                }
+
+        if self._port_calls is not None:
+            report["portCalls"] = [{
+                "port": port_call['port'],
+                "startTS": port_call['startTS'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "endTS": port_call['endTS'].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                "fixes": port_call['fixes'],
+                "closestApproach": port_call['closestApproach']
+            } for port_call in self._port_calls]
+
+        return json_safe(report)
+
+    @staticmethod
+    def _rating(value, green, red, lower_is_better=True):
+        """
+        Return the G/Y/R rating of the value
+        """
+
+        if lower_is_better:
+            return 'G' if value < green else 'R' if value >= red else 'Y'
+
+        return 'G' if value > green else 'R' if value <= red else 'Y'
+
+
+    def to_xml(self):
         """
         Return the report in XML format using the r2r 1.0 template.
         """
 
-        xmltree = ET.parse(XML_TEMPLATE)
-        xmlroot = xmltree.getroot()
+        xmlroot = copy.deepcopy(_xml_template())
 
-        return None
-        
-
-        # # iterating through the price values.
-        # for prices in xmlroot.iter('price'):
-        #     # updates the price value
-        #     prices.text = str(float(prices.text)+10)
-        #     # creates a new attribute
-        #     prices.set('newprices', 'yes')
-         
-        # # creating a new tag under the parent.
-        # # xmlroot[0] here is the first food tag.
-        # ET.SubElement(xmlroot[0], 'tasty')
-        # for temp in xmlroot.iter('tasty'):
-        #     # giving the value as Yes.
-        #     temp.text = str('YES')
-         
-        # # deleting attributes in the xml.
-        # # by using pop as attrib returns dictionary.
-        # # removes the itemid attribute in the name tag of
-        # # the second food tag.
-        # xmlroot[1][0].attrib.pop('itemid')
-         
-        # # Removing the tag completely we use remove function.
-        # # completely removes the third food tag.
-        # xmlroot.remove(xmlroot[2])
+        def _find(path):
+            return xmlroot.find(path, XML_NAMESPACES)
+
+        def _percent(count):
+            return 100 * count / self._total_lines
+
+        _find('r2r:identifier').text = basename(self._filename)
+        _find('r2r:provenance/r2r:create_process').text = 'navqa.py'
+        _find('r2r:provenance/r2r:create_time').text = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        longest_gap = self._delta_t[1].total_seconds() if self._delta_t[1] is not None else 0
+
+        tests = {
+            'percent_completeness': (self._percent_completeness, self._rating(self._percent_completeness or 0, 95, 75, lower_is_better=False)),
+            'longest_epoch_gap': (longest_gap, 'G' if longest_gap <= 15 * 60 else 'R' if longest_gap >= 24 * 3600 else 'Y'),
+            'percent_records_out_of_sequence': (_percent(self._out_of_sequence_errors), None),
+            'percent_records_with_bad_gps_quality_indicator': (_percent(self._nmea_qualty_errors), None),
+            'percent_unreasonable_speeds': (_percent(self._horizontal_speed_errors), None),
+            'percent_unreasonable_accelerations': (_percent(self._horizontal_acceleration_errors), None)
+        }
+
+        ratings = []
+        for test in _find('r2r:certificate/r2r:tests').findall('r2r:test', XML_NAMESPACES):
+            value, rating = tests[test.get('name')]
+            rating = rating or self._rating(value, 5, 10)
+            ratings.append(rating)
+
+            test.find('r2r:rating', XML_NAMESPACES).text = rating
+            test.find('r2r:value', XML_NAMESPACES).text = "%0.3f" % value if value is not None else None
+
+            if test.get('name') == 'longest_epoch_gap':
+                test.find('r2r:value', XML_NAMESPACES).set('uom', 's')
+
+        _find('r2r:certificate/r2r:rating').text = 'G' if all(rating == 'G' for rating in ratings) else 'R' if 'R' in ratings else 'Y'
+
+        infos = {
+            'first_epoch': self._timestamps[0].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            'last_epoch': self._timestamps[1].strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            'epoch_interval': self._epoch_interval.total_seconds() if self._epoch_interval is not None else None,
+            'number_of_satellites': self._nsv,
+            'HDOP': self._hdop,
+            'altitude': self._antenna_altitude,
+            'horizontal_speed': self._horizontal_speed,
+            'horizontal_acceleration': self._horizontal_acceleration,
+            'northBoundLatitude': self._bbox[1],
+            'southBoundLatitude': self._bbox[3],
+            'westBoundLongitude': self._bbox[2],
+            'eastBoundLongitude': self._bbox[0],
+            'number_of_gaps_longer_than_threshold': self._delta_t_errors
+        }
+
+        for info in _find('r2r:certificate/r2r:infos').findall('r2r:info', XML_NAMESPACES):
+            value = infos[info.get('name')]
+            bounds = info.find('r2r:bounds', XML_NAMESPACES)
+
+            if bounds is not None:
+                for bound in bounds.findall('r2r:bound', XML_NAMESPACES):
+                    bound.text = str(value[1] if bound.get('name') == 'maximum' else value[0])
+            else:
+                info.find('r2r:value', XML_NAMESPACES).text = str(value) if value is not None else None
+
+        parameters = {
+            'data_starttime': (infos['first_epoch'], None),
+            'data_endtime': (infos['last_epoch'], None),
+            'speed_threshold': (self._horizontal_speed_threshold, 'm/s'),
+            'acceleration_threshold': (self._horzontal_acceleration_threshold, 'm/s^2'),
+            'gap_threshold': (self._delta_t_threshold.total_seconds(), 's')
+        }
+
+        for parameter in _find('r2r:configuration/r2r:parameters').findall('r2r:parameter', XML_NAMESPACES):
+            value, uom = parameters[parameter.get('name')]
+            parameter.text = str(value)
+            if uom is not None:
+                parameter.set('uom', uom)
+
+        return ET.tostring(xmlroot, encoding='unicode', xml_declaration=True)
+
+
+class NavQABreakdown():
+    """
+    Class for a navqa report broken down by group (UTC day or source file)
+    """
+
+    def __init__(self, group_by, reports):
+
+        # The grouping (day or file)
+        self._group_by = group_by
+
+        # The NavQAReport for each group, in data order
+        self._reports = reports
+
+
+    @property
+    def group_by(self):
+        '''
+        Getter function for self._group_by
+        '''
+        return self._group_by
+
+
+    @property
+    def reports(self):
+        '''
+        Getter function for self._reports
+        '''
+        return self._reports
+
+
+    def __str__(self):
+
+        def _percent(count, total):
+            return "%0.3f" % (100 * count / total) if count is not None and total else "-"
+
+        columns = [self._group_by, 'Lines', 'Complete %', 'Longest Gap', 'Gaps %', 'Sequence %', 'GPS Quality %', 'Speed %', 'Accel %', 'Parse Errors']
+        rows = []
+
+        for group, report in self._reports.items():
+            errors = report.errors
+            rows.append([
+                str(group),
+                str(report.total_lines),
+                "%0.3f" % report.percent_completeness if report.percent_completeness is not None else "-",
+                str(report.longest_gap),
+                _percent(errors['gaps'], report.total_lines),
+                _percent(errors['out_of_sequence'], report.total_lines),
+                _percent(errors['nmea_quality'], report.total_lines),
+                _percent(errors['speed'], report.total_lines),
+                _percent(errors['acceleration'], report.total_lines),
+                str(errors['parse'])
+            ])
+
+        widths = [max(len(row[position]) for row in [columns] + rows) for position in range(len(columns))]
+
+        lines = ["NavQA Breakdown by %s:" % self._group_by]
+        for row in [columns] + rows:
+            lines.append("  ".join([row[0].ljust(widths[0])] + [value.rjust(width) for value, width in zip(row[1:], widths[1:])]))
+
+        return "\n".join(lines) + "\n"
+
+
+    def to_json(self):
+        """
+        Return the breakdown as a json object
+        """
+
+        return {str(group): report.to_json() for group, report in self._reports.items()}
+
+
+class NavQASweep():
+    """
+    Class for a navqa threshold sweep, the error percentage vs threshold of
+    the gap, speed and acceleration tests
+    """
+
+    METRICS = {
+        'delta_t': ('Gap', 's'),
+        'speed': ('Horizontal Speed', 'm/s'),
+        'acceleration': ('Horizontal Acceleration', 'm/s^2')
+    }
+
+    def __init__(self, filename, sweep):
+
+        # The filename
+        self._filename = filename
+
+        # The sweep returned by sweep_nav_data
+        self._sweep = sweep
+
+
+    @property
+    def sweep(self):
+        '''
+        Getter function for self._sweep
+        '''
+        return self._sweep
+
+
+    def _curve(self, key):
+        '''
+        Return the (threshold, errors, percentage) rows of the metric
+        '''
+        thresholds, counts = self._sweep[key]
+        total = self._sweep['total_lines']
+        return [(threshold, int(count), 100 * count / total if total else 0.0) for threshold, count in zip(thresholds, counts)]
+
+
+    def __str__(self):
+
+        lines = ["NavQA Threshold Sweep: %s" % basename(self._filename), "Total Lines of Data: %d" % self._sweep['total_lines']]
+
+        for key, (name, uom) in self.METRICS.items():
+            if key not in self._sweep:
+                continue
+
+            lines.append("")
+            lines.append("%s Threshold (%s)     Errors  Percentage" % (name, uom))
+            width = len(lines[-1].split('  ')[0])
+            for threshold, errors, percentage in self._curve(key):
+                lines.append("%s  %9d  %9.3f %%" % (("%g" % threshold).rjust(width), errors, percentage))
+
+        return "\n".join(lines) + "\n"
+
+
+    def to_json(self):
+        """
+        Return the sweep as a json object
+        """
+
+        report = {"filename": self._filename, "totalLines": self._sweep['total_lines']}
+
+        names = {'delta_t': 'gapThreshold', 'speed': 'horizontalSpeedThreshold', 'acceleration': 'horizontalAccelerationThreshold'}
+        for key, name in names.items():
+            if key in self._sweep:
+                report[name] = [{"threshold": threshold, "errors": errors, "percentage": percentage} for threshold, errors, percentage in self._curve(key)]
+
+        return json_safe(report)
+
+
+class NavTrackReport():
+    """
+    Class for track statistics: the track length and the time underway, on
+    station and in port
+    """
+
+    STATES = {
+        'underway': ('Underway', 'timeUnderway'),
+        'on_station': ('On Station', 'timeOnStation'),
+        'in_port': ('In Port', 'timeInPort')
+    }
+
+    def __init__(self, filename, underway_speed=UNDERWAY_SPEED, station_speed=STATION_SPEED, port_index=None, port_radius=PORT_RADIUS): # pylint: disable=too-many-arguments
+
+        # The filename
+        self._filename = filename
+
+        # The segmentation speeds (m/s)
+        self._underway_speed = underway_speed
+        self._station_speed = station_speed
+
+        # The port database (PortIndex) and radius (m) used for in port
+        self._port_index = port_index
+        self._port_radius = port_radius
+
+        # The segments and totals
+        self._segments = None
+        self._totals = None
+
+
+    @property
+    def segments(self):
+        '''
+        Getter function for self._segments
+        '''
+        return self._segments
+
+
+    @property
+    def totals(self):
+        '''
+        Getter function for self._totals
+        '''
+        return self._totals
+
+
+    def build_report(self, dataframe):
+        """
+        Build the track report
+        """
+
+        self._segments = segment_track(dataframe, self._underway_speed, self._station_speed, self._port_index, self._port_radius)
+        self._totals = track_totals(self._segments)
+
+
+    def __str__(self):
+
+        total_duration = sum(self._totals['duration'].values())
+
+        lines = [
+            "NavTrack Report: %s" % basename(self._filename),
+            "Track Length: %0.3f km" % self._totals['track_length']
+        ]
+
+        for state, (name, _) in self.STATES.items():
+            duration = self._totals['duration'][state]
+            lines.append("Time %s: %s (%0.3f %%), %0.3f km" % (name, pd.Timedelta(duration), 100 * duration / total_duration if total_duration else 0.0, self._totals['distance'][state]))
+
+        lines.append("Segments: %d" % self._totals['segments'])
+        for segment in self._segments.itertuples():
+            lines.append("\t%s: %s - %s, %s, %0.3f km" % (self.STATES[segment.state][0], segment.start_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), segment.end_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), pd.Timedelta(segment.duration), segment.distance))
+
+        return "\n".join(lines) + "\n"
+
+
+    def to_json(self):
+        """
+        Return the track report as a json object, durations in seconds and
+        distances in km
+        """
+
+        report = {"filename": self._filename, "trackLength": self._totals['track_length']}
+
+        for state, (_, name) in self.STATES.items():
+            report[name] = self._totals['duration'][state] / 10**9
+
+        report["segments"] = [{
+            "state": segment.state,
+            "startTS": segment.start_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "endTS": segment.end_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "duration": segment.duration / 10**9,
+            "distance": segment.distance,
+            "fixes": int(segment.fixes)
+        } for segment in self._segments.itertuples()]
+
+        return json_safe(report)
+
+
+@lru_cache(maxsize=None)
+def _xml_template():
+    """
+    Return the root of the parsed XML template, parsed once.  Callers must
+    copy the tree before modifying it.
+    """
+
+    for prefix, uri in XML_NAMESPACES.items():
+        ET.register_namespace(prefix, uri)
+
+    return ET.parse(XML_TEMPLATE).getroot()
 
 
 class NavExport():
@@ -416,15 +1043,33 @@ class NavExport():
 
         self._data = None
 
+        # All the rows with their qc_flags, see apply_qc
+        self._flagged_data = None
+
+        # The control point ranking: (min_epsilon, max_points, importance, rank)
+        self._control_ranking = None
+
+        # The steps building the dataframe, executed when the data is first used
+        self._plan = None
+
 
     @property
     def data(self):
         '''
         Getter function for self.
         '''
+        self.execute()
         return self._data
 
 
+    @property
+    def plan(self):
+        '''
+        Getter function for self.
+        '''
+        return self._plan
+
+
     @staticmethod
     def _round_data(data_frame, precision=None):
         """
@@ -442,16 +1087,58 @@ class NavExport():
         return data_frame
 
 
-    def read_r2rnavfile(self, file_format='csv'):
+    def read_r2rnavfile(self, file_format='csv', start_ts=None, end_ts=None):
+        """
+        Plan building the NavExport dataframe from the NavExport filename, the
+        rows with bad parses are removed.  start_ts and end_ts are used to
+        select the shards/blocks of a partitioned r2rnav directory or archive
+        file, use crop_data to crop the rows.  The file is read when the data
+        is first used, see execute.
+        """
+
+        self._plan = ExportPlan(self._filename, file_format, start_ts=start_ts, end_ts=end_ts)
+        self._data = None
+        self._flagged_data = None
+        self._control_ranking = None
+
+
+    def _planned(self):
+        """
+        Return True if the steps are added to the plan (the plan has not been
+        executed yet)
+        """
+
+        return self._plan is not None and self._data is None
+
+
+    def select_columns(self, columns):
+        """
+        Plan reading only the columns (plus the columns used by the crop and
+        QC steps), i.e. the columns of the products that will be built.  Has
+        no effect once the plan is executed.
+        """
+
+        if not self._planned():
+            logging.debug("The data has been read, ignoring the column selection")
+            return
+
+        self._plan.project(columns)
+
+
+    def execute(self):
         """
-        Build the NavExport dataframe from the NavExport filename
+        Execute the planned steps (see nav_plan.ExportPlan) if they have not
+        been executed
         """
 
-        self._data = read_r2rnavfile(self._filename, file_format)
+        if not self._planned():
+            return
+
+        self._data, self._flagged_data = self._plan.execute()
 
-        # remove bad parse rows
-        logging.debug("Culling bad parses")
-        self._data = self._data[self._data['valid_parse'] == 1]
+        if self._data is None:
+            logging.error("No data read from r2rnav file: %s", self._filename)
+            raise ValueError("No data read from r2rnav file: {}".format(self._filename))
 
 
     def crop_data(self, start_ts=None, end_ts=None):
@@ -459,6 +1146,10 @@ class NavExport():
         Crop the NavExport dataframe to the start/end timestamps specified.
         """
 
+        if self._planned():
+            self._plan.crop(start_ts, end_ts)
+            return
+
         try:
             if start_ts is not None:
                 logging.debug("  start_dt: %s", start_ts)
@@ -468,52 +1159,173 @@ class NavExport():
                 logging.debug("  stop_dt: %s", end_ts)
                 self._data = self._data[(self._data['iso_time'] <= end_ts)]
 
+            # apply_qc must be called again to keep the flagged rows
+            self._flagged_data = None
+            self._control_ranking = None
+
         except Exception as err:
             logging.error("Could not crop data")
             logging.error(str(err))
             raise err
 
 
-    def apply_qc(self):
+    def apply_qc(self, keep_flagged=False):
         """
-        Apply the QC rules to the NavExport dataframe
+        Apply the QC rules to the NavExport dataframe, the rows with any of
+        the QC_EXPORT_MASK flags set are removed.  If keep_flagged is set the
+        bestres dataset keeps all the rows plus their qc_flags column, the
+        other datasets are built from the rows passing the QC rules.
         """
 
-        # remove bad gps fixes
-        logging.debug("Culling bad NMEA fixes")
-        self._data = self._data[self._data['nmea_quality'].between(1,3)]
+        if self._planned():
+            self._plan.qc(self._delta_t_threshold.total_seconds(), self._horizontal_speed_threshold, self._horzontal_acceleration_threshold, keep_flagged)
+            return
 
-        # remove bad cksums
-        logging.debug("Culling bad cksums")
-        self._data = self._data[self._data['valid_cksum'] == 1]
+        logging.debug("Culling data failing the QC rules")
+        flags = qc_flags(self._data, self._delta_t_threshold.total_seconds(), self._horizontal_speed_threshold, self._horzontal_acceleration_threshold)
+        passed = (flags & np.uint8(QC_EXPORT_MASK)) == 0
 
-        # remove bad sequence data points
-        logging.debug("Culling out-of-sequence data")
-        self._data = self._data[self._data['valid_order'] == 1]
+        logging.debug("Rows failing the QC rules: %d", len(passed) - np.count_nonzero(passed))
 
-        # remove bad speeds
-        logging.debug("Culling data exceeding speed threshold")
-        self._data = self._data[self._data['speed_made_good'] <= self._horizontal_speed_threshold]
+        if keep_flagged:
+            self._flagged_data = self._data.assign(**{QC_COL: flags})
 
-        # remove bad accelerations
-        logging.debug("Culling data exceeding acceleration threshold")
-        self._data = self._data[self._data['acceleration'] <= self._horzontal_acceleration_threshold]
+        self._data = self._data[passed]
+        self._control_ranking = None
 
 
-    def build_bestres(self):
+    def bestres_template(self, keep_flagged=None):
         """
-        Build the bestres dataset from the NavExport dataframe
+        Return the geocsv header template of the bestres dataset, including
+        the qc_flags column and bit definitions if the flagged rows are kept
+        (default: if apply_qc kept the flagged rows)
         """
 
-        drop_columns = [x for x in list(self._data.columns) if x not in bestres_cols]
-        logging.debug("Dropping columns: %s", drop_columns)
-        self._data = self._data.drop(drop_columns, axis = 1)
+        if keep_flagged is None:
+            self.execute()
+            keep_flagged = self._flagged_data is not None
+
+        if not keep_flagged:
+            return bestres_header
+
+        header = copy.deepcopy(bestres_header)
+        for key, value in [('field_unit', '(unitless)'), ('field_type', 'integer'), ('field_standard_name', QC_COL), ('field_long_name', 'QC flags bitmask')]:
+            header[key] += ',' + value
+
+        header['qc_flags'] = ','.join(["{}={}".format(name, bit) for name, bit in QC_FLAGS.items()])
+        header['qc_thresholds'] = 'delta_t={},speed={},acceleration={}'.format(self._delta_t_threshold.total_seconds(), self._horizontal_speed_threshold, self._horzontal_acceleration_threshold)
+
+        return header
+
+
+    def bestres_data(self):
+        """
+        Return the bestres dataset without modifying the NavExport dataframe,
+        with the qc_flags column if the flagged rows are kept (see apply_qc)
+        """
+
+        self.execute()
+        data = self._data if self._flagged_data is None else self._flagged_data
+
+        columns = [x for x in list(data.columns) if x in bestres_cols]
+        if self._flagged_data is not None:
+            columns.append(QC_COL)
+
+        logging.debug("Selecting columns: %s", columns)
 
         logging.debug("Rounding data: %s", rounding)
-        self._data = self._round_data(self._data, rounding)
+        return self._round_data(data[columns], rounding)
+
+
+    def build_bestres(self):
+        """
+        Build the bestres dataset from the NavExport dataframe
+        """
 
         # Update geocsv header
-        self._geocsv_header = bestres_header
+        self._geocsv_header = self.bestres_template()
+
+        self._data = self.bestres_data()
+        self._flagged_data = None
+
+
+    def iter_bestres(self, chunk_size=CHUNK_SIZE):
+        """
+        Stream the bestres dataset of the planned steps (see read_r2rnavfile)
+        without loading it into memory, yields the bestres rows of each
+        chunk of up to chunk_size input rows.  The chunks written with
+        write_csv_chunks are identical to the bestres dataset built in
+        memory, the bestres columns are scanned before streaming to find the
+        dtypes the in memory dataset would have.  The NavExport dataframe is
+        not modified.
+        """
+
+        if not self._planned():
+            logging.error("The bestres dataset can only be streamed from the planned steps")
+            raise ValueError("The r2rnav file has already been read")
+
+        self._plan.project(bestres_cols)
+        dtypes = self._plan.scan_dtypes(bestres_cols, chunk_size)
+
+        for data, flagged in self._plan.iter_execute(chunk_size):
+            data = data if flagged is None else flagged
+
+            columns = [x for x in list(data.columns) if x in bestres_cols]
+            if flagged is not None:
+                columns.append(QC_COL)
+
+            yield self._round_data(data[columns].astype({col: dtypes[col] for col in columns if col in dtypes}), rounding)
+
+        logging.debug("Executed plan:\n%s", self._plan.explain())
+
+
+    def onemin_data(self):
+        """
+        Return the 1min dataset without modifying the NavExport dataframe, the
+        first fix with a position in each minute.  Only the minutes containing fixes are
+        visited so gaps (i.e. port calls) cost nothing, the speed and course
+        are calculated from the selected fixes.
+        """
+
+        self.execute()
+
+        logging.debug('Subsampling data...')
+        iso_time = self._data['iso_time'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+        longitude = self._data['ship_longitude'].to_numpy(dtype=np.float64)
+        latitude = self._data['ship_latitude'].to_numpy(dtype=np.float64)
+
+        rows = np.flatnonzero((iso_time != NAT_INT) & ~np.isnan(longitude) & ~np.isnan(latitude))
+        minutes = iso_time[rows] // ONE_MINUTE_NS
+
+        if minutes.size > 0 and np.all(minutes[1:] >= minutes[:-1]):
+            first = np.flatnonzero(np.diff(minutes, prepend=minutes[0] - 1) != 0)
+        else:
+            _, first = np.unique(minutes, return_index=True)
+
+        rows = rows[first]
+        minutes = minutes[first]
+        longitude = longitude[rows]
+        latitude = latitude[rows]
+
+        # Calculate speed_made_good and course_made_good columns
+        logging.debug("Building speed_made_good and course_made_good columns...")
+        speed_made_good = np.full(rows.size, np.nan)
+        course_made_good = np.full(rows.size, np.nan)
+
+        if rows.size > 1:
+            speed_made_good[1:] = great_circle_distances(latitude, longitude) * 1000 / (np.diff(minutes) * 60)
+            course_made_good[1:] = calculate_bearings(latitude, longitude)
+
+        data = pd.DataFrame({
+            'iso_time': pd.to_datetime(minutes * ONE_MINUTE_NS),
+            'ship_longitude': longitude,
+            'ship_latitude': latitude,
+            'speed_made_good': speed_made_good,
+            'course_made_good': course_made_good
+        }, columns=onemin_cols)
+
+        logging.debug("Rounding data: %s", rounding)
+        return self._round_data(data, rounding)
 
 
     def build_1min(self):
@@ -521,91 +1333,198 @@ class NavExport():
         Build the 1min dataset from the NavExport dataframe
         """
 
-        drop_columns = [x for x in list(self._data.columns) if x not in onemin_cols]
-        logging.debug("Dropping columns: %s", drop_columns)
-        self._data = self._data.drop(drop_columns, axis = 1)
+        self._data = self.onemin_data()
 
-        logging.debug('Subsampling data...')
-        self._data.set_index('iso_time',inplace=True)
-        self._data = self._data.resample('1T', label='left', closed='left').first()
-        self._data.reset_index(inplace=True)
-        self._data.dropna(inplace=True, thresh=4)
+        # Update geocsv header
+        self._geocsv_header = onemin_header
 
-        # Calculate deltaT column
-        logging.debug('Building deltaT column...')
-        self._data = self._data.join(self._data['iso_time'].diff().to_frame(name='deltaT'))
 
-        # Calculate distance column
-        logging.debug("Building distance column...")
-        self._data['point'] = self._data.apply(lambda row: Point(latitude=row['ship_latitude'], longitude=row['ship_longitude']), axis=1)
-        self._data['point_next'] = self._data['point'].shift(1)
-        self._data.loc[self._data['point_next'].isna(), 'point_next'] = None
+    @staticmethod
+    def decimated_header(interval, rule='first'):
+        """
+        Return the geocsv header template of the decimated dataset
+        """
 
-        self._data['distance'] = self._data.apply(lambda row: great_circle(row['point'], row['point_next']).km if row['point_next'] is not None else float('nan'), axis=1)
+        header = copy.deepcopy(decimated_header)
+        header['title'] = "{} {} ({})".format(decimated_header['title'], interval, rule)
+        header['decimation_interval'] = interval
+        header['decimation_rule'] = rule
 
-        # Calculate speed_made_good column
-        logging.debug("Building speed_made_good column...")
-        self._data['speed_made_good'] = (self._data['distance'] * 1000) / self._data.deltaT.dt.total_seconds()
+        return header
 
-        # Calculate course_made_good column
-        logging.debug("Building course_made_good column...")
-        self._data['course_made_good'] = self._data.apply(lambda row: calculate_bearing(tuple(row['point']), tuple(row['point_next'])) if row['point_next'] is not None else float('nan'), axis=1)
 
-        self._data = self._data.drop('point_next', axis=1)
-        self._data = self._data.drop('point', axis=1)
-        self._data = self._data.drop('distance', axis=1)
-        self._data = self._data.drop('deltaT', axis=1)
+    def decimated_data(self, interval, rule='first'):
+        """
+        Return a decimated dataset without modifying the NavExport dataframe,
+        one fix per interval (i.e. 10s, 5min, 500m, 100pts, see
+        parse_interval) selected with the rule: first, center or mean
+        """
+
+        self.execute()
+
+        interval_type, interval_value = parse_interval(interval)
+
+        logging.debug('Decimating data to one fix per %s (%s)...', interval, rule)
+        data = decimate(self._data, interval_type, interval_value, rule)
 
         logging.debug("Rounding data: %s", rounding)
-        self._data = self._round_data(self._data, rounding)
+        return self._round_data(data, rounding)
+
+
+    def build_decimated(self, interval, rule='first'):
+        """
+        Build a decimated dataset from the NavExport dataframe, see
+        decimated_data
+        """
+
+        self._data = self.decimated_data(interval, rule)
 
         # Update geocsv header
-        self._geocsv_header = onemin_header
+        self._geocsv_header = self.decimated_header(interval, rule)
 
 
-    def build_control(self):
+    def rank_control(self, epsilons=None, budgets=None):
         """
-        Build the control dataset from the NavExport dataframe
+        Rank the control points of the NavExport dataframe once for all the
+        epsilons and point budgets (maximum number of points) that will be
+        built with build_control/control_data
         """
 
-        drop_columns = [x for x in list(self._data.columns) if x not in control_cols]
-        logging.debug("Dropping columns: %s", drop_columns)
-        self._data = self._data.drop(drop_columns, axis = 1)
+        self.execute()
 
-        # run rdp algorithim
-        logging.debug("Building control coordinates using RDP algorithim")
-        coords = self._data.filter(['ship_longitude','ship_latitude'], axis=1).to_numpy()
-        control = rdp(coords, epsilon=RDP_EPSILON)
+        min_epsilon = min(epsilons) if epsilons else None
+        max_points = max(budgets) if budgets else None
 
-        logging.debug("Length of full-res coordinates: %d", len(self._data.index))
-        logging.debug("Length of control coordinates: %d", control.shape[0])
+        logging.debug("Ranking control points using RDP algorithim")
+        coords = self._data[['ship_longitude','ship_latitude']].to_numpy(dtype=np.float64)
+        self._control_ranking = (min_epsilon, max_points) + rdp_ranking(coords, min_epsilon, max_points)
+
+
+    def _ranking(self, epsilon=None, max_points=None):
+        """
+        Return the control point ranking, the points are ranked again if the
+        current ranking does not cover the epsilon and/or point budget
+        """
+
+        ranking = self._control_ranking
+        if ranking is None or (epsilon is not None and (ranking[0] is None or ranking[0] > epsilon)) or (max_points is not None and (ranking[1] is None or ranking[1] < max_points)):
+            self.rank_control([epsilon] if epsilon is not None else None, [max_points] if max_points is not None else None)
+            ranking = self._control_ranking
+
+        return ranking
+
+
+    def control_data(self, epsilon=None, max_points=None):
+        """
+        Return the control dataset for the epsilon and/or point budget
+        (default: RDP_EPSILON) without modifying the NavExport dataframe
+        """
+
+        if epsilon is None and max_points is None:
+            epsilon = RDP_EPSILON
+
+        _, _, importance, rank = self._ranking(epsilon, max_points)
+
+        # keep the points meeting both the epsilon and the budget
+        keep = np.ones(len(importance), dtype=bool)
+        if epsilon is not None:
+            keep &= importance > epsilon
+        if max_points is not None:
+            keep &= rank < max_points
+
+        return self._control_rows(keep)
+
+
+    def _control_rows(self, keep):
+        """
+        Return the control dataset of the rows selected by the keep mask
+        """
 
-        control_df = pd.DataFrame(control, columns = ['ship_longitude','ship_latitude'])
+        control = np.flatnonzero(keep)
 
-        self._data = pd.merge(control_df, self._data, on=['ship_longitude','ship_latitude'], how='left')
-        self._data = self._data[control_cols]
+        logging.debug("Length of full-res coordinates: %d", len(self._data.index))
+        logging.debug("Length of control coordinates: %d", control.size)
 
+        # select the control rows by position, exact for repeated positions
         logging.debug("Rounding data: %s", rounding)
-        self._data = self._round_data(self._data, rounding)
+        return self._round_data(self._data.iloc[control][control_cols].reset_index(drop=True), rounding)
+
+
+    def build_control(self, epsilon=None, max_points=None):
+        """
+        Build the control dataset from the NavExport dataframe for the epsilon
+        and/or point budget, default: RDP_EPSILON
+        """
+
+        self._data = self.control_data(epsilon, max_points)
+        self._control_ranking = None
 
         # Update geocsv header
         self._geocsv_header = control_header
 
 
-    def geocsv_header(self, custom_meta = None):
+    def pyramid_levels(self, factor=PYRAMID_FACTOR, min_points=PYRAMID_MIN_POINTS):
+        """
+        Return the number of points in each level of the track pyramid, the
+        full track followed by 1/factor, 1/factor^2... of the points for as
+        long as a level has at least min_points points
+        """
+
+        self.execute()
+
+        if factor < 2:
+            logging.error("Invalid pyramid factor: %s", factor)
+            raise ValueError("The pyramid factor must be at least 2")
+
+        levels = [len(self._data.index)]
+        while levels[-1] // factor >= max(min_points, 2):
+            levels.append(levels[-1] // factor)
+
+        return levels
+
+
+    def pyramid_data(self, factor=PYRAMID_FACTOR, min_points=PYRAMID_MIN_POINTS):
+        """
+        Generate the levels of the track pyramid, full resolution first, as
+        (tolerance, dataframe) tuples.  The levels are cut from one control
+        point ranking so each level is a subset of the previous one, the
+        tolerance of a level is the importance of the most important point
+        dropped (the RDP epsilon in degrees the level satisfies).
+        """
+
+        levels = self.pyramid_levels(factor, min_points)
+
+        yield 0.0, self._round_data(self._data[control_cols].reset_index(drop=True), rounding)
+
+        if len(levels) < 2:
+            return
+
+        # rank one point past the largest level to know its tolerance
+        _, _, importance, rank = self._ranking(max_points=levels[1] + 1)
+
+        for max_points in levels[1:]:
+            dropped = importance[rank == max_points]
+
+            yield float(dropped[0]) if dropped.size else 0.0, self._control_rows(rank < max_points)
+
+
+    def geocsv_header(self, custom_meta = None, template = None):
         """
         Build the geocsv header, apply any custom metadata and return it as a
-        string.
+        string.  The header of the last product built is used unless a
+        template is specified.
         """
 
+        template = template if template is not None else self._geocsv_header
+
         geocsv_header = ""
 
-        for key, _ in self._geocsv_header.items():
+        for key, _ in template.items():
             if custom_meta and key in custom_meta:
                 geocsv_header += "#{}: {}\n".format(key, custom_meta[key])
 
             else:
-                geocsv_header += "#{}: {}\n".format(key, self._geocsv_header[key])
+                geocsv_header += "#{}: {}\n".format(key, template[key])
 
         return geocsv_header
 
@@ -614,10 +1533,7 @@ class NavExport():
         '''
         Output self._data in csv format.
         '''
-        output = StringIO()
-        self._data.to_csv(output, index=False, na_rep='NAN')
-        output.seek(0)
-        print(output.read())
+        write_csv(self.data, sys.stdout.buffer, na_rep='NAN', date_format=None, precision=rounding)
 
 
 class NavParser():
@@ -631,7 +1547,9 @@ class NavParser():
         self._example_data = example_data
         self._parse_cols = parse_cols
         self._file_report = []
+        self._report = None
         self._df_proc = pd.DataFrame()
+        self._qc_thresholds = None
 
 
     @property
@@ -682,6 +1600,33 @@ class NavParser():
         return self._df_proc
 
 
+    @property
+    def report(self):
+        '''
+        Getter function for self._report, the NavInfoReport of the last
+        parsed file
+        '''
+        return self._report
+
+
+    @property
+    def qc_thresholds(self):
+        '''
+        Getter function for self._qc_thresholds, the thresholds of the
+        qc_flags column (None until build_qc_flags is called)
+        '''
+        return self._qc_thresholds
+
+
+    @property
+    def source_files(self):
+        '''
+        Getter function for the source logger files, the [filename, startTS,
+        endTS] of each parsed file with data
+        '''
+        return [[basename(report.filename), report.start_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), report.end_ts.strftime("%Y-%m-%dT%H:%M:%S.%fZ")] for report in self._file_report if report.start_ts is not None]
+
+
     def parse_file(self, filepath):
         """
         Process the given file.  This function must be overrided by subclasses
@@ -689,6 +1634,15 @@ class NavParser():
         raise NotImplementedError('process_file must be implemented by subclass')
 
 
+    def new_file_report(self, filepath):
+        """
+        Start the NavInfoReport for the file being parsed.  Parsers update the
+        report as each line is decoded so it is complete when parsing finishes.
+        """
+        self._report = NavInfoReport(filepath)
+        return self._report
+
+
     def add_file_report(self, file_report):
         """
         Append the file_report to the NavParser's array of file reports.
@@ -755,6 +1709,20 @@ class NavParser():
         self._df_proc = self._df_proc.drop('speed_next', axis=1)
 
 
+    def build_qc_flags(self, delta_t_threshold=MAX_DELTA_T, speed_threshold=MAX_SPEED, acceleration_threshold=MAX_ACCEL):
+        """
+        Add the qc_flags column, one bit per QC rule (see nav_qc), to the
+        processed dataframe.  The thresholds are recorded in the dataframe
+        attrs and should be saved with the data.
+        """
+
+        self._qc_thresholds = qc_thresholds(delta_t_threshold, speed_threshold, acceleration_threshold)
+
+        logging.debug("Building qc_flags column...")
+        self._df_proc[QC_COL] = build_qc_flags(self._df_proc, delta_t_threshold, speed_threshold, acceleration_threshold)
+        self._df_proc.attrs['qc_thresholds'] = self._qc_thresholds
+
+
     def crop_data(self, start_ts=None, end_ts=None):
         """
         Crop the dataframe to the start/end timestamps specified.
@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_monitor.py
+ DESCRIPTION:  Rolling window navqa monitor used to QA navigation data as it
+               is logged.
+
+        BUGS:
+       NOTES:  Fixes are added one at a time and only the fixes within the
+               window (the last N seconds of data) are reported.  The window
+               min/max values are kept in monotonic deques and the error
+               counts are kept with the fixes in the window and decremented
+               when the fixes expire, so adding a fix is amortized O(1).  The
+               epoch counts are runs of epoch bins, as in scan_nav_data, the
+               run starting before the window is counted once.  The
+               distributions are kept as one quantile sketch per bucket of
+               time (DISTRIBUTION_BUCKET), the expired buckets are dropped and
+               the live buckets are merged when a report is requested, so the
+               distributions cover the window rounded out to whole buckets.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-20
+    REVISION:  2021-05-20
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import math
+import logging
+from collections import deque
+
+import numpy as np
+import pandas as pd
+from geopy.distance import great_circle
+
+from lib.nav_manager import NavQAReport, MAX_DELTA_T, MAX_SPEED, MAX_ACCEL
+from lib.nav_sketch import QuantileSketch
+from lib.nav_stats import median_interval, complete_epochs, DISTRIBUTION_METRICS
+
+WINDOW = 600 # seconds
+
+EPOCH_INTERVAL_FIXES = 60
+
+DISTRIBUTION_BUCKET = 60 # seconds
+
+# The QA error counted for each fix
+ERRORS = ['delta_t', 'out_of_sequence', 'nmea_quality', 'speed', 'acceleration', 'parse', 'cksum']
+
+# The errors that flag a fix (not countable for the epoch completeness)
+FLAGS = ['out_of_sequence', 'nmea_quality', 'speed', 'acceleration', 'parse', 'cksum']
+
+EXTREMA = ['longitude', 'latitude', 'antenna_height', 'speed', 'acceleration', 'nsv', 'hdop', 'delta_t']
+
+
+def _float(value):
+    """
+    Return the value as a float, nan if missing
+    """
+
+    if value is None or value == '':
+        return np.nan
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _time(value):
+    """
+    Return the timestamp as int64 ns, None if missing
+    """
+
+    if value is None or value == '':
+        return None
+
+    timestamp = pd.Timestamp(value)
+
+    if timestamp is pd.NaT:
+        return None
+
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert(None)
+
+    return timestamp.value
+
+
+class _WindowExtrema():
+    """
+    Min/max of the values in the window using monotonic deques
+    """
+
+    def __init__(self):
+        self._min = deque()
+        self._max = deque()
+
+
+    def push(self, seq, value):
+        '''
+        Add the value of fix seq, missing values (None/nan) are ignored
+        '''
+
+        if value is None or value != value: # pylint: disable=comparison-with-itself
+            return
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((seq, value))
+
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((seq, value))
+
+
+    def expire(self, seq):
+        '''
+        Remove the values of the fixes up to and including seq
+        '''
+
+        while self._min and self._min[0][0] <= seq:
+            self._min.popleft()
+
+        while self._max and self._max[0][0] <= seq:
+            self._max.popleft()
+
+
+    def min_max(self, missing):
+        '''
+        Return [min, max], [missing, missing] if the window has no values
+        '''
+
+        if not self._min:
+            return [missing, missing]
+
+        return [self._min[0][1], self._max[0][1]]
+
+
+class _WindowRuns():
+    """
+    Number of runs of equal consecutive epoch bins in the window
+    """
+
+    def __init__(self):
+        self._bins = deque()
+        self._runs = 0
+
+
+    def push(self, seq, epoch_bin):
+        '''
+        Add the epoch bin of fix seq
+        '''
+
+        new_run = not self._bins or self._bins[-1][1] != epoch_bin
+        self._bins.append((seq, epoch_bin, new_run))
+        self._runs += new_run
+
+
+    def expire(self, seq):
+        '''
+        Remove the bins of the fixes up to and including seq
+        '''
+
+        while self._bins and self._bins[0][0] <= seq:
+            self._runs -= self._bins.popleft()[2]
+
+
+    @property
+    def runs(self):
+        '''
+        Getter method for the number of runs, the run continuing from before
+        the window is counted
+        '''
+
+        if not self._bins:
+            return 0
+
+        return self._runs + (not self._bins[0][2])
+
+
+    @property
+    def first_last(self):
+        '''
+        Getter method for the first/last bins
+        '''
+
+        if not self._bins:
+            return [None, None]
+
+        return [self._bins[0][1], self._bins[-1][1]]
+
+
+class _WindowSketches():
+    """
+    Quantile sketches of the values in the window, one sketch per metric per
+    bucket of time.  The values of the current bucket are kept until the
+    bucket is closed.
+    """
+
+    def __init__(self, bucket):
+
+        # The bucket length in ns
+        self._bucket = bucket
+
+        # The closed buckets: (bucket, {metric: sketch})
+        self._sketches = deque()
+
+        # The current bucket and its values
+        self._current = None
+        self._values = {metric: [] for metric in DISTRIBUTION_METRICS}
+
+
+    def _close(self):
+        '''
+        Sketch the values of the current bucket
+        '''
+
+        if self._current is not None:
+            self._sketches.append((self._current, {metric: QuantileSketch().add(values) for metric, values in self._values.items()}))
+
+        self._values = {metric: [] for metric in DISTRIBUTION_METRICS}
+
+
+    def push(self, stamp, values):
+        '''
+        Add the values (dict of metric: value) of the fix with the window
+        stamp
+        '''
+
+        current = stamp // self._bucket
+
+        if current != self._current:
+            self._close()
+            self._current = current
+
+        for metric, value in values.items():
+            self._values[metric].append(value)
+
+
+    def expire(self, cutoff):
+        '''
+        Remove the buckets ending at or before the cutoff (ns)
+        '''
+
+        while self._sketches and (self._sketches[0][0] + 1) * self._bucket <= cutoff:
+            self._sketches.popleft()
+
+        if self._current is not None and (self._current + 1) * self._bucket <= cutoff:
+            self._current = None
+            self._values = {metric: [] for metric in DISTRIBUTION_METRICS}
+
+
+    @property
+    def distributions(self):
+        '''
+        Getter method for the merged sketches of the live buckets
+        '''
+
+        return {metric: QuantileSketch.combined([QuantileSketch().add(values)] + [sketches[metric] for _, sketches in self._sketches]) for metric, values in self._values.items()}
+
+
+class NavQAMonitor(): # pylint: disable=too-many-instance-attributes
+    """
+    Rolling window navqa monitor
+    """
+
+    def __init__(self, name='navmonitor', window=WINDOW, delta_t_threshold=MAX_DELTA_T, speed_threshold=MAX_SPEED, acceleration_threshold=MAX_ACCEL, epoch_interval=None, port_index=None): # pylint: disable=too-many-arguments
+
+        # The name used as the report filename
+        self._name = name
+
+        # The window length in ns
+        self._window = int(round(window * 10**9))
+
+        # The QA thresholds
+        self._delta_t_threshold = delta_t_threshold
+        self._speed_threshold = speed_threshold
+        self._acceleration_threshold = acceleration_threshold
+
+        # The port database (PortIndex) used for the distance from port
+        self._port_index = port_index
+
+        # The nominal epoch interval in ns, inferred from the first fixes if
+        # not specified
+        self._epoch_interval = int(round(epoch_interval * 10**9)) if epoch_interval is not None else None
+        self._interval_samples = []
+
+        # The fixes in the window: (seq, stamp, iso_time, errors, flagged)
+        self._fixes = deque()
+        self._seq = 0
+        self._stamp = None
+
+        # The previous fix
+        self._last_time = None
+        self._last_position = None
+        self._last_speed = np.nan
+
+        # The error counts
+        self._errors = dict.fromkeys(ERRORS, 0)
+
+        # The window min/max
+        self._extrema = {key: _WindowExtrema() for key in EXTREMA}
+
+        # The fixes with a valid time/parse: (seq, iso_time, longitude, latitude)
+        self._times = deque()
+        self._positions = deque()
+
+        # The epoch bins of all the fixes and of the unflagged fixes
+        self._actual = _WindowRuns()
+        self._countable = _WindowRuns()
+
+        # The distributions of the fixes in the window
+        self._sketches = _WindowSketches(min(DISTRIBUTION_BUCKET * 10**9, self._window))
+
+
+    @property
+    def window(self):
+        '''
+        Getter method for the window property (seconds)
+        '''
+        return self._window / 10**9
+
+
+    @property
+    def epoch_interval(self):
+        '''
+        Getter method for the epoch_interval property (seconds)
+        '''
+        return self._epoch_interval / 10**9 if self._epoch_interval is not None else None
+
+
+    @property
+    def total_lines(self):
+        '''
+        Getter method for the number of fixes in the window
+        '''
+        return len(self._fixes)
+
+
+    def _derive(self, fix, iso_time, longitude, latitude):
+        '''
+        Return the deltaT, speed and acceleration of the fix, the speed and
+        acceleration are calculated from the previous fix if the fix does not
+        include speed_made_good.
+        '''
+
+        delta_t = iso_time - self._last_time if iso_time is not None and self._last_time is not None else None
+
+        if 'speed_made_good' in fix:
+            return delta_t, _float(fix['speed_made_good']), _float(fix.get('acceleration'))
+
+        speed = np.nan
+        if delta_t is not None and delta_t > 0 and self._last_position is not None and not (math.isnan(longitude) or math.isnan(latitude)):
+            speed = great_circle((latitude, longitude), self._last_position).m / (delta_t / 10**9)
+
+        acceleration = np.nan
+        if delta_t is not None and delta_t > 0:
+            acceleration = (speed - self._last_speed) / (delta_t / 10**9)
+
+        return delta_t, speed, acceleration
+
+
+    def _count(self, seq, iso_time, flagged):
+        '''
+        Add the fix to the epoch counts
+        '''
+
+        if iso_time is None or self._epoch_interval is None:
+            return
+
+        epoch_bin = (iso_time + self._epoch_interval // 2) // self._epoch_interval
+        self._actual.push(seq, epoch_bin)
+
+        if not flagged:
+            self._countable.push(seq, epoch_bin)
+
+
+    def _infer_interval(self, delta_t):
+        '''
+        Set the epoch interval once enough positive deltaT values are seen and
+        count the epochs of the fixes already in the window
+        '''
+
+        if delta_t is None or delta_t <= 0:
+            return
+
+        self._interval_samples.append(delta_t)
+
+        if len(self._interval_samples) < EPOCH_INTERVAL_FIXES:
+            return
+
+        self._epoch_interval = median_interval(np.array(self._interval_samples, dtype=np.int64))
+        self._interval_samples = []
+        logging.debug("Monitor epoch interval: %s ns", self._epoch_interval)
+
+        for seq, _, iso_time, _, flagged in self._fixes:
+            self._count(seq, iso_time, flagged)
+
+
+    def add_fix(self, fix):
+        '''
+        Add a fix to the monitor.  The fix is a mapping with the r2rnav
+        columns (iso_time, ship_longitude, ship_latitude, nmea_quality, nsv,
+        hdop, antenna_height, valid_cksum, valid_parse and optionally
+        valid_order, speed_made_good and acceleration).  Fixes older than the
+        window are removed.
+        '''
+
+        iso_time = _time(fix.get('iso_time'))
+        longitude = _float(fix.get('ship_longitude'))
+        latitude = _float(fix.get('ship_latitude'))
+        nmea_quality = _float(fix.get('nmea_quality'))
+        valid_parse = _float(fix.get('valid_parse'))
+        valid_cksum = _float(fix.get('valid_cksum'))
+
+        delta_t, speed, acceleration = self._derive(fix, iso_time, longitude, latitude)
+
+        valid_order = _float(fix.get('valid_order'))
+        if math.isnan(valid_order) and delta_t is not None:
+            valid_order = float(delta_t > 0)
+
+        errors = {
+            'delta_t': delta_t is not None and delta_t > self._delta_t_threshold * 10**9,
+            'out_of_sequence': valid_order == 0,
+            'nmea_quality': not 1 <= nmea_quality <= 3,
+            'speed': speed > self._speed_threshold,
+            'acceleration': acceleration > self._acceleration_threshold,
+            'parse': valid_parse == 0,
+            'cksum': valid_cksum == 0
+        }
+        flagged = any(errors[key] for key in FLAGS)
+
+        for key, error in errors.items():
+            self._errors[key] += error
+
+        # The window is kept in arrival order, the stamp is the latest
+        # timestamp seen
+        self._seq += 1
+        seq = self._seq
+        if iso_time is not None and (self._stamp is None or iso_time > self._stamp):
+            self._stamp = iso_time
+
+        self._fixes.append((seq, self._stamp, iso_time, errors, flagged))
+
+        for key, value in zip(EXTREMA, [longitude, latitude, _float(fix.get('antenna_height')), speed, acceleration, _float(fix.get('nsv')), _float(fix.get('hdop')), delta_t]):
+            self._extrema[key].push(seq, value)
+
+        if iso_time is not None:
+            self._times.append((seq, iso_time))
+
+        if self._stamp is not None:
+            self._sketches.push(self._stamp, {'speed': speed, 'acceleration': acceleration, 'hdop': _float(fix.get('hdop')), 'nsv': _float(fix.get('nsv')), 'delta_t': delta_t / 10**9 if delta_t is not None else np.nan})
+
+        if valid_parse == 1:
+            self._positions.append((seq, iso_time, longitude, latitude))
+
+        if self._epoch_interval is None:
+            self._infer_interval(delta_t)
+        else:
+            self._count(seq, iso_time, flagged)
+
+        # The previous fix
+        self._last_time = iso_time
+        if not (math.isnan(longitude) or math.isnan(latitude)):
+            self._last_position = (latitude, longitude)
+        self._last_speed = speed
+
+        self._expire()
+
+
+    def _expire(self):
+        '''
+        Remove the fixes older than the window
+        '''
+
+        if self._stamp is None:
+            return
+
+        cutoff = self._stamp - self._window
+        expired = None
+
+        self._sketches.expire(cutoff)
+
+        while self._fixes and (self._fixes[0][1] is None or self._fixes[0][1] <= cutoff):
+            expired, _, _, errors, _ = self._fixes.popleft()
+
+            for key, error in errors.items():
+                self._errors[key] -= error
+
+        if expired is None:
+            return
+
+        for extrema in self._extrema.values():
+            extrema.expire(expired)
+
+        for fixes in [self._times, self._positions]:
+            while fixes and fixes[0][0] <= expired:
+                fixes.popleft()
+
+        self._actual.expire(expired)
+        self._countable.expire(expired)
+
+
+    @property
+    def stats(self):
+        '''
+        Getter method for the statistics of the window, in the format
+        returned by scan_nav_data
+        '''
+
+        stats = {
+            'total_lines': len(self._fixes),
+            'parse_errors': self._errors['parse'],
+            'first_valid': list(self._positions[0][1:]) if self._positions else None,
+            'last_valid': list(self._positions[-1][1:]) if self._positions else None,
+            'first_epoch': self._times[0][1] if self._times else None,
+            'last_epoch': self._times[-1][1] if self._times else None,
+            'distributions': self._sketches.distributions
+        }
+
+        for key in EXTREMA:
+            stats[key] = self._extrema[key].min_max(None if key == 'delta_t' else np.nan)
+
+        for key in ERRORS:
+            stats[key + '_errors'] = self._errors[key]
+
+        stats.update({
+            'epoch_interval': self._epoch_interval,
+            'epoch_bins': self._actual.first_last,
+            'actual_epochs': self._actual.runs if self._epoch_interval is not None else None,
+            'countable_epochs': self._countable.runs if self._epoch_interval is not None else None
+        })
+
+        return complete_epochs(stats)
+
+
+    def report(self):
+        '''
+        Return the NavQAReport of the window, None if the window is empty
+        '''
+
+        if not self._fixes:
+            return None
+
+        report = NavQAReport(self._name, self._delta_t_threshold, self._speed_threshold, self._acceleration_threshold, port_index=self._port_index)
+        report.load_stats(self.stats)
+
+        return report
+
+
+    def to_json(self):
+        '''
+        Return the NavQAReport json of the window, None if the window is empty
+        '''
+
+        report = self.report()
+        return report.to_json() if report is not None else None
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_plan.py
+ DESCRIPTION:  Lazy execution plan of the steps building the navexport
+               dataframe: read, cull bad parses, crop, QC and select columns.
+
+        BUGS:
+       NOTES:  The steps are recorded and executed once, when the data is
+               first used.  The optimizer pushes the crop windows into the
+               reader (only the shards/blocks overlapping the window are
+               read), reads only the columns the products and the QC rules
+               need and fuses the cull, crop and QC masks into one filter
+               applied to each chunk as it is read, so the unfiltered
+               dataset is never held in memory.  The filtered rows keep the
+               dtypes of the full read (see combine_dtypes).
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-24
+    REVISION:  2021-05-24
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+
+from lib.utils import iter_r2rnavfile, read_r2rnav_columns, read_r2rnav_metadata, combine_dtypes, r2rnav_dtypes
+from lib.nav_qc import QC_COL, QC_EXPORT_MASK, qc_columns, qc_flags
+
+PLAN_CHUNK_SIZE = 500000 # rows
+
+
+def _intersect(window, start_ts=None, end_ts=None):
+    """
+    Return the intersection of the (start_ts, end_ts) window and the
+    start/end timestamps, None is unbounded
+    """
+
+    if start_ts is not None:
+        start_ts = start_ts if window[0] is None else max(window[0], start_ts)
+
+    if end_ts is not None:
+        end_ts = end_ts if window[1] is None else min(window[1], end_ts)
+
+    return (window[0] if start_ts is None else start_ts, window[1] if end_ts is None else end_ts)
+
+
+class ExportPlan():
+    """
+    Lazy plan of the steps building the NavExport dataframe
+    """
+
+    def __init__(self, filename, file_format='csv', start_ts=None, end_ts=None):
+
+        self._filename = filename
+        self._file_format = file_format
+
+        # The logical plan, the steps as (step, arguments) tuples
+        self._steps = [('read', {'start_ts': start_ts, 'end_ts': end_ts}), ('cull', {})]
+
+        # The optimized plan, see optimize
+        self._optimized = None
+
+        # The combined dtypes of the rows read, see combine_dtypes
+        self._dtypes = {}
+
+        # The row counts and timing of the last execution
+        self._stats = None
+
+
+    @property
+    def steps(self):
+        '''
+        Getter function for self.
+        '''
+        return self._steps
+
+
+    @property
+    def stats(self):
+        '''
+        Getter function for self.
+        '''
+        return self._stats
+
+
+    def _add_step(self, step, args):
+        """
+        Add a step to the logical plan
+        """
+
+        self._steps.append((step, args))
+        self._optimized = None
+
+
+    def crop(self, start_ts=None, end_ts=None):
+        """
+        Crop the rows to the start/end timestamps
+        """
+
+        self._add_step('crop', {'start_ts': start_ts, 'end_ts': end_ts})
+
+
+    def qc(self, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None, keep_flagged=False): # pylint: disable=invalid-name
+        """
+        Remove the rows with any of the QC_EXPORT_MASK flags set, if
+        keep_flagged is set the rows passing the previous steps are also
+        returned with their qc_flags column
+        """
+
+        self._add_step('qc', {'delta_t_threshold': delta_t_threshold, 'speed_threshold': speed_threshold, 'acceleration_threshold': acceleration_threshold, 'keep_flagged': keep_flagged})
+
+
+    def project(self, columns):
+        """
+        Select the columns, the columns of all the project steps are kept
+        """
+
+        if ('project', {'columns': list(columns)}) not in self._steps:
+            self._add_step('project', {'columns': list(columns)})
+
+
+    def optimize(self):
+        """
+        Return the optimized plan, a dict of: window (start_ts, end_ts) of
+        the shards/blocks read, the columns read (None for all the columns),
+        the crop window of the rows, the QC steps and the r2rnav metadata
+        """
+
+        if self._optimized is not None:
+            return self._optimized
+
+        window = (None, None)
+        crop = (None, None)
+        qc_steps = []
+        projection = None
+
+        for step, args in self._steps:
+            if step == 'read':
+                window = (args['start_ts'], args['end_ts'])
+            elif step == 'crop':
+                crop = _intersect(crop, args['start_ts'], args['end_ts'])
+            elif step == 'qc':
+                qc_steps.append(args)
+            elif step == 'project':
+                projection = (projection or []) + [col for col in args['columns'] if col not in (projection or [])]
+
+        metadata = read_r2rnav_metadata(self._filename, self._file_format)
+
+        # only the columns selected plus the columns the predicates read
+        columns = None
+        file_columns = read_r2rnav_columns(self._filename, self._file_format) if projection is not None else None
+
+        if file_columns is not None:
+            columns = projection + ['valid_parse']
+
+            if crop != (None, None):
+                columns.append('iso_time')
+
+            for args in qc_steps:
+                columns += qc_columns(file_columns, metadata, args['delta_t_threshold'], args['speed_threshold'], args['acceleration_threshold'])
+
+            columns = [col for col in file_columns if col in columns]
+
+        self._optimized = {
+            'window': _intersect(window, *crop),
+            'columns': columns,
+            'file_columns': file_columns,
+            'crop': crop,
+            'qc': qc_steps,
+            'metadata': metadata
+        }
+
+        return self._optimized
+
+
+    def scan_dtypes(self, columns=None, chunk_size=PLAN_CHUNK_SIZE):
+        """
+        Return the dtypes of the columns of the rows read by the plan (before
+        they are filtered), see r2rnav_dtypes
+        """
+
+        plan = self.optimize()
+        return r2rnav_dtypes(self._filename, self._file_format, start_ts=plan['window'][0], end_ts=plan['window'][1], chunk_size=chunk_size, columns=columns)
+
+
+    def _filter(self, chunk, plan):
+        """
+        Return the fused mask of the cull/crop steps, the fused mask of all
+        the steps and the qc_flags of the last QC step (None without QC) of
+        the chunk rows
+        """
+
+        selected = chunk['valid_parse'].to_numpy() == 1
+        self._stats['parsed'] += int(np.count_nonzero(selected))
+
+        if plan['crop'][0] is not None:
+            selected &= (chunk['iso_time'] >= plan['crop'][0]).to_numpy()
+
+        if plan['crop'][1] is not None:
+            selected &= (chunk['iso_time'] <= plan['crop'][1]).to_numpy()
+
+        self._stats['cropped'] += int(np.count_nonzero(selected))
+
+        passed = selected
+        flags = None
+
+        for idx, args in enumerate(plan['qc']):
+            flags = qc_flags(chunk, args['delta_t_threshold'], args['speed_threshold'], args['acceleration_threshold'])
+            if idx < len(plan['qc']) - 1:
+                selected = selected & ((flags & np.uint8(QC_EXPORT_MASK)) == 0)
+
+            passed = passed & ((flags & np.uint8(QC_EXPORT_MASK)) == 0)
+
+        self._stats['passed'] += int(np.count_nonzero(passed))
+
+        return selected, passed, flags
+
+
+    def iter_execute(self, chunk_size=PLAN_CHUNK_SIZE):
+        """
+        Execute the optimized plan chunk by chunk, yields the rows passing all
+        the steps and the flagged rows (None unless the last QC step keeps
+        the flagged rows) of each chunk.  The rows keep the dtypes of the
+        chunk they are read from, see execute.
+        """
+
+        plan = self.optimize()
+        keep_flagged = bool(plan['qc']) and plan['qc'][-1]['keep_flagged']
+
+        self._dtypes = {}
+        self._stats = {'chunks': 0, 'scanned': 0, 'parsed': 0, 'cropped': 0, 'passed': 0, 'seconds': 0.0}
+        start = time.time()
+
+        for chunk in iter_r2rnavfile(self._filename, self._file_format, start_ts=plan['window'][0], end_ts=plan['window'][1], chunk_size=chunk_size, columns=plan['columns']):
+            combine_dtypes(self._dtypes, chunk)
+            self._stats['chunks'] += 1
+            self._stats['scanned'] += len(chunk.index)
+
+            selected, passed, flags = self._filter(chunk, plan)
+
+            flagged = chunk[selected].assign(**{QC_COL: flags[selected]}) if keep_flagged else None
+
+            self._stats['seconds'] = time.time() - start
+            yield chunk[passed], flagged
+
+        self._stats['seconds'] = time.time() - start
+
+
+    def _restore_dtypes(self, data, exclude=None):
+        """
+        Cast the columns of the dataframe built from several chunks to the
+        dtypes of the full read
+        """
+
+        dtypes = {col: dtype for col, dtype in self._dtypes.items() if col in data.columns and col != exclude and data[col].dtype != dtype}
+        return data.astype(dtypes) if dtypes else data
+
+
+    def execute(self, chunk_size=PLAN_CHUNK_SIZE):
+        """
+        Execute the optimized plan once.  Returns the dataframe of the rows
+        passing all the steps and the dataframe of the flagged rows (None
+        unless the last QC step keeps the flagged rows), None, None if no
+        data could be read.
+        """
+
+        passed = []
+        flagged = []
+
+        for data, flagged_data in self.iter_execute(chunk_size):
+            passed.append(data)
+            if flagged_data is not None:
+                flagged.append(flagged_data)
+
+        logging.debug("Executed plan:\n%s", self.explain())
+
+        if not passed:
+            return None, None
+
+        metadata = self.optimize()['metadata']
+
+        data = self._restore_dtypes(pd.concat(passed, ignore_index=True))
+        data.attrs.update(metadata)
+
+        if not flagged:
+            return data, None
+
+        flagged = self._restore_dtypes(pd.concat(flagged, ignore_index=True), exclude=QC_COL)
+        flagged.attrs.update(metadata)
+
+        return data, flagged
+
+
+    def explain(self):
+        """
+        Return the logical plan, the optimized plan and the row counts of the
+        last execution as a string
+        """
+
+        def _window(window):
+            return "{} - {}".format(*["{}".format(ts) if ts is not None else '*' for ts in window])
+
+        lines = ["Logical plan:"]
+        for step, args in self._steps:
+            if step == 'read':
+                lines.append("  read     {} ({}), window: {}".format(self._filename, self._file_format, _window((args['start_ts'], args['end_ts']))))
+            elif step == 'cull':
+                lines.append("  cull     valid_parse == 1")
+            elif step == 'crop':
+                lines.append("  crop     {}".format(_window((args['start_ts'], args['end_ts']))))
+            elif step == 'qc':
+                lines.append("  qc       delta_t={delta_t_threshold}, speed={speed_threshold}, acceleration={acceleration_threshold}, keep_flagged={keep_flagged}".format(**args))
+            elif step == 'project':
+                lines.append("  project  {}".format(', '.join(args['columns'])))
+
+        plan = self.optimize()
+
+        predicates = ["valid_parse == 1"]
+        if plan['crop'][0] is not None:
+            predicates.append("iso_time >= {}".format(plan['crop'][0]))
+        if plan['crop'][1] is not None:
+            predicates.append("iso_time <= {}".format(plan['crop'][1]))
+        predicates += ["qc_flags & {} == 0".format(QC_EXPORT_MASK) for _ in plan['qc']]
+
+        lines.append("Optimized plan:")
+        lines.append("  scan     {} ({}), window: {}".format(self._filename, self._file_format, _window(plan['window'])))
+        if plan['columns'] is not None:
+            lines.append("           columns: {} of {}: {}".format(len(plan['columns']), len(plan['file_columns']), ', '.join(plan['columns'])))
+        else:
+            lines.append("           columns: all")
+        lines.append("  filter   {}".format(' & '.join(predicates)))
+        if plan['qc'] and plan['qc'][-1]['keep_flagged']:
+            lines.append("  flagged  {}, with {}".format(' & '.join(predicates[:-1]), QC_COL))
+
+        if self._stats is not None:
+            lines.append("Executed: {scanned} rows scanned in {chunks} chunk(s), {parsed} parsed, {cropped} cropped, {passed} passed in {seconds:.3f}s".format(**self._stats))
+
+        return '\n'.join(lines)
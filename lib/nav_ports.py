@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_ports.py
+ DESCRIPTION:  Port database used to calculate the distance from port for the
+               navqa report and to detect port calls.
+
+        BUGS:
+       NOTES:  Ports are read from a csv file with name, latitude and
+               longitude columns (decimal degrees), additional columns are
+               kept.  The ports are converted to unit vectors and indexed
+               with a KD-tree, the nearest port by chord length is the
+               nearest port by great circle distance.  Queries are processed
+               in batches: all the fixes descend the tree together to get an
+               initial candidate and then backtrack only into nodes closer
+               than their current best match.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-18
+    REVISION:  2021-05-18
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import logging
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from geopy.distance import EARTH_RADIUS
+
+PORT_COLS = ['name', 'latitude', 'longitude']
+
+LEAF_SIZE = 16
+
+PORT_RADIUS = 5000 # meters
+
+
+def _to_xyz(latitudes, longitudes):
+    """
+    Convert latitudes/longitudes in decimal degrees to unit vectors
+    """
+
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+
+    return np.column_stack((np.cos(latitudes) * np.cos(longitudes), np.cos(latitudes) * np.sin(longitudes), np.sin(latitudes)))
+
+
+def _chord_to_meters(chord):
+    """
+    Convert the chord length between unit vectors to the great circle
+    distance in meters
+    """
+
+    return 2 * np.arcsin(np.minimum(chord / 2, 1)) * EARTH_RADIUS * 1000
+
+
+class PortIndex():
+    """
+    Spatial index of a port database
+    """
+
+    def __init__(self, ports):
+
+        missing = [col for col in PORT_COLS if col not in ports.columns]
+        if missing:
+            logging.error("Port database is missing columns: %s", ', '.join(missing))
+            raise ValueError("Port database must contain the columns: {}".format(', '.join(PORT_COLS)))
+
+        ports = ports.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+
+        self._ports = ports
+        self._points = _to_xyz(ports['latitude'], ports['longitude'])
+
+        # The tree nodes, stored as arrays.  Leaves have a split_dim of -1 and
+        # hold the points order[start:end].
+        self._order = np.arange(len(ports.index))
+        self._nodes = {'lower': [], 'upper': [], 'split_dim': [], 'split_value': [], 'left': [], 'right': [], 'start': [], 'end': []}
+
+        if len(ports.index) > 0:
+            self._build(0, len(ports.index))
+
+        self._nodes = {key: np.array(values) for key, values in self._nodes.items()}
+
+
+    @property
+    def ports(self):
+        '''
+        Getter method for the ports property
+        '''
+        return self._ports
+
+
+    def _build(self, start, end):
+        '''
+        Build the tree node for the points order[start:end], returns the node
+        index
+        '''
+
+        node = len(self._nodes['start'])
+        points = self._points[self._order[start:end]]
+
+        for key in self._nodes:
+            self._nodes[key].append(-1)
+
+        self._nodes['lower'][node] = points.min(axis=0)
+        self._nodes['upper'][node] = points.max(axis=0)
+        self._nodes['start'][node] = start
+        self._nodes['end'][node] = end
+        self._nodes['split_value'][node] = 0.0
+
+        if end - start <= LEAF_SIZE:
+            return node
+
+        # split along the widest dimension at the median
+        split_dim = int(np.argmax(self._nodes['upper'][node] - self._nodes['lower'][node]))
+        middle = (end - start) // 2
+
+        partition = np.argpartition(points[:, split_dim], middle)
+        self._order[start:end] = self._order[start:end][partition]
+
+        self._nodes['split_dim'][node] = split_dim
+        self._nodes['split_value'][node] = self._points[self._order[start + middle], split_dim]
+        self._nodes['left'][node] = self._build(start, start + middle)
+        self._nodes['right'][node] = self._build(start + middle, end)
+
+        return node
+
+
+    def _search_leaf(self, node, queries, selected, best):
+        '''
+        Update the best matches of the selected queries with the points in
+        the leaf node
+        '''
+
+        candidates = self._order[self._nodes['start'][node]:self._nodes['end'][node]]
+        distances = ((queries[selected, None, :] - self._points[None, candidates, :]) ** 2).sum(axis=2)
+
+        nearest = distances.argmin(axis=1)
+        nearest_distance = distances[np.arange(len(selected)), nearest]
+
+        better = nearest_distance < best[1][selected]
+        best[0][selected[better]] = candidates[nearest[better]]
+        best[1][selected[better]] = nearest_distance[better]
+
+
+    def _query(self, queries):
+        '''
+        Return the index of the nearest port and the squared chord length for
+        each of the unit vector queries
+        '''
+
+        nodes = self._nodes
+        best = (np.full(len(queries), -1), np.full(len(queries), np.inf))
+
+        # descend to the leaf containing each query
+        current = np.zeros(len(queries), dtype=np.int64)
+        internal = nodes['split_dim'][current] >= 0
+        while internal.any():
+            node = current[internal]
+            go_left = queries[internal, nodes['split_dim'][node]] < nodes['split_value'][node]
+            current[internal] = np.where(go_left, nodes['left'][node], nodes['right'][node])
+            internal = nodes['split_dim'][current] >= 0
+
+        for leaf in np.unique(current):
+            self._search_leaf(leaf, queries, np.flatnonzero(current == leaf), best)
+
+        # backtrack into the nodes that may hold a closer port
+        stack = [(0, np.arange(len(queries)))]
+        while stack:
+            node, selected = stack.pop()
+
+            outside = np.maximum(nodes['lower'][node] - queries[selected], 0) + np.maximum(queries[selected] - nodes['upper'][node], 0)
+            selected = selected[(outside ** 2).sum(axis=1) < best[1][selected]]
+
+            if selected.size == 0:
+                continue
+
+            if nodes['split_dim'][node] < 0:
+                self._search_leaf(node, queries, selected, best)
+            else:
+                stack.append((nodes['right'][node], selected))
+                stack.append((nodes['left'][node], selected))
+
+        return best[0], np.sqrt(best[1])
+
+
+    def nearest(self, latitudes, longitudes):
+        '''
+        Return the index (row of the ports dataframe) of the nearest port and
+        the distance to it in meters for each of the positions.  Positions
+        with a missing latitude/longitude return -1 and nan.
+        '''
+
+        latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+        longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+
+        indices = np.full(len(latitudes), -1)
+        distances = np.full(len(latitudes), np.nan)
+
+        valid = ~(np.isnan(latitudes) | np.isnan(longitudes))
+        if len(self._ports.index) == 0 or not valid.any():
+            return indices, distances
+
+        indices[valid], chords = self._query(_to_xyz(latitudes[valid], longitudes[valid]))
+        distances[valid] = _chord_to_meters(chords)
+
+        return indices, distances
+
+
+    def nearest_port(self, latitude, longitude):
+        '''
+        Return the name of the port nearest to the position and the distance
+        to it in meters, (None, nan) if there is no nearest port
+        '''
+
+        indices, distances = self.nearest(latitude, longitude)
+
+        if indices[0] < 0:
+            return None, np.nan
+
+        return self._ports['name'].iloc[indices[0]], distances[0]
+
+
+    def port_calls(self, dataframe, radius=PORT_RADIUS):
+        '''
+        Return the port calls in the r2rnav dataframe, consecutive fixes
+        within radius meters of the same port (fixes without a position are
+        skipped).  Returns a list of dicts with
+        the port name, start/end timestamps, number of fixes and the closest
+        approach in meters (open is used when merging chunks).
+        '''
+
+        # fixes without a position do not end a port call
+        dataframe = dataframe[dataframe['ship_latitude'].notna() & dataframe['ship_longitude'].notna()]
+
+        indices, distances = self.nearest(dataframe['ship_latitude'], dataframe['ship_longitude'])
+        indices[~(distances <= radius)] = -1
+
+        # runs of fixes at the same port
+        starts = np.flatnonzero(np.diff(indices, prepend=-1) != 0)
+        ends = np.append(starts[1:], len(indices))
+
+        iso_time = dataframe['iso_time'].to_numpy()
+
+        return [{
+            'port': self._ports['name'].iloc[indices[start]],
+            'startTS': pd.Timestamp(iso_time[start]),
+            'endTS': pd.Timestamp(iso_time[end - 1]),
+            'fixes': int(end - start),
+            'closestApproach': float(np.min(distances[start:end])),
+            'open': False
+        } for start, end in zip(starts, ends) if indices[start] >= 0]
+
+
+@lru_cache(maxsize=None)
+def load_port_index(filename):
+    """
+    Read the port database csv file and return the PortIndex.  The index is
+    built once per file and reused.
+    """
+
+    logging.debug("Building port index from %s", filename)
+    return PortIndex(pd.read_csv(filename))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_qc.py
+ DESCRIPTION:  The per-row QC flag bitmask of the r2rnav data, one bit per QC
+               rule, used by navparse, navqa and navexport.
+
+        BUGS:
+       NOTES:  The bits of the threshold rules (deltaT, speed, acceleration)
+               depend on the thresholds used to build them, the thresholds are
+               recorded in the r2rnav metadata (partition manifest, archive
+               index, hdf attributes).  Flags read without matching thresholds
+               have their threshold bits rebuilt from the data.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-23
+    REVISION:  2021-05-23
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import numpy as np
+
+QC_COL = 'qc_flags'
+
+QC_PARSE = 1              # valid_parse == 0
+QC_NMEA_QUALITY = 2       # nmea_quality not 1-3
+QC_CKSUM = 4              # valid_cksum not 1
+QC_ORDER = 8              # valid_order not 1
+QC_DELTA_T = 16           # deltaT > delta_t threshold
+QC_SPEED = 32             # speed_made_good > speed threshold
+QC_ACCELERATION = 64      # acceleration > acceleration threshold
+QC_MOTION_UNCHECKED = 128 # speed_made_good or acceleration missing
+
+QC_FLAGS = {
+    'parse': QC_PARSE,
+    'nmea_quality': QC_NMEA_QUALITY,
+    'cksum': QC_CKSUM,
+    'order': QC_ORDER,
+    'delta_t': QC_DELTA_T,
+    'speed': QC_SPEED,
+    'acceleration': QC_ACCELERATION,
+    'motion_unchecked': QC_MOTION_UNCHECKED
+}
+
+QC_THRESHOLD_FLAGS = QC_DELTA_T | QC_SPEED | QC_ACCELERATION
+
+# the r2rnav columns used to build the flags and to rebuild the threshold bits
+QC_INPUT_COLS = ['valid_parse', 'nmea_quality', 'valid_cksum', 'valid_order', 'deltaT', 'speed_made_good', 'acceleration']
+QC_THRESHOLD_COLS = ['deltaT', 'speed_made_good', 'acceleration']
+
+# the records counted as flagged by navqa
+QC_NAVQA_MASK = QC_PARSE | QC_NMEA_QUALITY | QC_CKSUM | QC_ORDER | QC_SPEED | QC_ACCELERATION
+
+# the records removed by navexport --qc
+QC_EXPORT_MASK = QC_NMEA_QUALITY | QC_CKSUM | QC_ORDER | QC_SPEED | QC_ACCELERATION | QC_MOTION_UNCHECKED
+
+
+def qc_thresholds(delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None):
+    """
+    Return the thresholds as recorded in the r2rnav metadata
+    """
+
+    return {
+        'delta_t': delta_t_threshold,
+        'speed': speed_threshold,
+        'acceleration': acceleration_threshold
+    }
+
+
+def _values(dataframe, column):
+    """
+    Return the column as a float64 numpy array
+    """
+
+    return dataframe[column].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _threshold_flags(dataframe, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None):
+    """
+    Return the threshold bits of the dataframe rows, a bit is not set if its
+    threshold is not specified
+    """
+
+    flags = np.zeros(len(dataframe.index), dtype=np.uint8)
+
+    if delta_t_threshold is not None:
+        delta_t = dataframe['deltaT'].to_numpy(dtype='timedelta64[ns]')
+        flags[~np.isnat(delta_t) & (delta_t > np.timedelta64(int(delta_t_threshold * 10**9), 'ns'))] |= QC_DELTA_T
+
+    if speed_threshold is not None:
+        flags[_values(dataframe, 'speed_made_good') > speed_threshold] |= QC_SPEED
+
+    if acceleration_threshold is not None:
+        flags[_values(dataframe, 'acceleration') > acceleration_threshold] |= QC_ACCELERATION
+
+    return flags
+
+
+def build_qc_flags(dataframe, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None):
+    """
+    Return the QC flag bitmask (uint8) of the processed r2rnav dataframe rows
+    """
+
+    nmea_quality = _values(dataframe, 'nmea_quality')
+    speed = _values(dataframe, 'speed_made_good')
+    acceleration = _values(dataframe, 'acceleration')
+
+    flags = _threshold_flags(dataframe, delta_t_threshold, speed_threshold, acceleration_threshold)
+
+    flags[_values(dataframe, 'valid_parse') == 0] |= QC_PARSE
+    flags[~((nmea_quality >= 1) & (nmea_quality <= 3))] |= QC_NMEA_QUALITY
+    flags[~(_values(dataframe, 'valid_cksum') == 1)] |= QC_CKSUM
+    flags[~(_values(dataframe, 'valid_order') == 1)] |= QC_ORDER
+    flags[np.isnan(speed) | np.isnan(acceleration)] |= QC_MOTION_UNCHECKED
+
+    return flags
+
+
+def qc_flags(dataframe, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None):
+    """
+    Return the QC flag bitmask of the r2rnav dataframe rows for the
+    thresholds.  The qc_flags column is used if present, its threshold bits
+    are only reused if the thresholds recorded in the dataframe attrs match.
+    """
+
+    if QC_COL not in dataframe.columns:
+        return build_qc_flags(dataframe, delta_t_threshold, speed_threshold, acceleration_threshold)
+
+    flags = dataframe[QC_COL].to_numpy(dtype=np.uint8)
+
+    if dataframe.attrs.get('qc_thresholds') == qc_thresholds(delta_t_threshold, speed_threshold, acceleration_threshold):
+        return flags
+
+    return (flags & np.uint8(~QC_THRESHOLD_FLAGS & 0xff)) | _threshold_flags(dataframe, delta_t_threshold, speed_threshold, acceleration_threshold)
+
+
+def qc_columns(columns, metadata, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None):
+    """
+    Return the columns qc_flags reads from r2rnav data with the columns and
+    metadata (see read_r2rnav_metadata) for the thresholds: only the
+    qc_flags column if its thresholds match, the qc_flags column plus the
+    threshold columns if not, and the columns the flags are built from if
+    the data has no qc_flags column.
+    """
+
+    if QC_COL not in columns:
+        return QC_INPUT_COLS
+
+    if metadata.get('qc_thresholds') == qc_thresholds(delta_t_threshold, speed_threshold, acceleration_threshold):
+        return [QC_COL]
+
+    return [QC_COL] + QC_THRESHOLD_COLS
+
+
+def count_qc_flags(flags):
+    """
+    Return the number of rows with each QC flag set.  The rows are counted
+    per bitmask value in one pass and the bit counts summed from the 256
+    value counts.
+    """
+
+    value_counts = np.bincount(flags, minlength=256)
+    values = np.arange(256)
+
+    return {name: int(value_counts[(values & bit) != 0].sum()) for name, bit in QC_FLAGS.items()}
+
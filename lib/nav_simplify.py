@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_simplify.py
+ DESCRIPTION:  Line simplification used to build the control product.
+
+        BUGS:
+       NOTES:  Ramer-Douglas-Peucker simplification.  The segments are
+               processed from a priority queue instead of recursively and the
+               distance of all the points in a segment is calculated at once
+               with numpy.
+               The distance is the perpendicular distance to the line through
+               the segment end points (the distance to the start point if the
+               end points are equal) and a point is kept if its distance is
+               greater than epsilon, the same semantics as the rdp package.
+               The importance of a point is the largest epsilon at which it is
+               kept and its rank is the order in which it is added, so one
+               ranking answers any epsilon or point budget.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-21
+    REVISION:  2021-05-21
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import heapq
+
+import numpy as np
+
+
+def _line_distances(points, start, end):
+    """
+    Return the distance of the points between start and end (exclusive) to
+    the line through the points start and end
+    """
+
+    segment = points[start + 1:end]
+    direction = points[end] - points[start]
+    length = np.hypot(direction[0], direction[1])
+
+    if length == 0:
+        return np.hypot(segment[:, 0] - points[start, 0], segment[:, 1] - points[start, 1])
+
+    return np.abs(direction[0] * (points[start, 1] - segment[:, 1]) - direction[1] * (points[start, 0] - segment[:, 0])) / length
+
+
+def rdp_ranking(points, min_epsilon=None, max_points=None):
+    """
+    Rank the points of the line (n x 2 array of x/y) for the
+    Ramer-Douglas-Peucker algorithm.  Returns the importance of each point,
+    the largest epsilon at which rdp keeps the point (rdp with epsilon keeps
+    the points with an importance greater than epsilon, the end points are
+    inf), and the rank of each point, the order in which the points are
+    added (the points with a rank less than N are the N point simplification).
+    The points are ranked until the remaining points are not more important
+    than min_epsilon and at least max_points points are ranked (all the
+    points if neither is specified), the points not ranked have an importance
+    of 0 and a rank of n.
+    """
+
+    points = np.asarray(points, dtype=np.float64)
+    importance = np.zeros(len(points))
+    rank = np.full(len(points), len(points), dtype=np.int64)
+
+    if len(points) == 0:
+        return importance, rank
+
+    importance[[0, -1]] = np.inf
+    rank[-1] = min(len(points) - 1, 1)
+    rank[0] = 0
+
+    if min_epsilon is None and max_points is None:
+        min_epsilon = 0.0
+
+    def _push(heap, start, end, parent):
+        if end - start < 2:
+            return
+
+        distances = _line_distances(points, start, end)
+        farthest = int(np.argmax(distances))
+
+        # a point is never more important than the point splitting its parent
+        value = min(distances[farthest], parent)
+        if value > 0:
+            heapq.heappush(heap, (-value, start, end, start + 1 + farthest))
+
+    heap = []
+    _push(heap, 0, len(points) - 1, np.inf)
+
+    ranked = min(len(points), 2)
+    while heap and ((min_epsilon is not None and -heap[0][0] > min_epsilon) or (max_points is not None and ranked < max_points)):
+        value, start, end, index = heapq.heappop(heap)
+
+        importance[index] = -value
+        rank[index] = ranked
+        ranked += 1
+
+        _push(heap, start, index, -value)
+        _push(heap, index, end, -value)
+
+    return importance, rank
+
+
+def rdp_indices(points, epsilon):
+    """
+    Simplify the line (n x 2 array of x/y) using the Ramer-Douglas-Peucker
+    algorithm, returns the indices of the points kept in ascending order
+    """
+
+    return np.flatnonzero(rdp_ranking(points, epsilon)[0] > epsilon)
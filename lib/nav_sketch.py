@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_sketch.py
+ DESCRIPTION:  Mergeable streaming quantile sketch used for the navqa
+               percentiles and histograms.
+
+        BUGS:
+       NOTES:  The sketch keeps logarithmic buckets (DDSketch): a value x is
+               counted in bucket ceil(log(|x|) / log(gamma)) with
+               gamma = (1 + alpha) / (1 - alpha), so every quantile is
+               returned within a relative error of alpha.  Values closer to 0
+               than MIN_VALUE are counted as 0.  Sketches with the same alpha
+               are merged by adding the bucket counts.  If every value is a
+               whole number (i.e. nsv) the quantiles are rounded.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-19
+    REVISION:  2021-05-19
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import logging
+
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+
+MIN_VALUE = 1e-9
+
+
+class _BucketStore():
+    """
+    Dense bucket counts starting at bucket index offset
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+
+    def add(self, indices):
+        '''
+        Count the bucket indices
+        '''
+
+        if indices.size == 0:
+            return
+
+        low = int(indices.min())
+        self.add_counts(low, np.bincount(indices - low))
+
+
+    def add_counts(self, offset, counts):
+        '''
+        Add the counts of the buckets starting at offset
+        '''
+
+        if counts.size == 0:
+            return
+
+        if self.counts.size == 0:
+            self.offset, self.counts = offset, counts.astype(np.int64)
+            return
+
+        low = min(self.offset, offset)
+        high = max(self.offset + self.counts.size, offset + counts.size)
+
+        merged = np.zeros(high - low, dtype=np.int64)
+        merged[self.offset - low:self.offset - low + self.counts.size] += self.counts
+        merged[offset - low:offset - low + counts.size] += counts
+
+        self.offset, self.counts = low, merged
+
+
+class QuantileSketch():
+    """
+    Mergeable quantile sketch with a bounded relative error
+    """
+
+    def __init__(self, alpha=RELATIVE_ACCURACY):
+
+        # The relative accuracy
+        self._alpha = alpha
+        self._log_gamma = np.log((1 + alpha) / (1 - alpha))
+
+        # The bucket counts
+        self._positive = _BucketStore()
+        self._negative = _BucketStore()
+        self._zero = 0
+
+        # The exact count/min/max
+        self._count = 0
+        self._min = np.nan
+        self._max = np.nan
+
+        # Whether all the values are whole numbers
+        self._integer = True
+
+
+    @property
+    def alpha(self):
+        '''
+        Getter method for the alpha property
+        '''
+        return self._alpha
+
+
+    @property
+    def count(self):
+        '''
+        Getter method for the count property
+        '''
+        return self._count
+
+
+    def _indices(self, magnitudes):
+        '''
+        Return the bucket index of each magnitude (>= MIN_VALUE)
+        '''
+
+        indices = np.log(magnitudes)
+        indices /= self._log_gamma
+        np.ceil(indices, out=indices)
+
+        return indices.astype(np.int64)
+
+
+    def add(self, values):
+        '''
+        Add the values (NaNs are ignored), returns the sketch
+        '''
+
+        values = np.asarray(values, dtype=np.float64)
+
+        if np.isnan(values).any():
+            values = values[~np.isnan(values)]
+
+        if values.size == 0:
+            return self
+
+        low, high = values.min(), values.max()
+
+        # whole numbers, check a sample before the full array
+        if self._integer:
+            self._integer = bool((np.rint(values[:1024]) == values[:1024]).all() and (np.rint(values) == values).all())
+
+        self._count += int(values.size)
+        self._min = np.nanmin([self._min, low])
+        self._max = np.nanmax([self._max, high])
+
+        if low >= MIN_VALUE:
+            self._positive.add(self._indices(values))
+            return self
+
+        indices = self._indices(np.maximum(np.abs(values), MIN_VALUE))
+        positive = values >= MIN_VALUE
+        negative = values <= -MIN_VALUE
+
+        self._positive.add(indices[positive])
+        self._negative.add(indices[negative])
+        self._zero += int(values.size - np.count_nonzero(positive) - np.count_nonzero(negative))
+
+        return self
+
+
+    def merged(self, other):
+        '''
+        Return a new sketch holding the values of this sketch and the other
+        sketch
+        '''
+
+        return QuantileSketch.combined([self, other], self._alpha)
+
+
+    @classmethod
+    def combined(cls, sketches, alpha=RELATIVE_ACCURACY):
+        '''
+        Return a new sketch holding the values of all the sketches, the
+        bucket counts of each store are added into one array
+        '''
+
+        if any(source.alpha != alpha for source in sketches):
+            logging.error("Can not merge sketches with different accuracies")
+            raise ValueError("Sketch accuracies do not match: {} != {}".format(alpha, [source.alpha for source in sketches]))
+
+        sketch = cls(alpha)
+        sketches = [source for source in sketches if source.count > 0]
+
+        if not sketches:
+            return sketch
+
+        for store, stores in [(sketch._positive, [source._positive for source in sketches]), (sketch._negative, [source._negative for source in sketches])]: # pylint: disable=protected-access
+            stores = [source for source in stores if source.counts.size > 0]
+
+            if not stores:
+                continue
+
+            store.offset = min(source.offset for source in stores)
+            store.counts = np.zeros(max(source.offset + source.counts.size for source in stores) - store.offset, dtype=np.int64)
+
+            for source in stores:
+                store.counts[source.offset - store.offset:source.offset - store.offset + source.counts.size] += source.counts
+
+        sketch._zero = sum(source._zero for source in sketches) # pylint: disable=protected-access
+        sketch._count = sum(source.count for source in sketches) # pylint: disable=protected-access
+        sketch._integer = all(source._integer for source in sketches) # pylint: disable=protected-access
+        sketch._min = min(source._min for source in sketches) # pylint: disable=protected-access
+        sketch._max = max(source._max for source in sketches) # pylint: disable=protected-access
+
+        return sketch
+
+
+    def _buckets(self):
+        '''
+        Return the representative value and count of every bucket in
+        ascending order of value
+        '''
+
+        gamma = np.exp(self._log_gamma)
+
+        def _values(store):
+            return 2 * np.exp((store.offset + np.arange(store.counts.size)) * self._log_gamma) / (gamma + 1)
+
+        values = np.concatenate((-_values(self._negative)[::-1], [0.0], _values(self._positive)))
+        counts = np.concatenate((self._negative.counts[::-1], [self._zero], self._positive.counts))
+
+        return np.clip(values, self._min, self._max), counts
+
+
+    def quantiles(self, quantiles):
+        '''
+        Return the values at the quantiles (0-1), None if the sketch is empty
+        '''
+
+        if self._count == 0:
+            return None
+
+        quantiles = np.atleast_1d(np.asarray(quantiles, dtype=np.float64))
+
+        values, counts = self._buckets()
+        ranks = quantiles * (self._count - 1)
+
+        results = values[np.searchsorted(np.cumsum(counts), ranks, side='right')]
+
+        if self._integer:
+            results = np.rint(results)
+
+        # the min/max are exact
+        results[quantiles <= 0] = self._min
+        results[quantiles >= 1] = self._max
+
+        return results
+
+
+    def histogram(self, bins=10):
+        '''
+        Return the histogram counts and bin edges of the values, the bucket
+        values are used so counts near the bin edges are approximate, None if
+        the sketch is empty
+        '''
+
+        if self._count == 0:
+            return None
+
+        values, counts = self._buckets()
+        counts, edges = np.histogram(values, bins=bins, range=(self._min, self._max), weights=counts)
+
+        return counts.astype(np.int64), edges
@@ -0,0 +1,691 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_stats.py
+ DESCRIPTION:  Contains the report engine used to compute the navinfo and
+               navqa statistics from r2rnav data.
+
+        BUGS:
+       NOTES:  Every statistic is computed directly from the numpy column
+               arrays, counts are mask sums so no rows are copied.
+
+               NavQAAccumulator keeps the same statistics as mergeable state
+               so data can be processed in chunks (or in separate processes)
+               and combined, giving the same results as a single scan.
+
+               Epoch completeness: epochs are binned to the nominal epoch
+               interval (median positive deltaT rounded to the ms) with
+               integer arithmetic, bin = (iso_time + interval/2) // interval.
+               Records are counted in order, consecutive records in the same
+               bin count as one epoch.  The possible epochs are the bins
+               between the first and last bin, no time grid is built.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-17
+    REVISION:  2021-05-17
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from lib.nav_sketch import QuantileSketch
+from lib.nav_qc import qc_flags, count_qc_flags, QC_NAVQA_MASK
+
+NAT_INT = np.iinfo(np.int64).min
+
+ONE_DAY_NS = 24 * 60 * 60 * 10**9
+
+# the metrics with percentiles/histograms
+DISTRIBUTION_METRICS = ['speed', 'acceleration', 'hdop', 'nsv', 'delta_t']
+
+
+def float_column(dataframe, column):
+    """
+    Return the column as a float64 numpy array
+    """
+
+    return dataframe[column].to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def time_column(dataframe, column, dtype='datetime64[ns]'):
+    """
+    Return the datetime/timedelta column as int64 ns (NaT as NAT_INT)
+    """
+
+    series = dataframe[column]
+
+    if pd.api.types.is_datetime64_any_dtype(series.dtype) and series.dt.tz is not None:
+        series = series.dt.tz_convert(None)
+
+    return series.to_numpy(dtype=dtype).view(np.int64)
+
+
+def _min_max(values):
+    """
+    Return [min, max] of the float values ignoring NaNs, [nan, nan] if there
+    are no values.
+    """
+
+    values = values[~np.isnan(values)]
+
+    if values.size == 0:
+        return [np.nan, np.nan]
+
+    return [values.min(), values.max()]
+
+
+def _merge_min_max(left, right, missing):
+    """
+    Combine two [min, max] pairs, ignoring missing values
+    """
+
+    def _is_missing(value):
+        return value is None or (missing is not None and np.isnan(value))
+
+    return [
+        min((value for value in (left[0], right[0]) if not _is_missing(value)), default=missing),
+        max((value for value in (left[1], right[1]) if not _is_missing(value)), default=missing)
+    ]
+
+
+def _time_min_max(values):
+    """
+    Return [min, max] of the int64 ns values ignoring NaT, [None, None] if
+    there are no values.
+    """
+
+    values = values[values != NAT_INT]
+
+    if values.size == 0:
+        return [None, None]
+
+    return [values.min(), values.max()]
+
+
+def interval_counts(delta_t, counts=None):
+    """
+    Return the number of positive deltaT values (int64 ns) per value rounded
+    to the ms, a dict of ms: count.  The counts of the values are added to
+    counts if specified, so the counts of several chunks can be combined.
+    """
+
+    counts = counts if counts is not None else {}
+
+    delta_t = delta_t[(delta_t != NAT_INT) & (delta_t > 0)]
+    values, value_counts = np.unique((delta_t + 5 * 10**5) // 10**6, return_counts=True)
+
+    for value, count in zip(values.tolist(), value_counts.tolist()):
+        counts[value] = counts.get(value, 0) + count
+
+    return counts
+
+
+def median_interval_counts(counts):
+    """
+    Return the nominal epoch interval in ns, the median of the interval_counts
+    rounded to the ms, None if there are no counts
+    """
+
+    if not counts:
+        return None
+
+    values = np.array(sorted(counts), dtype=np.int64)
+    cumulative = np.cumsum([counts[value] for value in values])
+
+    low = values[np.searchsorted(cumulative, (cumulative[-1] - 1) // 2, side='right')]
+    high = values[np.searchsorted(cumulative, cumulative[-1] // 2, side='right')]
+
+    return max(int(round((low + high) / 2)), 1) * 10**6
+
+
+def median_interval(delta_t):
+    """
+    Return the nominal epoch interval in ns (median of the positive deltaT
+    values rounded to the ms), None if there are no positive values
+    """
+
+    return median_interval_counts(interval_counts(delta_t))
+
+
+def infer_epoch_interval(dataframe):
+    """
+    Return the nominal epoch interval of the r2rnav dataframe in seconds,
+    None if it can not be determined
+    """
+
+    if 'deltaT' not in dataframe.columns:
+        return None
+
+    interval = median_interval(time_column(dataframe, 'deltaT', dtype='timedelta64[ns]'))
+    return interval / 10**9 if interval is not None else None
+
+
+def _count_runs(bins):
+    """
+    Return the number of runs of equal consecutive values
+    """
+
+    if bins.size == 0:
+        return 0
+
+    return 1 + int(np.count_nonzero(bins[1:] != bins[:-1]))
+
+
+def _scan_epochs(iso_time, flagged, interval):
+    """
+    Return the epoch statistics, the head/tail bins are kept so epoch counts
+    can be merged.  Countable epochs are epochs with unflagged records.
+    """
+
+    if interval is None:
+        return {
+            'epoch_interval': None,
+            'epoch_bins': [None, None],
+            'actual_epochs': None,
+            'countable_epochs': None,
+            'epoch_head': [None, None],
+            'epoch_tail': [None, None]
+        }
+
+    valid = iso_time != NAT_INT
+    bins = (iso_time[valid] + interval // 2) // interval
+    countable_bins = (iso_time[valid & ~flagged] + interval // 2) // interval
+
+    return {
+        'epoch_interval': interval,
+        'epoch_bins': _time_min_max(bins),
+        'actual_epochs': _count_runs(bins),
+        'countable_epochs': _count_runs(countable_bins),
+        'epoch_head': [bins[0] if bins.size > 0 else None, countable_bins[0] if countable_bins.size > 0 else None],
+        'epoch_tail': [bins[-1] if bins.size > 0 else None, countable_bins[-1] if countable_bins.size > 0 else None]
+    }
+
+
+def complete_epochs(stats):
+    """
+    Add the possible/absent/flagged epoch counts and the percent completeness
+    """
+
+    if stats['actual_epochs'] is None or stats['epoch_bins'][0] is None:
+        stats.update({'possible_epochs': None, 'absent_epochs': None, 'flagged_epochs': None, 'percent_completeness': None})
+        return stats
+
+    possible = int(stats['epoch_bins'][1] - stats['epoch_bins'][0]) + 1
+
+    stats.update({
+        'possible_epochs': possible,
+        'absent_epochs': max(possible - stats['actual_epochs'], 0),
+        'flagged_epochs': stats['actual_epochs'] - stats['countable_epochs'],
+        'percent_completeness': 100 * stats['countable_epochs'] / possible
+    })
+
+    return stats
+
+
+def scan_nav_data(dataframe, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None, epoch_interval=None): # pylint: disable=too-many-locals
+    """
+    Compute all the navinfo and navqa statistics for the r2rnav dataframe.
+    delta_t_threshold is in seconds.  Threshold counts are None if the
+    threshold is not specified.  epoch_interval is the nominal epoch interval
+    in seconds, inferred from deltaT if not specified.
+
+    Returns a dict of statistics.  Timestamps/timedeltas are returned as int64
+    ns (None if missing), use to_timestamp/to_timedelta to convert them.  The
+    distributions are QuantileSketches (deltaT in seconds).
+    """
+
+    total_lines = len(dataframe.index)
+
+    iso_time = time_column(dataframe, 'iso_time')
+    longitude = float_column(dataframe, 'ship_longitude')
+    latitude = float_column(dataframe, 'ship_latitude')
+    valid_parse = float_column(dataframe, 'valid_parse')
+
+    stats = {
+        'total_lines': total_lines,
+        'parse_errors': int(np.count_nonzero(valid_parse == 0)),
+        'first_valid': None,
+        'last_valid': None,
+        'longitude': _min_max(longitude),
+        'latitude': _min_max(latitude),
+        'first_epoch': None,
+        'last_epoch': None
+    }
+
+    valid_rows = np.flatnonzero(valid_parse == 1)
+    if valid_rows.size > 0:
+        stats['first_valid'] = [iso_time[valid_rows[0]], longitude[valid_rows[0]], latitude[valid_rows[0]]]
+        stats['last_valid'] = [iso_time[valid_rows[-1]], longitude[valid_rows[-1]], latitude[valid_rows[-1]]]
+
+    valid_times = np.flatnonzero(iso_time != NAT_INT)
+    if valid_times.size > 0:
+        stats['first_epoch'] = iso_time[valid_times[0]]
+
+    if total_lines > 0 and iso_time[-1] != NAT_INT:
+        stats['last_epoch'] = iso_time[-1]
+
+    # the remaining statistics require the processed r2rnav columns
+    if 'deltaT' not in dataframe.columns:
+        return stats
+
+    delta_t = time_column(dataframe, 'deltaT', dtype='timedelta64[ns]')
+    speed = float_column(dataframe, 'speed_made_good')
+    acceleration = float_column(dataframe, 'acceleration')
+
+    nsv = float_column(dataframe, 'nsv')
+    hdop = float_column(dataframe, 'hdop')
+
+    # the error counts are the popcounts of the QC flag bits
+    flags = qc_flags(dataframe, delta_t_threshold, speed_threshold, acceleration_threshold)
+    flag_counts = count_qc_flags(flags)
+
+    stats.update({
+        'antenna_height': _min_max(float_column(dataframe, 'antenna_height')),
+        'speed': _min_max(speed),
+        'acceleration': _min_max(acceleration),
+        'nsv': _min_max(nsv),
+        'hdop': _min_max(hdop),
+        'delta_t': _time_min_max(delta_t),
+        'out_of_sequence_errors': flag_counts['order'],
+        'nmea_quality_errors': flag_counts['nmea_quality'],
+        'cksum_errors': flag_counts['cksum'],
+        'delta_t_errors': flag_counts['delta_t'] if delta_t_threshold is not None else None,
+        'speed_errors': flag_counts['speed'] if speed_threshold is not None else None,
+        'acceleration_errors': flag_counts['acceleration'] if acceleration_threshold is not None else None,
+        'distributions': {
+            'speed': QuantileSketch().add(speed),
+            'acceleration': QuantileSketch().add(acceleration),
+            'hdop': QuantileSketch().add(hdop),
+            'nsv': QuantileSketch().add(nsv),
+            'delta_t': QuantileSketch().add(delta_t[delta_t != NAT_INT] / 10**9)
+        }
+    })
+
+    # records flagged by any of the QA tests
+    flagged = (flags & QC_NAVQA_MASK) != 0
+
+    interval = int(round(epoch_interval * 10**9)) if epoch_interval is not None else median_interval(delta_t)
+    stats.update(_scan_epochs(iso_time, flagged, interval))
+
+    return complete_epochs(stats)
+
+
+def to_timestamp(value):
+    """
+    Convert int64 ns value to pd.Timestamp (None stays None)
+    """
+
+    return pd.Timestamp(value) if value is not None else None
+
+
+def to_timedelta(value):
+    """
+    Convert int64 ns value to pd.Timedelta (None stays None)
+    """
+
+    return pd.Timedelta(value) if value is not None else None
+
+
+def _merge_epochs(left, right):
+    """
+    Merge the epoch statistics of consecutive pieces of data
+    """
+
+    if left['epoch_interval'] is not None and right['epoch_interval'] is not None and left['epoch_interval'] != right['epoch_interval']:
+        logging.error("Can not merge epoch statistics with different epoch intervals")
+        raise ValueError("Epoch intervals do not match: {} != {} ns".format(left['epoch_interval'], right['epoch_interval']))
+
+    if left['epoch_interval'] is None or right['epoch_interval'] is None:
+        return _scan_epochs(None, None, None)
+
+    merged = {
+        'epoch_interval': left['epoch_interval'],
+        'epoch_bins': _merge_min_max(left['epoch_bins'], right['epoch_bins'], None),
+        'epoch_head': [head if head is not None else other for head, other in zip(left['epoch_head'], right['epoch_head'])],
+        'epoch_tail': [tail if tail is not None else other for tail, other in zip(right['epoch_tail'], left['epoch_tail'])]
+    }
+
+    # an epoch spanning the seam is only counted once
+    for position, key in enumerate(['actual_epochs', 'countable_epochs']):
+        seam = left['epoch_tail'][position] is not None and left['epoch_tail'][position] == right['epoch_head'][position]
+        merged[key] = left[key] + right[key] - int(seam)
+
+    return merged
+
+
+def stream_epoch_interval(chunks):
+    """
+    Return the nominal epoch interval in seconds of the r2rnav dataframe
+    chunks, the median of the positive deltaT values of all the chunks (same
+    as infer_epoch_interval on the whole data), None if it can not be
+    determined.  Only the count of each distinct deltaT (rounded to the ms)
+    is kept, see interval_counts.
+    """
+
+    counts = {}
+
+    for chunk in chunks:
+        if 'deltaT' in chunk.columns:
+            interval_counts(time_column(chunk, 'deltaT', dtype='timedelta64[ns]'), counts)
+
+    interval = median_interval_counts(counts)
+    return interval / 10**9 if interval is not None else None
+
+
+class NavQAAccumulator():
+    """
+    Mergeable navinfo/navqa statistics.  Feed r2rnav dataframe chunks in
+    order to update(), or build accumulators for consecutive pieces of the
+    data independently and combine them with merge().  merge() is
+    associative, the stats are identical to scan_nav_data on the whole
+    dataframe.
+
+    The first/last timestamps of each piece are kept so a deltaT missing on
+    the first row of a piece (i.e. a chunk processed without the preceding
+    row) is filled in from the end of the previous piece.
+
+    The epoch interval (seconds) should be the interval of all the data,
+    i.e. from stream_epoch_interval, so the stats match scan_nav_data.  If
+    it is not specified it is inferred from the first chunk passed to
+    update().  Accumulators built independently must use the same
+    epoch_interval to be merged.
+    """
+
+    def __init__(self, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None, epoch_interval=None):
+
+        # The QA thresholds (delta_t_threshold in seconds)
+        self._thresholds = (delta_t_threshold, speed_threshold, acceleration_threshold)
+
+        # The nominal epoch interval in seconds
+        self._epoch_interval = epoch_interval
+
+        # The merged statistics, None until data has been added
+        self._stats = None
+
+        # The boundary rows: first iso_time, whether the first deltaT is
+        # missing and the last iso_time (int64 ns)
+        self._head_time = NAT_INT
+        self._head_gap = False
+        self._tail_time = NAT_INT
+
+
+    @property
+    def thresholds(self):
+        '''
+        Getter method for the thresholds property
+        '''
+        return self._thresholds
+
+
+    @property
+    def epoch_interval(self):
+        '''
+        Getter method for the epoch_interval property
+        '''
+        return self._epoch_interval
+
+
+    @property
+    def total_lines(self):
+        '''
+        Getter method for the total_lines property
+        '''
+        stats = self.stats
+        return stats['total_lines'] if stats is not None else 0
+
+
+    @property
+    def stats(self):
+        '''
+        Getter method for the stats property, same format as scan_nav_data
+        '''
+        return self._stats
+
+
+    def _scan(self, dataframe):
+        '''
+        Return an accumulator for the dataframe
+        '''
+
+        chunk = NavQAAccumulator(*self._thresholds, epoch_interval=self._epoch_interval)
+        chunk._stats = scan_nav_data(dataframe, *self._thresholds, epoch_interval=self._epoch_interval) # pylint: disable=protected-access
+
+        iso_time = time_column(dataframe, 'iso_time')
+        chunk._head_time = iso_time[0] # pylint: disable=protected-access
+        chunk._tail_time = iso_time[-1] # pylint: disable=protected-access
+
+        if 'deltaT' in dataframe.columns:
+            chunk._head_gap = bool(pd.isnull(dataframe['deltaT'].iloc[0])) # pylint: disable=protected-access
+
+        return chunk
+
+
+    def update(self, dataframe):
+        '''
+        Add the next chunk of r2rnav data
+        '''
+
+        if len(dataframe.index) == 0:
+            return self
+
+        if self._epoch_interval is None:
+            self._epoch_interval = infer_epoch_interval(dataframe)
+
+        chunk = self._scan(dataframe)
+        return self.merge(chunk)
+
+
+    def merge(self, other):
+        '''
+        Merge the accumulator for the data immediately following this
+        accumulator's data into this accumulator.
+        '''
+
+        if other.thresholds != self._thresholds:
+            logging.error("Can not merge accumulators with different thresholds")
+            raise ValueError("Accumulator thresholds do not match: {} != {}".format(self._thresholds, other.thresholds))
+
+        if other.stats is None:
+            return self
+
+        if self._stats is None:
+            self._stats = dict(other.stats)
+            self._head_time, self._head_gap, self._tail_time = other._head_time, other._head_gap, other._tail_time # pylint: disable=protected-access
+            self._epoch_interval = self._epoch_interval if self._epoch_interval is not None else other.epoch_interval
+            return self
+
+        left, right = self._stats, other.stats
+
+        merged = {
+            'total_lines': left['total_lines'] + right['total_lines'],
+            'parse_errors': left['parse_errors'] + right['parse_errors'],
+            'first_valid': left['first_valid'] if left['first_valid'] is not None else right['first_valid'],
+            'last_valid': right['last_valid'] if right['last_valid'] is not None else left['last_valid'],
+            'longitude': _merge_min_max(left['longitude'], right['longitude'], np.nan),
+            'latitude': _merge_min_max(left['latitude'], right['latitude'], np.nan),
+            'first_epoch': left['first_epoch'] if left['first_epoch'] is not None else right['first_epoch'],
+            'last_epoch': right['last_epoch']
+        }
+
+        if 'delta_t' in left and 'delta_t' in right:
+            merged.update({
+                'antenna_height': _merge_min_max(left['antenna_height'], right['antenna_height'], np.nan),
+                'speed': _merge_min_max(left['speed'], right['speed'], np.nan),
+                'acceleration': _merge_min_max(left['acceleration'], right['acceleration'], np.nan),
+                'nsv': _merge_min_max(left['nsv'], right['nsv'], np.nan),
+                'hdop': _merge_min_max(left['hdop'], right['hdop'], np.nan),
+                'delta_t': _merge_min_max(left['delta_t'], right['delta_t'], None),
+                'distributions': {metric: left['distributions'][metric].merged(right['distributions'][metric]) for metric in DISTRIBUTION_METRICS}
+            })
+
+            for key in ['out_of_sequence_errors', 'nmea_quality_errors', 'cksum_errors', 'delta_t_errors', 'speed_errors', 'acceleration_errors']:
+                merged[key] = left[key] + right[key] if left[key] is not None else None
+
+            # fill in the deltaT missing from the first row of the other data
+            if other._head_gap and self._tail_time != NAT_INT and other._head_time != NAT_INT: # pylint: disable=protected-access
+                gap = other._head_time - self._tail_time # pylint: disable=protected-access
+                merged['delta_t'] = _merge_min_max(merged['delta_t'], [gap, gap], None)
+                merged['distributions']['delta_t'].add([gap / 10**9])
+
+                if merged['delta_t_errors'] is not None and gap > int(self._thresholds[0] * 10**9):
+                    merged['delta_t_errors'] += 1
+
+            merged.update(_merge_epochs(left, right))
+            complete_epochs(merged)
+
+        self._stats = merged
+        self._tail_time = other._tail_time # pylint: disable=protected-access
+
+        return self
+
+
+def day_keys(dataframe):
+    """
+    Return the UTC day (YYYY-mm-dd) of each row of the r2rnav dataframe,
+    'nodate' for rows without a timestamp
+    """
+
+    iso_time = time_column(dataframe, 'iso_time')
+    days = np.where(iso_time != NAT_INT, iso_time // ONE_DAY_NS, NAT_INT)
+
+    unique_days, inverse = np.unique(days, return_inverse=True)
+    labels = np.array([pd.Timestamp(day * ONE_DAY_NS).strftime('%Y-%m-%d') if day != NAT_INT else 'nodate' for day in unique_days], dtype=object)
+
+    return labels[inverse]
+
+
+def source_keys(dataframe):
+    """
+    Return the source logger file of each row of the r2rnav dataframe from
+    the logger file time ranges navparse records in the metadata (the
+    source_files attr), a row belongs to the last file starting at or before
+    its timestamp and rows without a timestamp to the file of the previous
+    row.  None if the data does not record the logger files.
+    """
+
+    source_files = dataframe.attrs.get('source_files')
+
+    if not source_files:
+        return None
+
+    source_files = sorted(source_files, key=lambda source_file: source_file[1])
+    names = np.array([source_file[0] for source_file in source_files], dtype=object)
+    starts = np.array([pd.Timestamp(source_file[1]).value for source_file in source_files], dtype=np.int64)
+
+    iso_time = time_column(dataframe, 'iso_time')
+    files = pd.Series(np.maximum(np.searchsorted(starts, iso_time, side='right') - 1, 0)).where(iso_time != NAT_INT)
+
+    return names[files.ffill().bfill().fillna(0).to_numpy(dtype=np.int64)]
+
+
+def _scan_run(args):
+    """
+    Return the accumulator for a run of rows (used by the process pool)
+    """
+
+    dataframe, thresholds, epoch_interval = args
+    return NavQAAccumulator(*thresholds, epoch_interval=epoch_interval).update(dataframe)
+
+
+def scan_nav_groups(dataframe, keys, delta_t_threshold=None, speed_threshold=None, acceleration_threshold=None, epoch_interval=None, workers=None): # pylint: disable=too-many-arguments
+    """
+    Compute the navinfo/navqa statistics for each group of rows of the r2rnav
+    dataframe (i.e. keys=day_keys(dataframe)).  Each run of consecutive rows
+    with the same key is scanned once, using up to workers processes, and the
+    runs are merged into the groups and the total.
+
+    Returns the total NavQAAccumulator and a dict of key: NavQAAccumulator in
+    order of first appearance.  The total is identical to scanning the whole
+    dataframe with the same epoch_interval (inferred from the whole dataframe
+    if not specified).
+    """
+
+    thresholds = (delta_t_threshold, speed_threshold, acceleration_threshold)
+
+    if epoch_interval is None:
+        epoch_interval = infer_epoch_interval(dataframe)
+
+    keys = np.asarray(keys, dtype=object)
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) > 0 else np.array([], dtype=np.int64)
+    ends = np.append(starts[1:], len(keys))
+
+    runs = [(dataframe.iloc[start:end], thresholds, epoch_interval) for start, end in zip(starts, ends)]
+
+    if workers is not None and workers > 1 and len(runs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            accumulators = list(executor.map(_scan_run, runs))
+    else:
+        accumulators = [_scan_run(run) for run in runs]
+
+    total = NavQAAccumulator(*thresholds, epoch_interval=epoch_interval)
+    groups = {}
+    for start, accumulator in zip(starts, accumulators):
+        total.merge(accumulator)
+        groups.setdefault(keys[start], NavQAAccumulator(*thresholds, epoch_interval=epoch_interval)).merge(accumulator)
+
+    return total, groups
+
+
+def _count_exceeding(values, thresholds):
+    """
+    Return the number of values greater than each threshold.  The values are
+    sorted once and each threshold is a binary search.
+    """
+
+    values = np.sort(values)
+    return len(values) - np.searchsorted(values, thresholds, side='right')
+
+
+def sweep_nav_data(dataframe, delta_t_thresholds=None, speed_thresholds=None, acceleration_thresholds=None):
+    """
+    Count the gap, speed and acceleration errors of the r2rnav dataframe for
+    every threshold in the lists (delta_t_thresholds in seconds), the counts
+    match scan_nav_data for the same threshold.  Returns a dict with the
+    total_lines and the thresholds/counts of each swept metric.  Sweeps of
+    consecutive chunks are combined with merge_sweeps.
+    """
+
+    sweep = {'total_lines': len(dataframe.index)}
+
+    if delta_t_thresholds is not None:
+        delta_t = time_column(dataframe, 'deltaT', dtype='timedelta64[ns]')
+        thresholds_ns = (np.asarray(delta_t_thresholds, dtype=np.float64) * 10**9).astype(np.int64)
+        sweep['delta_t'] = (list(delta_t_thresholds), _count_exceeding(delta_t[delta_t != NAT_INT], thresholds_ns))
+
+    if speed_thresholds is not None:
+        speed = float_column(dataframe, 'speed_made_good')
+        sweep['speed'] = (list(speed_thresholds), _count_exceeding(speed[~np.isnan(speed)], speed_thresholds))
+
+    if acceleration_thresholds is not None:
+        acceleration = float_column(dataframe, 'acceleration')
+        sweep['acceleration'] = (list(acceleration_thresholds), _count_exceeding(acceleration[~np.isnan(acceleration)], acceleration_thresholds))
+
+    return sweep
+
+
+def merge_sweeps(left, right):
+    """
+    Combine the sweeps of consecutive pieces of data, the sweeps must use the
+    same thresholds.
+    """
+
+    if left is None:
+        return right
+
+    merged = {'total_lines': left['total_lines'] + right['total_lines']}
+
+    for key in ['delta_t', 'speed', 'acceleration']:
+        if key in left:
+            if left[key][0] != right[key][0]:
+                logging.error("Can not merge sweeps with different thresholds")
+                raise ValueError("Sweep thresholds do not match for {}".format(key))
+
+            merged[key] = (left[key][0], left[key][1] + right[key][1])
+
+    return merged
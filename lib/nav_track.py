@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_track.py
+ DESCRIPTION:  Track statistics, segments the cruise into underway, on station
+               and in port intervals and calculates the track length.
+
+        BUGS:
+       NOTES:  A fix is underway when speed_made_good reaches the underway
+               speed and on station when it drops to the station speed, fixes
+               in between (or without a speed) keep the previous state
+               (hysteresis).  Fixes on station within the port radius of a
+               port are in port (requires a port database).  The segments are
+               the runs of equal states.  A segment lasts from its first fix
+               to the first fix of the next segment so the segment durations
+               and distances add up to the cruise totals.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.1
+     CREATED:  2021-05-20
+    REVISION:  2021-05-20
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import logging
+
+import numpy as np
+import pandas as pd
+from geopy.distance import EARTH_RADIUS
+
+from lib.nav_stats import NAT_INT, float_column, time_column
+from lib.nav_ports import PORT_RADIUS
+
+UNDERWAY_SPEED = 1.0 # m/s
+STATION_SPEED = 0.5  # m/s
+
+ON_STATION = 0
+UNDERWAY = 1
+IN_PORT = 2
+
+SEGMENT_STATES = {ON_STATION: 'on_station', UNDERWAY: 'underway', IN_PORT: 'in_port'}
+
+SEGMENT_COLS = ['state', 'start_ts', 'end_ts', 'duration', 'distance', 'fixes']
+
+
+def _hysteresis(speed, underway_speed, station_speed):
+    """
+    Return the underway (1) / on station (0) state of each speed, speeds
+    between the thresholds or missing keep the previous state, leading
+    undetermined speeds are on station
+    """
+
+    state = np.full(speed.size, -1, dtype=np.int8)
+    state[speed >= underway_speed] = UNDERWAY
+    state[speed <= station_speed] = ON_STATION
+
+    # forward fill the undetermined states
+    determined = np.where(state >= 0, np.arange(speed.size), 0)
+    np.maximum.accumulate(determined, out=determined)
+    state = state[determined]
+    state[state < 0] = ON_STATION
+
+    return state
+
+
+def _step_distances(longitude, latitude):
+    """
+    Return the great circle distance in km from the previous fix with a
+    position to each fix, 0 for the first fix and fixes without a position
+    """
+
+    distances = np.zeros(longitude.size)
+    valid = np.flatnonzero(~(np.isnan(longitude) | np.isnan(latitude)))
+
+    if valid.size < 2:
+        return distances
+
+    lon = np.radians(longitude[valid])
+    lat = np.radians(latitude[valid])
+
+    haversine = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    distances[valid[1:]] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(haversine, 1)))
+
+    return distances
+
+
+def segment_track(dataframe, underway_speed=UNDERWAY_SPEED, station_speed=STATION_SPEED, port_index=None, port_radius=PORT_RADIUS): # pylint: disable=too-many-arguments
+    """
+    Segment the r2rnav dataframe into underway, on station and in port
+    intervals.  Returns a dataframe with the state, start/end timestamps,
+    duration (int64 ns), distance (km) and number of fixes of each segment.
+    Fixes without a timestamp are ignored.
+    """
+
+    if station_speed > underway_speed:
+        logging.error("Invalid track segmentation speeds")
+        raise ValueError("The station speed ({} m/s) must not exceed the underway speed ({} m/s)".format(station_speed, underway_speed))
+
+    iso_time = time_column(dataframe, 'iso_time')
+    valid = iso_time != NAT_INT
+
+    iso_time = iso_time[valid]
+    longitude = float_column(dataframe, 'ship_longitude')[valid]
+    latitude = float_column(dataframe, 'ship_latitude')[valid]
+    speed = float_column(dataframe, 'speed_made_good')[valid]
+
+    if iso_time.size == 0:
+        return pd.DataFrame(columns=SEGMENT_COLS)
+
+    state = _hysteresis(speed, underway_speed, station_speed)
+
+    if port_index is not None:
+        stationary = np.flatnonzero(state == ON_STATION)
+        _, distances = port_index.nearest(latitude[stationary], longitude[stationary])
+        state[stationary[distances <= port_radius]] = IN_PORT
+
+    # run-length encode the states
+    starts = np.flatnonzero(np.diff(state, prepend=-1) != 0)
+    ends = np.append(starts[1:], iso_time.size - 1)
+
+    cumulative_distance = np.cumsum(_step_distances(longitude, latitude))
+
+    return pd.DataFrame({
+        'state': np.array([SEGMENT_STATES[value] for value in sorted(SEGMENT_STATES)])[state[starts]],
+        'start_ts': pd.to_datetime(iso_time[starts]),
+        'end_ts': pd.to_datetime(iso_time[ends]),
+        'duration': iso_time[ends] - iso_time[starts],
+        'distance': cumulative_distance[ends] - cumulative_distance[starts],
+        'fixes': np.diff(np.append(starts, iso_time.size))
+    }, columns=SEGMENT_COLS)
+
+
+def track_totals(segments):
+    """
+    Return the track length (km), the number of segments and the total
+    duration (ns) and distance (km) of each state
+    """
+
+    totals = segments.groupby('state')[['duration', 'distance']].sum()
+
+    return {
+        'track_length': float(segments['distance'].sum()),
+        'segments': len(segments.index),
+        'duration': {state: int(totals['duration'].get(state, 0)) for state in SEGMENT_STATES.values()},
+        'distance': {state: float(totals['distance'].get(state, 0)) for state in SEGMENT_STATES.values()}
+    }
@@ -0,0 +1,659 @@
+#!/usr/bin/env python3
+'''
+        FILE:  nav_writer.py
+ DESCRIPTION:  Contains the streaming output functions and the vectorized csv
+               encoder used by the r2rNavManagerPy programs to write
+               csv/geocsv data.
+
+        BUGS:
+       NOTES:  The encoder builds each chunk of csv text as a 2D array of
+               bytes (one row per record, NUL padded) and then strips the NUL
+               bytes, so no per-value python formatting is done.
+
+               Compressed output is written as independent gzip members/zstd
+               frames (one per block), which the standard tools decompress as
+               a single stream.  This lets the blocks be compressed in
+               parallel.
+      AUTHOR:  Webb Pinner
+     COMPANY:  OceanDataTools
+     VERSION:  0.3
+     CREATED:  2021-05-12
+    REVISION:  2021-05-14
+
+LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
+              Copyright (C) OceanDataTools 2021
+'''
+
+import os
+import sys
+import json
+import zlib
+import logging
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 50000 # rows
+
+ISO_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+ONE_DAY_NS = 86400 * 10**9
+ONE_DAY_US = 86400 * 10**6
+
+FLOAT_MAX_DECIMALS = 8
+
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024 # bytes
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd'
+}
+
+MANIFEST_FILENAME = 'manifest.json'
+
+NAT_INT = np.iinfo(np.int64).min
+
+
+def _byte_matrix(values):
+    """
+    Return the byte strings in values as a (rows, width) uint8 matrix, NUL
+    padded on the right.
+    """
+
+    values = np.ascontiguousarray(values)
+
+    if values.dtype.kind != 'S':
+        values = values.astype('S')
+
+    return values.view(np.uint8).reshape(values.shape[0], values.dtype.itemsize)
+
+
+def _const_matrix(rows, value):
+    """
+    Return a (rows, len(value)) uint8 matrix where each row is value.
+    """
+
+    matrix = np.empty((rows, len(value)), dtype=np.uint8)
+    matrix[:] = np.frombuffer(value, dtype=np.uint8)
+    return matrix
+
+
+def _na_matrix(mask, na_rep):
+    """
+    Return a matrix containing na_rep for the rows in mask, NUL elsewhere.
+    """
+
+    matrix = _const_matrix(mask.shape[0], na_rep)
+    matrix[~mask] = 0
+    return matrix
+
+
+def _digit_matrix(values, digits, leading_zeros=True):
+    """
+    Return non-negative integer values as a (rows, digits) matrix of ascii
+    digits.  If leading_zeros is False the leading zeros are NUL'ed.
+    """
+
+    powers = 10 ** np.arange(digits - 1, -1, -1, dtype=np.int64)
+    matrix = (values[:, None] // powers % 10 + ord('0')).astype(np.uint8)
+
+    if not leading_zeros and digits > 1:
+        leading = values[:, None] < powers
+        leading[:, -1] = False
+        matrix[leading] = 0
+
+    return matrix
+
+
+def _int_matrix(values):
+    """
+    Return integer values as a matrix of signed ascii integers.
+    """
+
+    values = np.asarray(values, dtype=np.int64)
+    abs_values = np.abs(values)
+    digits = len(str(abs_values.max())) if abs_values.size > 0 else 1
+
+    sign = _const_matrix(len(values), b'-')
+    sign[values >= 0] = 0
+
+    return np.hstack([sign, _digit_matrix(abs_values, digits, leading_zeros=False)])
+
+
+def _encode_datetime(series, na_rep, date_format):
+    """
+    Encode datetime column as ISO8601 strings (equivalent to strftime with
+    ISO_DATE_FORMAT).  The calendar fields are derived from the int64
+    timestamps using integer arithmetic.
+    """
+
+    if date_format != ISO_DATE_FORMAT:
+        raise TypeError("Unsupported date format: {}".format(date_format))
+
+    if series.dt.tz is not None:
+        series = series.dt.tz_localize(None)
+
+    micro = series.to_numpy(dtype='datetime64[us]').view(np.int64)
+    nat = micro == NAT_INT
+    micro = np.where(nat, 0, micro)
+    rows = len(micro)
+
+    days = micro // ONE_DAY_US
+    micro = micro - days * ONE_DAY_US
+
+    # civil date from days since 1970-01-01 (proleptic gregorian)
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = np.where(month_index < 10, month_index + 3, month_index - 9)
+    year = year_of_era + era * 400 + (month <= 2)
+
+    if ((year < 1000) | (year > 9999))[~nat].any():
+        raise TypeError("Year out of range for ISO8601 encoding")
+
+    matrix = np.hstack([
+        _digit_matrix(year, 4), _const_matrix(rows, b'-'),
+        _digit_matrix(month, 2), _const_matrix(rows, b'-'),
+        _digit_matrix(day, 2), _const_matrix(rows, b'T'),
+        _digit_matrix(micro // 3600000000, 2), _const_matrix(rows, b':'),
+        _digit_matrix(micro // 60000000 % 60, 2), _const_matrix(rows, b':'),
+        _digit_matrix(micro // 1000000 % 60, 2), _const_matrix(rows, b'.'),
+        _digit_matrix(micro % 1000000, 6), _const_matrix(rows, b'Z')
+    ])
+    matrix[nat] = 0
+
+    return [matrix, _na_matrix(nat, na_rep)]
+
+
+def _encode_timedelta(series, na_rep):
+    """
+    Encode timedelta column using the same representation as pandas (i.e.
+    "0 days 00:00:10.047000")
+    """
+
+    values = series.to_numpy(dtype='timedelta64[ns]').view(np.int64)
+    nat = values == NAT_INT
+    values = np.where(nat, 0, values)
+    rows = len(values)
+
+    days = values // ONE_DAY_NS
+    remainder = values - days * ONE_DAY_NS
+
+    # columns containing only whole days are written as "N days"
+    if not remainder.any():
+        matrix = np.hstack([_int_matrix(days), _const_matrix(rows, b' days')])
+        matrix[nat] = 0
+        return [matrix, _na_matrix(nat, na_rep)]
+
+    sub_seconds = remainder % 10**9
+    nano = sub_seconds % 1000
+
+    sign = _const_matrix(rows, b'+')
+    sign[days >= 0] = 0
+
+    fraction = np.hstack([_const_matrix(rows, b'.'), _digit_matrix(sub_seconds // 1000, 6)])
+    fraction[sub_seconds == 0] = 0
+
+    nano_matrix = _digit_matrix(nano, 3)
+    nano_matrix[nano == 0] = 0
+
+    matrix = np.hstack([
+        _int_matrix(days), _const_matrix(rows, b' days '), sign,
+        _digit_matrix(remainder // (3600 * 10**9), 2), _const_matrix(rows, b':'),
+        _digit_matrix(remainder // (60 * 10**9) % 60, 2), _const_matrix(rows, b':'),
+        _digit_matrix(remainder // 10**9 % 60, 2), fraction, nano_matrix
+    ])
+    matrix[nat] = 0
+
+    return [matrix, _na_matrix(nat, na_rep)]
+
+
+def _encode_float(series, na_rep, decimals=None):
+    """
+    Encode float column using the shortest repr of each value.  Values that
+    are exactly representable with at most decimals (default:
+    FLOAT_MAX_DECIMALS) decimal places, i.e. columns rounded with the rounding
+    table, are built from scaled integers.  All other values fall back to the
+    repr.
+    """
+
+    values = series.to_numpy(dtype=np.float64)
+    rows = len(values)
+    nan = np.isnan(values)
+
+    if decimals is None:
+        decimals = FLOAT_MAX_DECIMALS
+
+    # find the fewest decimal places that reproduce each value.  repr switches
+    # to scientific notation below 1e-4 and the value can only be rebuilt from
+    # decimals while the float spacing is finer than them.
+    row_decimals = np.full(rows, -1, dtype=np.int64)
+    with np.errstate(invalid='ignore', over='ignore'):
+        abs_values = np.abs(values)
+        candidate = ~nan & ((abs_values >= 1e-4) | (values == 0))
+
+        for places in range(decimals + 1):
+            scale = 10.0**places
+            found = candidate & (row_decimals < 0) & (abs_values < 10.0**(15 - places)) & (np.rint(values * scale) / scale == values)
+            row_decimals[found] = places
+
+    fast = row_decimals >= 0
+    max_decimals = max(int(row_decimals.max()) if rows > 0 else 0, 1)
+
+    scale = 10**np.maximum(row_decimals, 0)
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = np.where(fast, np.rint(abs_values * scale), 0).astype(np.int64)
+
+    sign = _const_matrix(rows, b'-')
+    sign[~(fast & np.signbit(values))] = 0
+
+    fraction = _digit_matrix(scaled % scale * 10**(max_decimals - np.maximum(row_decimals, 1)), max_decimals)
+    trailing = np.logical_and.accumulate(fraction[:, ::-1] == ord('0'), axis=1)[:, ::-1]
+    trailing[:, 0] = False
+    fraction[trailing] = 0
+
+    integer = scaled // scale
+    matrix = np.hstack([sign, _digit_matrix(integer, len(str(integer.max())) if rows > 0 else 1, leading_zeros=False), _const_matrix(rows, b'.'), fraction])
+    matrix[~fast] = 0
+
+    slow = ~fast & ~nan
+    parts = [matrix, _na_matrix(nan, na_rep)]
+
+    if slow.any():
+        slow_matrix = _byte_matrix(values.astype('S32'))
+        slow_matrix[~slow] = 0
+        parts.append(slow_matrix)
+
+    return parts
+
+
+def encode_csv(data_frame, header=True, na_rep='', date_format=ISO_DATE_FORMAT, precision=None):
+    """
+    Encode the data_frame as csv formatted bytes.  The output is identical to
+    DataFrame.to_csv(index=False, ...) for numeric, datetime and timedelta
+    columns.  precision is a dict of column: decimals (i.e. the rounding table)
+    for columns that have already been rounded, other float columns are
+    checked for up to FLOAT_MAX_DECIMALS decimal places.
+
+    Raises TypeError if the data_frame contains columns the encoder can not
+    reproduce exactly.
+    """
+
+    na_rep = na_rep.encode('ascii')
+    precision = precision or {}
+    rows = len(data_frame.index)
+
+    if len(data_frame.columns) < 2 and not na_rep:
+        raise TypeError("Single column csv requires quoting")
+
+    output = ','.join([str(col) for col in data_frame.columns]).encode('ascii') + b'\n' if header else b''
+
+    if rows == 0:
+        return output
+
+    parts = []
+    for idx, col in enumerate(data_frame.columns):
+        series = data_frame[col]
+
+        if idx > 0:
+            parts.append(_const_matrix(rows, b','))
+
+        if pd.api.types.is_datetime64_any_dtype(series.dtype):
+            parts += _encode_datetime(series, na_rep, date_format)
+
+        elif pd.api.types.is_timedelta64_dtype(series.dtype):
+            parts += _encode_timedelta(series, na_rep)
+
+        elif pd.api.types.is_float_dtype(series.dtype):
+            parts += _encode_float(series, na_rep, precision.get(col))
+
+        elif pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+            if series.hasnans:
+                raise TypeError("Unsupported nullable column: {}".format(col))
+            parts.append(_int_matrix(series.to_numpy()) if pd.api.types.is_integer_dtype(series.dtype) else _byte_matrix(series.to_numpy().astype('S')))
+
+        else:
+            raise TypeError("Unsupported column type: {} ({})".format(col, series.dtype))
+
+    parts.append(_const_matrix(rows, b'\n'))
+
+    matrix = np.hstack(parts)
+
+    return output + matrix[matrix != 0].tobytes()
+
+
+def write_csv(data_frame, out_file, header=None, chunk_size=CHUNK_SIZE, na_rep='', date_format=ISO_DATE_FORMAT, precision=None): # pylint: disable=too-many-arguments
+    """
+    Write the data_frame to the binary out_file (file object or
+    sys.stdout.buffer) in csv format, chunk_size rows at a time.  Each chunk is
+    flushed once written so downstream pipes receive data immediately and only
+    one chunk of csv text is held in memory at a time.
+
+    If header is specified (i.e. a geocsv header) it is written before the
+    csv data.  precision is passed to encode_csv, chunks encode_csv can not
+    handle are written with DataFrame.to_csv.
+    """
+
+    total_rows = len(data_frame.index)
+
+    logging.debug("Writing %d rows in chunks of %d rows", total_rows, chunk_size)
+
+    chunks = (data_frame.iloc[start:start + chunk_size] for start in range(0, max(total_rows, 1), chunk_size))
+    write_csv_chunks(chunks, out_file, header=header, na_rep=na_rep, date_format=date_format, precision=precision)
+
+
+def write_csv_chunks(chunks, out_file, header=None, na_rep='', date_format=ISO_DATE_FORMAT, precision=None): # pylint: disable=too-many-arguments
+    """
+    Write the dataframes yielded by chunks to the binary out_file in csv
+    format as one csv file (the column names are written with the first
+    chunk).  Each chunk is flushed once written, so the chunks can be
+    streamed from the input without holding the dataset in memory.  Returns
+    the number of rows written.
+
+    header and precision are used as with write_csv.
+    """
+
+    if header:
+        out_file.write(header.encode('utf-8'))
+
+    total_rows = 0
+
+    for idx, chunk in enumerate(chunks):
+
+        try:
+            out_file.write(encode_csv(chunk, header=(idx == 0), na_rep=na_rep, date_format=date_format, precision=precision))
+
+        except TypeError as err:
+            logging.debug("Falling back to DataFrame.to_csv: %s", str(err))
+            out_file.write(chunk.to_csv(header=(idx == 0), index=False, na_rep=na_rep, date_format=date_format).encode('utf-8'))
+
+        out_file.flush()
+        total_rows += len(chunk.index)
+
+    return total_rows
+
+
+def _compress_gzip(block, level):
+    """
+    Compress the block as a standalone gzip member
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _compress_zstd(block, level):
+    """
+    Compress the block as a standalone zstd frame
+    """
+
+    return zstandard.ZstdCompressor(level=level).compress(block)
+
+
+class CompressedWriter():
+    """
+    Binary file-like object that compresses everything written to it in
+    COMPRESSION_BLOCK_SIZE blocks using a pool of threads and writes the
+    compressed blocks, in order, to out_file.  Compression of a block runs
+    while the caller prepares the next one.
+    """
+
+    _codecs = {
+        'gzip': (_compress_gzip, 6),
+        'zstd': (_compress_zstd, 3)
+    }
+
+    def __init__(self, out_file, compression='gzip', threads=None, level=None, block_size=COMPRESSION_BLOCK_SIZE): # pylint: disable=too-many-arguments
+
+        if compression not in self._codecs:
+            raise ValueError("Unsupported compression: {}".format(compression))
+
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+        self._out_file = out_file
+        self._compress, default_level = self._codecs[compression]
+        self._level = default_level if level is None else level
+        self._block_size = block_size
+        self._threads = threads or os.cpu_count() or 1
+
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _submit(self):
+        """
+        Queue the buffered data for compression, if too many blocks are
+        pending wait for the oldest one and write it.
+        """
+
+        if self._buffer:
+            self._pending.append(self._executor.submit(self._compress, bytes(self._buffer), self._level))
+            self._buffer = bytearray()
+
+        while len(self._pending) > 2 * self._threads:
+            self._out_file.write(self._pending.popleft().result())
+
+
+    def _drain(self, wait=False):
+        """
+        Write the compressed blocks that are complete.  If wait is True write
+        all pending blocks.
+        """
+
+        while self._pending and (wait or self._pending[0].done()):
+            self._out_file.write(self._pending.popleft().result())
+
+
+    def write(self, data):
+        """
+        Buffer data, full blocks are submitted for compression.
+        """
+
+        self._buffer += data
+
+        if len(self._buffer) >= self._block_size:
+            self._submit()
+
+        self._drain()
+
+        return len(data)
+
+
+    def flush(self):
+        """
+        Submit the buffered data and write the blocks that have completed
+        compression.
+        """
+
+        self._submit()
+        self._drain()
+        self._out_file.flush()
+
+
+    def close(self):
+        """
+        Compress any remaining data, write all pending blocks and shut down the
+        thread pool.  The underlying out_file is flushed but not closed.
+        """
+
+        self._submit()
+        self._drain(wait=True)
+        self._executor.shutdown()
+        self._out_file.flush()
+
+
+def get_compression(filename, compression=None):
+    """
+    Return the compression to use for filename.  If compression is not
+    specified it is determined from the file extension.
+    """
+
+    if compression:
+        return compression
+
+    if filename:
+        return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+    return None
+
+
+@contextmanager
+def open_output(filename=None, compression=None, threads=None):
+    """
+    Open filename (stdout if filename is None) for binary output.  If
+    compression is specified or implied by the filename extension the output
+    is wrapped in a CompressedWriter.
+    """
+
+    compression = get_compression(filename, compression)
+    out_file = open(filename, 'wb') if filename else sys.stdout.buffer
+
+    try:
+        if compression:
+            logging.debug("Compressing output using %s", compression)
+            with CompressedWriter(out_file, compression=compression, threads=threads) as writer:
+                yield writer
+
+        else:
+            yield out_file
+
+    finally:
+        if filename:
+            out_file.close()
+
+
+def _partition_keys(data_frame, partition):
+    """
+    Return the partition key for each row.  partition is 'day' (UTC day of
+    iso_time) or a number of rows.  Rows without an iso_time are kept with the
+    preceding row.
+    """
+
+    if partition == 'day':
+        days = data_frame['iso_time'].dt.floor('D').ffill().bfill()
+        return days.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+    return np.arange(len(data_frame.index)) // int(partition)
+
+
+def write_partitioned(data_frame, directory, partition='day', compression=None, threads=None, prefix='r2rnav', metadata=None): # pylint: disable=too-many-arguments,too-many-locals
+    """
+    Write the data_frame to directory as a series of r2rnav csv shards, one
+    per UTC day or per partition rows, plus a manifest listing the time
+    bounds of each shard and the metadata (a json serializable dict).
+    Consecutive rows with the same key go to the same shard so the original
+    row order is preserved.
+
+    Derived columns (deltaT, speed_made_good, etc) must be calculated before
+    the data is partitioned so they are correct across shard boundaries.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+    keys = _partition_keys(data_frame, partition)
+    boundaries = list(np.flatnonzero(keys[1:] != keys[:-1]) + 1)
+    starts = [0] + boundaries if len(keys) > 0 else []
+    stops = boundaries + [len(keys)]
+
+    shards = []
+    for seq, (start, stop) in enumerate(zip(starts, stops)):
+        shard = data_frame.iloc[start:stop]
+        iso_time = shard['iso_time']
+
+        if partition == 'day':
+            day = pd.Timestamp(keys[start]).strftime('%Y%m%d') if keys[start] != NAT_INT else 'nodate'
+            filename = "{}_{:04d}_{}.csv{}".format(prefix, seq, day, extension)
+        else:
+            filename = "{}_{:04d}.csv{}".format(prefix, seq, extension)
+
+        logging.debug("Writing shard: %s (%d rows)", filename, stop - start)
+
+        with open_output(os.path.join(directory, filename), compression=compression, threads=threads) as out_file:
+            write_csv(shard, out_file, date_format=ISO_DATE_FORMAT)
+
+        shards.append({
+            'filename': filename,
+            'startTS': iso_time.min().strftime(ISO_DATE_FORMAT) if iso_time.notna().any() else None,
+            'endTS': iso_time.max().strftime(ISO_DATE_FORMAT) if iso_time.notna().any() else None,
+            'rows': int(stop - start)
+        })
+
+    manifest = {
+        'format': 'r2rnav',
+        'partition': partition,
+        'columns': [str(col) for col in data_frame.columns],
+        'shards': shards,
+        'metadata': metadata or {}
+    }
+
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
+
+
+def write_pyramid(levels, directory, header=None, compression=None, threads=None, prefix='pyramid', na_rep='', precision=None): # pylint: disable=too-many-arguments
+    """
+    Write the levels of detail of a track, (tolerance, data_frame) tuples
+    with the full resolution level first, to directory as one csv file per
+    level plus a manifest listing the points and tolerance of each level, so
+    a consumer only reads the level that fits its viewport or point budget.
+    If header is specified (i.e. a geocsv header) it is written at the top of
+    every level.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    extension = {'gzip': '.gz', 'zstd': '.zst'}.get(compression, '')
+
+    columns = []
+    index = []
+    for level, (tolerance, data_frame) in enumerate(levels):
+        filename = "{}_level{:02d}.csv{}".format(prefix, level, extension)
+
+        logging.debug("Writing pyramid level: %s (%d rows)", filename, len(data_frame.index))
+
+        with open_output(os.path.join(directory, filename), compression=compression, threads=threads) as out_file:
+            write_csv(data_frame, out_file, header=header, na_rep=na_rep, date_format=ISO_DATE_FORMAT, precision=precision)
+
+        columns = [str(col) for col in data_frame.columns]
+        index.append({
+            'level': level,
+            'filename': filename,
+            'points': len(data_frame.index),
+            'tolerance': tolerance
+        })
+
+    manifest = {
+        'format': 'r2rnav_pyramid',
+        'columns': columns,
+        'levels': index
+    }
+
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return manifest
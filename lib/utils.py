@@ -8,9 +8,9 @@
        NOTES:
       AUTHOR:  Webb Pinner
      COMPANY:  OceanDataTools
-     VERSION:  0.2
+     VERSION:  0.3
      CREATED:  2021-04-15
-    REVISION:  2021-05-05
+    REVISION:  2021-05-15
 
 LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for details)
               Copyright (C) OceanDataTools 2021
@@ -19,9 +19,19 @@ LICENSE INFO: This code is licensed under MIT license (see LICENSE.txt for detai
 import os
 import re
 import glob
+import json
 import math
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import pandas as pd
+from geopy.distance import EARTH_RADIUS
+
+from lib.nav_writer import MANIFEST_FILENAME, CHUNK_SIZE
+from lib.nav_archive import read_archive, iter_archive, read_archive_index
+
+SOURCE_FILE_COL = 'source_file'
 
 ################################################################################
 def build_file_list(path, sort=True, unique=True):
@@ -122,26 +132,220 @@ def calculate_bearing(point_b, point_a):
     return compass_bearing
 
 
-def read_r2rnavfile(file, file_format='csv'):
+def calculate_bearings(latitude, longitude):
+    """
+    Vectorized calculate_bearing, returns the bearing in degrees from each
+    point (latitude/longitude arrays in decimal degrees) to the next one, one
+    element shorter than the inputs
+    """
+
+    lat = np.radians(latitude)
+    diff_long = np.radians(np.diff(longitude))
+
+    x_pos = np.sin(diff_long) * np.cos(lat[1:])
+    y_pos = np.cos(lat[:-1]) * np.sin(lat[1:]) - (np.sin(lat[:-1]) * np.cos(lat[1:]) * np.cos(diff_long))
+
+    return (np.degrees(np.arctan2(x_pos, y_pos)) + 360) % 360
+
+
+def great_circle_distances(latitude, longitude):
+    """
+    Vectorized geopy great_circle, returns the distance in km from each point
+    (latitude/longitude arrays in decimal degrees) to the next one, one
+    element shorter than the inputs
+    """
+
+    lat = np.radians(latitude)
+    delta_lng = np.radians(np.diff(longitude))
+
+    sin_lat1, cos_lat1 = np.sin(lat[:-1]), np.cos(lat[:-1])
+    sin_lat2, cos_lat2 = np.sin(lat[1:]), np.cos(lat[1:])
+
+    distance = np.arctan2(np.sqrt((cos_lat2 * np.sin(delta_lng)) ** 2 + (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * np.cos(delta_lng)) ** 2),
+                          sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * np.cos(delta_lng))
+
+    return EARTH_RADIUS * distance
+
+
+def _to_naive_utc(timestamp):
+    """
+    Return timestamp as a tz-naive UTC pd.Timestamp (None if not specified)
+    """
+
+    if timestamp is None:
+        return None
+
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_convert(None) if timestamp.tzinfo is not None else timestamp
+
+
+def select_r2rnav_shards(directory, start_ts=None, end_ts=None):
+    """
+    Return the paths of the shards in the partitioned r2rnav directory that
+    overlap the start_ts/end_ts window, based on the directory's manifest.
+    """
+
+    with open(os.path.join(directory, MANIFEST_FILENAME), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    start_ts = _to_naive_utc(start_ts)
+    end_ts = _to_naive_utc(end_ts)
+
+    shards = []
+    for shard in manifest['shards']:
+
+        # shards without any valid timestamps are only included for full reads
+        if shard['startTS'] is None:
+            if start_ts is None and end_ts is None:
+                shards.append(os.path.join(directory, shard['filename']))
+            continue
+
+        if end_ts is not None and _to_naive_utc(shard['startTS']) > end_ts:
+            continue
+
+        if start_ts is not None and _to_naive_utc(shard['endTS']) < start_ts:
+            continue
+
+        shards.append(os.path.join(directory, shard['filename']))
+
+    return shards
+
+
+def _read_r2rnav_csv(file):
+    """
+    Read a single r2rnav csv file (optionally gzip/zstd compressed) and
+    convert the time columns.
+    """
+
+    return _convert_r2rnav_times(pd.read_csv(file))
+
+
+def _usecols(columns):
+    """
+    Return the read_csv usecols selecting the columns (all the columns if
+    None), columns missing from the file are ignored
+    """
+
+    if columns is None:
+        return None
+
+    return lambda name: name in columns
+
+
+def _convert_r2rnav_times(data):
+    """
+    Convert the time columns of r2rnav data read from csv
+    """
+
+    for col in ['iso_time', 'sensor_time']:
+        if col in data.columns:
+            data[col] = pd.to_datetime(data[col], utc=True).dt.tz_localize(None)
+
+    for col in ['deltaT', 'sensor_deltaT']:
+        if col in data.columns:
+            data[col] = pd.to_timedelta(data[col])
+
+    return data
+
+
+def _add_source(data, file, source):
+    """
+    Add the source_file column (basename of file) if source is True
+    """
+
+    if source:
+        data[SOURCE_FILE_COL] = os.path.basename(os.path.normpath(file))
+
+    return data
+
+
+def read_r2rnav_metadata(file, file_format='csv'):
+    """
+    Return the metadata (i.e. the qc_thresholds of the qc_flags column)
+    saved with the r2rnav file: the manifest of a partitioned directory, the
+    index of an archive file or the attributes of a hdf file.  csv files have
+    no metadata.
+    """
+
+    try:
+        if os.path.isdir(file):
+            with open(os.path.join(file, MANIFEST_FILENAME), 'r') as manifest_file:
+                return json.load(manifest_file).get('metadata', {})
+
+        if file_format == 'archive':
+            with open(file, 'rb') as archive_file:
+                return read_archive_index(archive_file).get('metadata', {})
+
+        if file_format == 'hdf':
+            with pd.HDFStore(file, mode='r') as data_file:
+                attrs = data_file.get_storer(data_file.keys()[0]).attrs
+                return getattr(attrs, 'metadata', {})
+
+    except (IOError, ValueError, IndexError) as err:
+        logging.warning("Could not read the r2rnav metadata of: %s", file)
+        logging.debug(str(err))
+
+    return {}
+
+
+def _add_metadata(data, file, file_format):
+    """
+    Record the r2rnav metadata in the dataframe attrs
+    """
+
+    data.attrs.update(read_r2rnav_metadata(file, file_format))
+    return data
+
+
+def read_r2rnavfile(file, file_format='csv', start_ts=None, end_ts=None, workers=None, source=False): # pylint: disable=too-many-arguments
     """
     Read the specifed r2rnav formatted file.  Returns a dataframe if successful
-    Return None if the file could not be read.
+    Return None if the file could not be read.  If source is True a
+    source_file column with the name of the file (or shard) each row was read
+    from is added.
+
+    If file is a partitioned r2rnav directory (see navparse.py --partition)
+    only the shards overlapping start_ts/end_ts are read, using up to workers
+    threads.  Likewise only the overlapping blocks of an archive file are
+    decoded.  Rows are not cropped to start_ts/end_ts.
     """
 
-    if file_format == 'hdf':
+    if os.path.isdir(file):
+        try:
+            shards = select_r2rnav_shards(file, start_ts, end_ts)
+            logging.debug("Reading %d shard(s) from %s", len(shards), file)
+
+            if not shards:
+                logging.warning("No shards in %s overlap the requested time window", file)
+                return None
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                data = pd.concat([_add_source(data, shard, source) for shard, data in zip(shards, executor.map(_read_r2rnav_csv, shards))], ignore_index=True)
+                return _add_metadata(data, file, file_format)
+
+        except IOError:
+            logging.error("Error opening partitioned r2rnav directory: %s", file)
+        except Exception as err:
+            logging.error("Error parsing partitioned r2rnav directory")
+            logging.error(str(err))
+
+    elif file_format == 'hdf':
         try:
             data = pd.read_hdf(file)
-            return data
+            return _add_metadata(_add_source(data, file, source), file, file_format)
         except IOError:
             logging.error("Error opening file r2rnav file: %s", file)
+    elif file_format == 'archive':
+        try:
+            return _add_metadata(_add_source(read_archive(file, start_ts=start_ts, end_ts=end_ts), file, source), file, file_format)
+        except IOError:
+            logging.error("Error opening file r2rnav file: %s", file)
+        except ValueError as err:
+            logging.error("Error parsing archive file")
+            logging.error(str(err))
     elif file_format == "csv":
         try:
-            data = pd.read_csv(file)
-            data['iso_time'] = pd.to_datetime(data['iso_time'])
-            data['sensor_time'] = pd.to_datetime(data['sensor_time'])
-            data['deltaT'] = pd.to_timedelta(data['deltaT'])
-            data['sensor_deltaT'] = pd.to_timedelta(data['sensor_deltaT'])
-            return data
+            return _add_source(_read_r2rnav_csv(file), file, source)
         except IOError:
             logging.error("Error opening file r2rnav file: %s", file)
         except Exception as err:
@@ -151,6 +355,192 @@ def read_r2rnavfile(file, file_format='csv'):
     return None
 
 
+def iter_r2rnavfile(file, file_format='csv', start_ts=None, end_ts=None, chunk_size=CHUNK_SIZE, source=False, columns=None): # pylint: disable=too-many-arguments
+    """
+    Read the specifed r2rnav formatted file (or partitioned r2rnav directory)
+    in chunks of up to chunk_size rows, yields a dataframe per chunk.  The
+    chunks are yielded in file order.  As with read_r2rnavfile only the
+    shards/blocks overlapping start_ts/end_ts are read, rows are not cropped,
+    source adds the source_file column and the r2rnav metadata is recorded in
+    the attrs of each chunk.  columns limits the columns that are read.  Logs
+    an error and stops if the file could not be read.
+    """
+
+    metadata = read_r2rnav_metadata(file, file_format)
+
+    try:
+        for chunk in _iter_r2rnav_chunks(file, file_format, start_ts, end_ts, chunk_size, source, columns):
+            chunk.attrs.update(metadata)
+            yield chunk
+
+    except IOError:
+        logging.error("Error opening file r2rnav file: %s", file)
+    except ValueError as err:
+        logging.error("Error parsing r2rnav file")
+        logging.error(str(err))
+
+
+def _iter_r2rnav_chunks(file, file_format, start_ts, end_ts, chunk_size, source, columns): # pylint: disable=too-many-arguments
+    """
+    Yield the chunks of the r2rnav file with the source_file column, see
+    iter_r2rnavfile
+    """
+
+    if os.path.isdir(file):
+        shards = select_r2rnav_shards(file, start_ts, end_ts)
+        logging.debug("Reading %d shard(s) from %s", len(shards), file)
+
+        if not shards:
+            logging.warning("No shards in %s overlap the requested time window", file)
+
+        for shard in shards:
+            with pd.read_csv(shard, chunksize=chunk_size, usecols=_usecols(columns)) as reader:
+                for chunk in reader:
+                    yield _add_source(_convert_r2rnav_times(chunk), shard, source)
+
+    elif file_format == 'hdf':
+        for chunk in _iter_hdf_chunks(file, chunk_size, columns):
+            yield _add_source(chunk, file, source)
+
+    elif file_format == 'archive':
+        for chunk in iter_archive(file, start_ts=start_ts, end_ts=end_ts, columns=columns):
+            chunk = _add_source(chunk, file, source)
+            for start in range(0, len(chunk.index), chunk_size):
+                yield chunk.iloc[start:start + chunk_size]
+
+    elif file_format == 'csv':
+        with pd.read_csv(file, chunksize=chunk_size, usecols=_usecols(columns)) as reader:
+            for chunk in reader:
+                yield _add_source(_convert_r2rnav_times(chunk), file, source)
+
+
+def _iter_hdf_chunks(file, chunk_size, columns):
+    """
+    Yield the chunks of the r2rnav hdf file (the first key) of up to
+    chunk_size rows.  Table format files (see navparse.py) are read chunk by
+    chunk, fixed format files are read whole and then sliced.
+    """
+
+    with pd.HDFStore(file, mode='r') as store:
+        key = store.keys()[0]
+
+        if columns is not None:
+            columns = [col for col in store.select(key, start=0, stop=0).columns if col in columns]
+
+        if store.get_storer(key).is_table:
+            for chunk in store.select(key, columns=columns, chunksize=chunk_size):
+                yield chunk.reset_index(drop=True)
+            return
+
+        logging.warning("Reading fixed format hdf file: %s into memory", file)
+        data = store.select(key)
+        data = data[columns] if columns is not None else data
+
+        for start in range(0, len(data.index), chunk_size):
+            yield data.iloc[start:start + chunk_size]
+
+
+def _stored_dtypes(file, file_format, columns=None):
+    """
+    Return the dtypes of the columns of the hdf (table format) or archive
+    file as read by read_r2rnavfile from the stored column types, None if
+    they are not stored (csv files, fixed format hdf files)
+    """
+
+    if file_format == 'hdf':
+        with pd.HDFStore(file, mode='r') as store:
+            key = store.keys()[0]
+
+            if not store.get_storer(key).is_table:
+                return None
+
+            dtypes = store.select(key, start=0, stop=0).dtypes
+
+    elif file_format == 'archive':
+        with open(file, 'rb') as archive_file:
+            kinds = {'time': np.dtype('datetime64[ns]'), 'timedelta': np.dtype('timedelta64[ns]')}
+            dtypes = {column['name']: kinds[column['dtype']] if column['dtype'] in kinds else np.dtype(column['dtype']) for column in read_archive_index(archive_file)['columns']}
+
+    else:
+        return None
+
+    return {col: dtype for col, dtype in dtypes.items() if columns is None or col in columns}
+
+
+def combine_dtypes(dtypes, data):
+    """
+    Update dtypes (dict of column: dtype) with the dtypes of the dataframe
+    the way concatenating the dataframes would, i.e. an integer column with
+    missing values in any dataframe is float64.  Returns dtypes.
+    """
+
+    for col, dtype in data.dtypes.items():
+        if col not in dtypes or dtypes[col] == dtype:
+            dtypes[col] = dtype
+        elif pd.api.types.is_numeric_dtype(dtypes[col]) and pd.api.types.is_numeric_dtype(dtype):
+            dtypes[col] = np.result_type(dtypes[col], dtype)
+        else:
+            dtypes[col] = np.dtype(object)
+
+    return dtypes
+
+
+def r2rnav_dtypes(file, file_format='csv', start_ts=None, end_ts=None, chunk_size=CHUNK_SIZE, columns=None): # pylint: disable=too-many-arguments
+    """
+    Return the dtype of each column of the r2rnav file as read by
+    read_r2rnavfile.  The stored types are used for hdf (table format) and
+    archive files, csv files (and partitioned directories) are read in
+    chunks (only the columns specified) and the dtypes of the chunks are
+    combined, see combine_dtypes.
+    """
+
+    if not os.path.isdir(file):
+        try:
+            dtypes = _stored_dtypes(file, file_format, columns)
+            if dtypes is not None:
+                return dtypes
+
+        except (IOError, ValueError) as err:
+            logging.warning("Could not read the stored dtypes of: %s", file)
+            logging.debug(str(err))
+
+    dtypes = {}
+    for chunk in iter_r2rnavfile(file, file_format, start_ts=start_ts, end_ts=end_ts, chunk_size=chunk_size, columns=columns):
+        combine_dtypes(dtypes, chunk)
+
+    return dtypes
+
+
+def read_r2rnav_columns(file, file_format='csv'):
+    """
+    Return the column names of the r2rnav file (or partitioned r2rnav
+    directory) without reading the data.  Returns None if the columns could
+    not be determined.
+    """
+
+    try:
+        if os.path.isdir(file):
+            shards = select_r2rnav_shards(file)
+            return list(pd.read_csv(shards[0], nrows=0).columns) if shards else None
+
+        if file_format == 'archive':
+            with open(file, 'rb') as archive_file:
+                return [column['name'] for column in read_archive_index(archive_file)['columns']]
+
+        if file_format == 'hdf':
+            with pd.HDFStore(file, mode='r') as store:
+                return list(store.select(store.keys()[0], start=0, stop=0).columns)
+
+        if file_format == 'csv':
+            return list(pd.read_csv(file, nrows=0).columns)
+
+    except (IOError, ValueError) as err:
+        logging.warning("Could not read the r2rnav columns of: %s", file)
+        logging.debug(str(err))
+
+    return None
+
+
 def hemisphere_correction(coordinate, hemisphere):
     if hemisphere in ('W', "S"):
         return coordinate * -1.0
@@ -189,6 +189,10 @@ class Nav01Parser(NavParser):
         # Re-order columns
         data = data[['iso_time', 'sensor_time', 'ship_latitude', 'ship_longitude', 'nmea_quality', 'nsv', 'hdop', 'antenna_height', 'valid_cksum', 'valid_parse', 'speed_made_good', 'course_made_good' ]]
 
+        # The iso_time is only known once the ZDA dates have been merged so the
+        # file report is built from the merged data
+        self.new_file_report(filepath).build_report(data)
+
         logging.debug("Finished parsing data file")
 
         return data
@@ -61,6 +61,9 @@ class Nav02Parser(NavParser):
         # Empty array to populate with parsed data
         raw_into_df = { value: [] for key, value in enumerate(self._parse_cols) }
 
+        # The file report is updated as each line is parsed
+        report = self.new_file_report(filepath)
+
         try:
             with open(filepath, 'r') as csvfile:
                 reader = csv.DictReader(csvfile, self._raw_cols)
@@ -93,6 +96,7 @@ class Nav02Parser(NavParser):
                         raw_into_df['antenna_height'].append(None)
                         raw_into_df['valid_cksum'].append(None)
                         raw_into_df['valid_parse'].append(0)
+                        report.add_parse_error()
 
                     else:
 
@@ -106,6 +110,7 @@ class Nav02Parser(NavParser):
                         raw_into_df['antenna_height'].append(antenna_height)
                         raw_into_df['valid_cksum'].append(valid_cksum)
                         raw_into_df['valid_parse'].append(1)
+                        report.add_fix(timestamp, longitude, latitude)
 
         except Exception as err:
             logging.error("Problem accessing input file: %s", filepath)
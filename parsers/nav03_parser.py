@@ -67,6 +67,9 @@ class Nav03Parser(NavParser):
 
         pos_into_df = { 'iso_time': [], 'sensor_time': [], 'ship_latitude': [], 'ship_longitude': [], 'nmea_quality': [], 'nsv': [], 'hdop': [], 'antenna_height': [], 'valid_cksum': [], 'valid_parse': [] }
 
+        # The file report is updated as each line is parsed
+        report = self.new_file_report(filepath)
+
         try:
             with open(filepath, 'r') as csvfile:
 
@@ -114,6 +117,11 @@ class Nav03Parser(NavParser):
                         pos_into_df['valid_cksum'].append(valid_cksum)
                         pos_into_df['valid_parse'].append(valid_parse)
 
+                        if valid_parse:
+                            report.add_fix(timestamp, ship_longitude, ship_latitude)
+                        else:
+                            report.add_parse_error()
+
                     elif row[2] == '$GPGGA':
 
                         if len(row) != len(raw_gga_cols):
@@ -145,6 +153,11 @@ class Nav03Parser(NavParser):
                         pos_into_df['valid_cksum'].append(valid_cksum)
                         pos_into_df['valid_parse'].append(valid_parse)
 
+                        if valid_parse:
+                            report.add_fix(timestamp, ship_longitude, ship_latitude)
+                        else:
+                            report.add_parse_error()
+
         except Exception as err:
             logging.error("Problem accessing input file: %s", filepath)
             logging.error(str(err))
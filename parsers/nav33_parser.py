@@ -61,6 +61,9 @@ class Nav33Parser(NavParser):
         # Empty array to populate with parsed data
         raw_into_df = { value: [] for key, value in enumerate(self._parse_cols) }
 
+        # The file report is updated as each line is parsed
+        report = self.new_file_report(filepath)
+
         try:
             with open(filepath, 'r') as csvfile:
                 reader = csv.DictReader(csvfile, self._raw_cols)
@@ -92,6 +95,7 @@ class Nav33Parser(NavParser):
                         antenna_height = None
                         valid_cksum = None
                         valid_parse = 0
+                        report.add_parse_error()
 
                     else:
                         raw_into_df['iso_time'].append(timestamp)
@@ -103,6 +107,8 @@ class Nav33Parser(NavParser):
                         raw_into_df['hdop'].append(hdop)
                         raw_into_df['antenna_height'].append(antenna_height)
                         raw_into_df['valid_cksum'].append(valid_cksum)
+                        raw_into_df['valid_parse'].append(valid_parse)
+                        report.add_fix(timestamp, longitude, latitude)
 
         except Exception as err:
             logging.error("Problem accessing input file: %s", filepath)